@@ -2,7 +2,161 @@
 Compress imagery using lzma
 """
 
+import os
 import lzma
+import logging
+from compressor.container import compress_container, decompress_container, BlockReader, \
+    is_block_container
+from compressor.codecs import iter_encode, iter_decode, choose_codec, read_header, write_header, \
+    open_source
+from compressor.filters import filter_spec, filtered_samples, iter_filter, iter_unfilter
+from compressor.roi import decompress_window, extract_window, open_random_access
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024  # 1 MiB read, and at most 1 MiB produced, per step
+
+
+def iter_compress(chunks, preset=6, codec="lzma"):
+    """
+    Compresses a stream of chunks without holding it in memory
+    :param chunks: iterable of bytes-like objects
+    :param preset: compression level
+    :param codec: codec name (see compressor.codecs.CODECS)
+    :return: generator of compressed bytes
+    """
+
+    return iter_encode(chunks, codec, preset)
+
+
+def iter_decompress(chunks, buffer_size=DEFAULT_BUFFER_SIZE, codec="lzma"):
+    """
+    Decompresses a stream of chunks. No step produces more than buffer_size bytes, so even a
+    small, highly compressed input can't blow up memory. Concatenated streams are supported, as
+    with lzma.open.
+    :param chunks: iterable of compressed bytes-like objects
+    :param buffer_size: maximum number of bytes yielded at a time
+    :param codec: codec name (see compressor.codecs.CODECS)
+    :return: generator of decompressed bytes
+    """
+
+    return iter_decode(chunks, codec, buffer_size)
+
+
+def iter_file(f, buffer_size=DEFAULT_BUFFER_SIZE, progress=None, total=None):
+    """
+    Reads a binary file object in chunks
+    :param f: binary file object
+    :param buffer_size: number of bytes to read per chunk
+    :param progress: callable taking (bytes read, total bytes), called after every chunk
+    :param total: total passed to progress
+    :return: generator of bytes
+    """
+
+    read = 0
+
+    while True:
+        chunk = f.read(buffer_size)
+        if not chunk:
+            break
+
+        read += len(chunk)
+        if progress is not None:
+            progress(read, total)
+
+        yield chunk
+
+
+def compress_file(source, destination, buffer_size=DEFAULT_BUFFER_SIZE, progress=None,
+                  codec=None, preset=None, filters=None):
+    """
+    Compresses one file into another with constant memory use. The codec is chosen by sampling
+    the file unless one is given, and is recorded in a header so decompress_file can read it.
+    The pixels of uncompressed rasters are run through pre-filters first if NumPy is available
+    (see compressor.filters).
+    :param source: path of the file to compress
+    :param destination: path of the file to write
+    :param buffer_size: number of bytes to read per step
+    :param progress: callable taking (bytes read, total bytes), e.g.
+    CheckoutStatusWindow.update_progress_bar
+    :param codec: codec name (see compressor.codecs.CODECS). None chooses one automatically.
+    :param preset: compression level. Defaults to the codec's default.
+    :param filters: pre-filter names (see compressor.filters.FILTERS). None uses the defaults,
+    an empty list turns them off.
+    :return: metadata dict recorded in the header
+    """
+
+    total = os.path.getsize(source)
+    spec = filter_spec(source, filters)
+
+    if codec is None:
+        metadata = choose_codec(source, None if spec is None else filtered_samples(source, spec))
+        logging.info("Compressing {0} with {1}: {2}".format(source, metadata["codec"],
+                                                            metadata["reason"]))
+    else:
+        metadata = {"codec": codec, "preset": preset}
+
+    if preset is not None:
+        metadata["preset"] = preset
+    metadata["size"] = total
+
+    if spec is not None and metadata["codec"] != "store":
+        metadata["filter"] = spec
+
+    with open(source, 'rb') as f_in, open(destination, 'wb') as f_out:
+        write_header(f_out, metadata)
+
+        chunks = iter_file(f_in, buffer_size, progress, total)
+        if "filter" in metadata:
+            chunks = iter_filter(chunks, metadata["filter"], total)
+
+        for data in iter_encode(chunks, metadata["codec"], metadata["preset"]):
+            f_out.write(data)
+
+    return metadata
+
+
+def decompress_file(source, destination, buffer_size=DEFAULT_BUFFER_SIZE, progress=None):
+    """
+    Decompresses one file into another with constant memory use. Files without a header are
+    read as plain .xz, as written by older versions.
+    :param source: path of the compressed file, or a binary file object
+    :param destination: path of the file to write
+    :param buffer_size: number of bytes to read, and at most write, per step
+    :param progress: callable taking (compressed bytes read, compressed total)
+    :return: None
+    """
+
+    with open(destination, 'wb') as f_out:
+        for data in iter_decompress_file(source, buffer_size, progress):
+            f_out.write(data)
+
+
+def iter_decompress_file(source, buffer_size=DEFAULT_BUFFER_SIZE, progress=None):
+    """
+    Decompresses a file written by compress_file, or a plain .xz file, in pieces
+    :param source: path of the compressed file, or a binary file object positioned at its start
+    :param buffer_size: number of bytes to read, and at most yield, per step
+    :param progress: callable taking (compressed bytes read, compressed total)
+    :return: generator of bytes
+    """
+
+    with open_source(source) as f:
+        start = f.tell()
+        total = f.seek(0, os.SEEK_END) - start
+        f.seek(start)
+
+        metadata = read_header(f)
+        if metadata is not None and "delta" in metadata:
+            raise ValueError("{} is a delta; rebuild it from its parent with "
+                             "compressor.delta.apply_delta".format(source))
+
+        codec = "lzma" if metadata is None else metadata["codec"]
+        pieces = iter_decode(iter_file(f, buffer_size, progress, total), codec, buffer_size)
+
+        if metadata is not None and "filter" in metadata:
+            pieces = iter_unfilter(pieces, metadata["filter"], metadata["size"])
+
+        for data in pieces:
+            yield data
 
 
 class Compressor:
@@ -10,26 +164,93 @@ class Compressor:
     Compressor
     """
 
-    def __init__(self, file_to_use, output_file):
+    def __init__(self, file_to_use, output_file, buffer_size=DEFAULT_BUFFER_SIZE, progress=None,
+                 workers=None, filters=None):
+        """
+        :param file_to_use: bytes to compress, or path of the file to compress/decompress
+        :param output_file: path of the file to write
+        :param buffer_size: number of bytes to handle per step when streaming
+        :param progress: callable taking (bytes read, total bytes)
+        :param workers: number of processes used for block containers
+        :param filters: raster pre-filters for compress (see compress_file)
+        """
+
         self.file = file_to_use
         self.output_file = output_file
+        self.buffer_size = buffer_size
+        self.progress = progress
+        self.workers = workers
+        self.filters = filters
 
     def compress(self):
         """
-        Compress the file using lzma
+        Compress the file. Bytes are written as plain .xz. Paths are streamed with constant
+        memory use, with a codec chosen by sampling the file (see compressor.codecs) and the
+        pixels of uncompressed rasters pre-filtered (see compressor.filters).
         :return: None
         """
 
-        with lzma.open(self.output_file, 'w') as f:
-            f.write(self.file)
+        if isinstance(self.file, (bytes, bytearray, memoryview)):
+            with lzma.open(self.output_file, 'w') as f:
+                f.write(self.file)
+        else:
+            compress_file(self.file, self.output_file, self.buffer_size, self.progress,
+                          filters=self.filters)
+
+    def compress_blocks(self):
+        """
+        Compress the file into a multi-block container across all cores. Decompressing it is
+        parallel too, and parts of it can be read with BlockReader.
+        :return: None
+        """
+
+        compress_container(self.file, self.output_file, workers=self.workers,
+                           progress=self.progress)
 
     def decompress(self):
         """
-        Read a compressed file
+        Read a compressed file. This holds the whole decompressed file in memory; use
+        decompress_to_file or iter_decompress for large rasters.
         :return: a file object
         """
 
-        with lzma.open(self.file) as f:
-            file_content = f.read()
+        return b"".join(self.iter_decompress())
+
+    def decompress_to_file(self):
+        """
+        Decompress the file into output_file with constant memory use. Block containers are
+        decompressed in parallel.
+        :return: None
+        """
+
+        if is_block_container(self.file):
+            decompress_container(self.file, self.output_file, self.workers, self.progress)
+            return
+
+        decompress_file(self.file, self.output_file, self.buffer_size, self.progress)
+
+    def decompress_window(self, window=None, tiles=None):
+        """
+        Check out part of a compressed TIFF into output_file, decompressing only the blocks that
+        cover it. The file needs a seekable layout (see compress_blocks).
+        :param window: (x offset, y offset, width, height) in pixels
+        :param tiles: tile or strip indices, instead of a window
+        :return: (x offset, y offset, width, height) of the written image within the source
+        """
+
+        return decompress_window(self.file, self.output_file, window, tiles)
+
+    def iter_decompress(self):
+        """
+        Decompress the file in pieces of at most buffer_size bytes
+        :return: generator of bytes
+        """
+
+        if is_block_container(self.file):
+            with BlockReader(self.file) as reader:
+                for data in reader:
+                    yield data
+            return
 
-        return file_content
+        for data in iter_decompress_file(self.file, self.buffer_size, self.progress):
+            yield data
@@ -0,0 +1,335 @@
+"""
+Codec registry and adaptive codec selection. Files are sampled, and TIFFs have their internal
+compression tag read, so imagery that is already compressed is stored as-is instead of burning
+CPU on lzma for no gain. The chosen codec is recorded in a small header in front of the data:
+
+    MAGIC, version (B), metadata length (I), metadata (UTF-8 JSON), codec stream
+"""
+
+import os
+import bz2
+import json
+import contextlib
+import lzma
+import zlib
+import struct
+from filesystem_utils.rasters import TiffFile, COMPRESSION
+
+MAGIC = b"IVCZ"
+VERSION = 1
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+_HEADER = struct.Struct("<4sBI")
+
+# TIFF compression tag values whose data won't shrink any further
+TIFF_COMPRESSED = {6: "old-style jpeg", 7: "jpeg", 34712: "jpeg2000", 34887: "lerc",
+                   34892: "lossy jpeg", 50000: "zstd", 50001: "webp", 50002: "jpeg xl"}
+
+SAMPLE_COUNT = 4
+SAMPLE_SIZE = 256 * 1024
+STORE_RATIO = 0.95  # Store if the best codec can't get the sample below this
+MIN_GAIN = 0.05  # A slower codec has to beat zlib by this much of the original size
+
+
+class _Store:
+    """
+    Pass-through codec with the compressor/decompressor interface
+    """
+
+    eof = False
+    needs_input = True
+    unused_data = b""
+
+    def compress(self, data):
+        return bytes(data)
+
+    def flush(self):
+        return b""
+
+    def decompress(self, data, max_length=-1):
+        return bytes(data)
+
+
+class _ZlibDecompressor:
+    """
+    Gives zlib.decompressobj the needs_input/eof interface of the bz2 and lzma decompressors
+    """
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+
+    @property
+    def eof(self):
+        return self.decompressor.eof
+
+    @property
+    def needs_input(self):
+        return not self.decompressor.unconsumed_tail
+
+    @property
+    def unused_data(self):
+        return self.decompressor.unused_data
+
+    def decompress(self, data, max_length=-1):
+        data = self.decompressor.unconsumed_tail + data
+        return self.decompressor.decompress(data, max(max_length, 0))
+
+
+# Codec name -> (callable taking a preset and returning a compressor, decompressor class)
+CODECS = {
+    "store": (lambda preset: _Store(), _Store),
+    "zlib": (lambda preset: zlib.compressobj(preset), _ZlibDecompressor),
+    "bz2": (lambda preset: bz2.BZ2Compressor(max(preset, 1)), bz2.BZ2Decompressor),
+    "lzma": (lambda preset: lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=preset),
+             lzma.LZMADecompressor),
+}
+
+DEFAULT_PRESETS = {"store": 0, "zlib": 6, "bz2": 9, "lzma": 6}
+
+
+def new_compressor(codec, preset=None):
+    """
+    Creates a streaming compressor from the registry
+    :param codec: codec name
+    :param preset: compression level. Defaults to the codec's entry in DEFAULT_PRESETS.
+    :return: object with compress() and flush()
+    """
+
+    if codec not in CODECS:
+        raise ValueError("Unknown codec '{0}'. Available: {1}".format(
+            codec, ", ".join(sorted(CODECS))))
+
+    return CODECS[codec][0](DEFAULT_PRESETS[codec] if preset is None else preset)
+
+
+def new_decompressor(codec):
+    """
+    Creates a streaming decompressor from the registry
+    :param codec: codec name
+    :return: object with decompress(data, max_length), needs_input, eof and unused_data
+    """
+
+    if codec not in CODECS:
+        raise ValueError("Unknown codec '{0}'. Available: {1}".format(
+            codec, ", ".join(sorted(CODECS))))
+
+    return CODECS[codec][1]()
+
+
+def iter_encode(chunks, codec, preset=None):
+    """
+    Compresses a stream of chunks with a codec
+    :param chunks: iterable of bytes-like objects
+    :param codec: codec name
+    :param preset: compression level
+    :return: generator of compressed bytes
+    """
+
+    compressor = new_compressor(codec, preset)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    data = compressor.flush()
+    if data:
+        yield data
+
+
+def iter_decode(chunks, codec, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+    Decompresses a stream of chunks. No step produces more than buffer_size bytes. Concatenated
+    streams are followed, as lzma.open and bz2.open do.
+    :param chunks: iterable of compressed bytes-like objects
+    :param codec: codec name
+    :param buffer_size: maximum number of bytes yielded at a time
+    :return: generator of decompressed bytes
+    """
+
+    decompressor = new_decompressor(codec)
+
+    for chunk in chunks:
+        data = bytes(chunk)
+
+        while data or not decompressor.needs_input:
+            if decompressor.eof:
+                data = decompressor.unused_data + data
+                if not data:
+                    break
+                decompressor = new_decompressor(codec)  # Next concatenated stream
+
+            output = decompressor.decompress(data, max_length=buffer_size)
+            data = b""
+
+            if output:
+                yield output
+            elif decompressor.needs_input:
+                break
+
+    if codec != "store" and not decompressor.eof:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+
+class ChunkReader:
+    """
+    Reads exact byte counts from a generator of pieces
+    """
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.buffer = bytearray()
+        self.offset = 0  # Start of the unread bytes in buffer
+
+    def read(self, length):
+        """
+        :return: length bytes, or fewer at the end of the pieces
+        """
+
+        while len(self.buffer) - self.offset < length:
+            piece = next(self.pieces, None)
+            if piece is None:
+                break
+
+            # Drop the bytes already read before appending. Fewer than length are left unread,
+            # so this copies no more than the read itself, instead of the rest of the buffer on
+            # every read.
+            del self.buffer[:self.offset]
+            self.offset = 0
+            self.buffer += piece
+
+        end = self.offset + length
+        data = bytes(self.buffer[self.offset:end])
+        self.offset = min(end, len(self.buffer))
+
+        return data
+
+
+def open_source(source):
+    """
+    Opens a path for reading, or passes an already open binary file object through
+    :param source: path or binary file object
+    :return: context manager giving a binary file object
+    """
+
+    if hasattr(source, "read"):
+        return contextlib.nullcontext(source)
+
+    return open(source, 'rb')
+
+
+def tiff_compression(path):
+    """
+    Reads the compression tag of the first image in a TIFF
+    :param path: path to file
+    :return: compression tag value, or None if the file isn't a readable TIFF
+    """
+
+    with open(path, 'rb') as f:
+        if f.read(4) not in (b"II*\0", b"MM\0*", b"II+\0", b"MM\0+"):
+            return None
+
+        try:
+            return TiffFile(f).tag(0, COMPRESSION, [1])[0]
+        except (ValueError, struct.error, IndexError):
+            return None
+
+
+def read_samples(path, sample_count=SAMPLE_COUNT, sample_size=SAMPLE_SIZE):
+    """
+    Reads evenly spaced samples of a file
+    :return: list of bytes
+    """
+
+    file_size = os.path.getsize(path)
+    samples = []
+
+    with open(path, 'rb') as f:
+        if file_size <= sample_count * sample_size:
+            return [f.read()]
+
+        step = (file_size - sample_size) // (sample_count - 1)
+        for index in range(sample_count):
+            f.seek(index * step)
+            samples.append(f.read(sample_size))
+
+    return samples
+
+
+def choose_codec(path, samples=None):
+    """
+    Chooses a codec and preset for a file. TIFFs whose tiles are already JPEG/JPEG2000/etc.
+    compressed are stored. Everything else is decided by compressing samples of the file with
+    each codec: the file is stored if nothing gets it below STORE_RATIO, and a slower codec is
+    only picked over zlib if it saves at least MIN_GAIN more.
+    :param path: path to file
+    :param samples: list of bytes to decide on instead of samples read from the file, e.g.
+    pre-filtered pixel data
+    :return: metadata dict with "codec", "preset" and the reason for the choice
+    """
+
+    compression = tiff_compression(path)
+
+    if compression in TIFF_COMPRESSED:
+        return {"codec": "store", "preset": 0, "tiff_compression": compression,
+                "reason": "tiff is {} compressed".format(TIFF_COMPRESSED[compression])}
+
+    sample = b"".join(read_samples(path) if samples is None else samples)
+    if not sample:
+        return {"codec": "store", "preset": 0, "reason": "empty file"}
+
+    ratios = {}
+    for codec in ("zlib", "bz2", "lzma"):
+        compressed = b"".join(iter_encode([sample], codec))
+        ratios[codec] = len(compressed) / len(sample)
+
+    best = min(ratios, key=ratios.get)
+    metadata = {"tiff_compression": compression, "sample_ratios": ratios}
+
+    if ratios[best] >= STORE_RATIO:
+        codec = "store"
+    elif ratios["zlib"] - ratios[best] < MIN_GAIN:
+        codec = "zlib"
+    else:
+        codec = best
+
+    metadata.update({"codec": codec, "preset": DEFAULT_PRESETS[codec],
+                     "reason": "sampled {:.0%} with {}".format(ratios[best], best)})
+
+    return metadata
+
+
+def write_header(f, metadata):
+    """
+    Writes the header in front of a codec stream
+    :param f: binary file object
+    :param metadata: dict with at least "codec"
+    :return: None
+    """
+
+    encoded = json.dumps(metadata, sort_keys=True).encode("utf-8")
+    f.write(_HEADER.pack(MAGIC, VERSION, len(encoded)))
+    f.write(encoded)
+
+
+def read_header(f):
+    """
+    Reads the header of a file written by write_header, leaving f at the start of the stream
+    :param f: binary file object at the start of the file
+    :return: metadata dict, or None if the file has no header (raw .xz from older versions).
+    f is left where it was in that case.
+    """
+
+    start = f.tell()
+    header = f.read(_HEADER.size)
+
+    if len(header) < _HEADER.size or header[:len(MAGIC)] != MAGIC:
+        f.seek(start)
+        return None
+
+    magic, version, length = _HEADER.unpack(header)
+    if version > VERSION:
+        raise ValueError("Compressed file is version {0}; only {1} is supported".format(
+            version, VERSION))
+
+    return json.loads(f.read(length).decode("utf-8"))
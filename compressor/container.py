@@ -0,0 +1,268 @@
+"""
+Multi-block LZMA container. The input is cut into fixed-size blocks that are compressed
+independently across a process pool, and an index of the blocks is written at the end of the
+file. Decompression is parallel as well, and BlockReader can read any byte range after inflating
+only the blocks that cover it.
+
+Layout (all integers little-endian):
+
+    header   MAGIC, version (B), 3 bytes padding, block size (I)
+    blocks   one .xz stream per block
+    index    per block: uncompressed offset, uncompressed length, compressed offset,
+             compressed length (4 x Q)
+    footer   index offset (Q), block count (Q), uncompressed size (Q), MAGIC
+"""
+
+import os
+import lzma
+import bisect
+import struct
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+MAGIC = b"IVCB"
+VERSION = 1
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024  # Smaller is cheaper to read at random, larger compresses
+                                      # better
+DEFAULT_PRESET = 6
+
+_HEADER = struct.Struct("<4sB3xI")
+_INDEX_ENTRY = struct.Struct("<QQQQ")
+_FOOTER = struct.Struct("<QQQ4s")
+
+
+def is_block_container(path):
+    """
+    Checks whether a file is a block container
+    :param path: path to file
+    :return: Bool
+    """
+
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _compress_block(source, offset, length, preset):
+    """
+    Reads and compresses one block. Runs in a worker process; reading the block there keeps the
+    uncompressed data from being pickled across.
+    :return: compressed bytes
+    """
+
+    with open(source, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=preset)
+
+
+def _decompress_block(source, destination, compressed_offset, compressed_length, offset,
+                      length):
+    """
+    Decompresses one block straight into its place in the destination file. Runs in a worker
+    process, so only the offsets are pickled.
+    :return: number of bytes written
+    """
+
+    with open(source, 'rb') as f:
+        f.seek(compressed_offset)
+        data = lzma.decompress(f.read(compressed_length), format=lzma.FORMAT_XZ)
+
+    if len(data) != length:
+        raise ValueError("Block at {0} decompressed to {1} bytes instead of {2}".format(
+            offset, len(data), length))
+
+    with open(destination, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+    return length
+
+
+def compress_container(source, destination, block_size=DEFAULT_BLOCK_SIZE, workers=None,
+                       preset=DEFAULT_PRESET, progress=None):
+    """
+    Compresses a file into a block container across a process pool. At most two blocks per
+    worker are in flight, so memory use doesn't grow with the file size.
+    :param source: path of the file to compress
+    :param destination: path of the container to write
+    :param block_size: uncompressed bytes per block
+    :param workers: number of processes. Defaults to the number of CPUs.
+    :param preset: lzma preset (0-9)
+    :param progress: callable taking (bytes compressed, total bytes)
+    :return: number of blocks written
+    """
+
+    total = os.path.getsize(source)
+    workers = workers or os.cpu_count() or 1
+    blocks = [(offset, min(block_size, total - offset)) for offset in range(0, total, block_size)]
+    index = []
+
+    with open(destination, 'wb') as f_out, ProcessPoolExecutor(max_workers=workers) as executor:
+        f_out.write(_HEADER.pack(MAGIC, VERSION, block_size))
+        pending = collections.deque()
+        next_block = 0
+        done = 0
+
+        while next_block < len(blocks) or pending:
+            # Keep the pool busy without queueing the whole file
+            while next_block < len(blocks) and len(pending) < workers * 2:
+                offset, length = blocks[next_block]
+                pending.append((offset, length, executor.submit(_compress_block, source, offset,
+                                                                length, preset)))
+                next_block += 1
+
+            offset, length, future = pending.popleft()
+            data = future.result()  # Blocks are written in order
+            index.append((offset, length, f_out.tell(), len(data)))
+            f_out.write(data)
+
+            done += length
+            if progress is not None:
+                progress(done, total)
+
+        index_offset = f_out.tell()
+        for entry in index:
+            f_out.write(_INDEX_ENTRY.pack(*entry))
+        f_out.write(_FOOTER.pack(index_offset, len(index), total, MAGIC))
+
+    return len(index)
+
+
+def decompress_container(source, destination, workers=None, progress=None):
+    """
+    Decompresses a block container across a process pool. Each worker writes its block into
+    place in the preallocated destination file.
+    :param source: path of the container
+    :param destination: path of the file to write
+    :param workers: number of processes. Defaults to the number of CPUs.
+    :param progress: callable taking (bytes decompressed, total bytes)
+    :return: None
+    """
+
+    with BlockReader(source) as reader:
+        index = reader.index
+        total = reader.size
+
+    with open(destination, 'wb') as f:
+        f.truncate(total)
+
+    workers = workers or os.cpu_count() or 1
+    done = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_decompress_block, source, destination, compressed_offset,
+                                   compressed_length, offset, length)
+                   for offset, length, compressed_offset, compressed_length in index]
+
+        for future in futures:
+            done += future.result()
+            if progress is not None:
+                progress(done, total)
+
+
+class BlockReader:
+    """
+    Random access to the uncompressed contents of a block container
+    """
+
+    def __init__(self, path, cached_blocks=4):
+        """
+        :param path: path of the container
+        :param cached_blocks: number of decompressed blocks kept for repeated reads
+        """
+
+        self.f = open(path, 'rb')
+
+        try:
+            magic, version, self.block_size = _HEADER.unpack(self.f.read(_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError("{} is not a block container".format(path))
+            if version > VERSION:
+                raise ValueError("{0} is container version {1}; only {2} is supported".format(
+                    path, version, VERSION))
+
+            self.f.seek(-_FOOTER.size, os.SEEK_END)
+            index_offset, block_count, self.size, magic = _FOOTER.unpack(
+                self.f.read(_FOOTER.size))
+            if magic != MAGIC:
+                raise ValueError("{} is truncated (no footer)".format(path))
+
+            self.f.seek(index_offset)
+            index_data = self.f.read(block_count * _INDEX_ENTRY.size)
+            self.index = [_INDEX_ENTRY.unpack_from(index_data, position * _INDEX_ENTRY.size)
+                          for position in range(block_count)]
+        except (ValueError, struct.error):
+            self.f.close()
+            raise
+
+        self.offsets = [entry[0] for entry in self.index]
+        self.cached_blocks = cached_blocks
+        self.cache = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes the container
+        :return: None
+        """
+
+        self.f.close()
+
+    def read_block(self, block_number):
+        """
+        Decompresses one block
+        :param block_number: position in the index
+        :return: bytes
+        """
+
+        data = self.cache.get(block_number)
+        if data is not None:
+            self.cache.move_to_end(block_number)
+            return data
+
+        offset, length, compressed_offset, compressed_length = self.index[block_number]
+        self.f.seek(compressed_offset)
+        data = lzma.decompress(self.f.read(compressed_length), format=lzma.FORMAT_XZ)
+
+        self.cache[block_number] = data
+        if len(self.cache) > self.cached_blocks:
+            self.cache.popitem(last=False)
+
+        return data
+
+    def read_at(self, offset, length):
+        """
+        Reads a byte range of the uncompressed file, inflating only the blocks that cover it
+        :param offset: uncompressed offset
+        :param length: number of bytes. Reads past the end return fewer bytes.
+        :return: bytes
+        """
+
+        end = min(offset + length, self.size)
+        pieces = []
+        block_number = bisect.bisect_right(self.offsets, offset) - 1
+
+        while offset < end and 0 <= block_number < len(self.index):
+            block_offset = self.index[block_number][0]
+            data = self.read_block(block_number)
+            pieces.append(data[offset - block_offset:end - block_offset])
+            offset = block_offset + len(data)
+            block_number += 1
+
+        return b"".join(pieces)
+
+    def __iter__(self):
+        """
+        Yields the decompressed blocks in order, without caching them
+        :return: generator of bytes
+        """
+
+        for offset, length, compressed_offset, compressed_length in self.index:
+            self.f.seek(compressed_offset)
+            yield lzma.decompress(self.f.read(compressed_length), format=lzma.FORMAT_XZ)
@@ -0,0 +1,223 @@
+"""
+Block-aligned binary deltas between two versions of a file. Rasters are edited in place, so the
+target is compared with its parent block by block: blocks found anywhere in the parent (usually
+at the same offset) become copies, everything else is stored as literal data. The op stream is
+compressed with a codec and written behind the usual compressor header.
+
+Ops (little-endian):
+
+    COPY     b"C", parent offset (Q), length (Q)
+    LITERAL  b"L", length (Q), data
+"""
+
+import os
+import struct
+import hashlib
+from compressor.codecs import iter_encode, iter_decode, read_header, write_header, open_source, \
+    ChunkReader
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+DEFAULT_MAX_RATIO = 0.5  # Literal share of the target above which a full snapshot is stored
+MAX_LITERAL_LENGTH = 4 * 1024 * 1024  # Longer literal runs are split into several ops
+
+COPY = b"C"
+LITERAL = b"L"
+_COPY = struct.Struct("<cQQ")
+_LITERAL = struct.Struct("<cQ")
+
+
+class DeltaTooLarge(Exception):
+    """
+    Raised when a delta would hold more literal data than max_ratio allows
+    """
+
+    pass
+
+
+def _block_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def index_blocks(path, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Hashes the aligned blocks of a file
+    :param path: path to file
+    :param block_size: bytes per block
+    :return: (list of digests in file order, dict of {digest: first offset})
+    """
+
+    digests = []
+    offsets = {}
+
+    with open(path, 'rb') as f:
+        offset = 0
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+
+            digest = _block_digest(data)
+            digests.append(digest)
+            offsets.setdefault(digest, offset)
+            offset += len(data)
+
+    return digests, offsets
+
+
+def iter_delta_ops(parent, target, block_size=DEFAULT_BLOCK_SIZE, max_ratio=None):
+    """
+    Compares target with parent block by block
+    :param parent: path of the parent version
+    :param target: path of the new version
+    :param block_size: bytes per block
+    :param max_ratio: raise DeltaTooLarge as soon as the literal data passes this share of the
+    target. None never gives up.
+    :return: generator of encoded ops (bytes)
+    """
+
+    parent_digests, parent_offsets = index_blocks(parent, block_size)
+    target_size = os.path.getsize(target)
+    literal_limit = None if max_ratio is None else max_ratio * target_size
+    literal_bytes = 0
+
+    copy_offset = copy_length = 0  # Running copy
+    literal = []  # Running literal blocks
+    literal_length = 0
+
+    with open(target, 'rb') as f:
+        block_number = 0
+
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+
+            digest = _block_digest(data)
+
+            # Same place in the parent first; blocks that moved are found through the index
+            if block_number < len(parent_digests) and parent_digests[block_number] == digest:
+                source_offset = block_number * block_size
+            else:
+                source_offset = parent_offsets.get(digest)
+
+            if source_offset is None:
+                if copy_length:
+                    yield _COPY.pack(COPY, copy_offset, copy_length)
+                    copy_length = 0
+
+                literal.append(data)
+                literal_length += len(data)
+                literal_bytes += len(data)
+
+                if literal_limit is not None and literal_bytes > literal_limit:
+                    raise DeltaTooLarge("{0} differs from {1} in more than {2:.0%} of its "
+                                        "blocks".format(target, parent, max_ratio))
+
+                if literal_length >= MAX_LITERAL_LENGTH:  # Keeps memory bounded
+                    yield _LITERAL.pack(LITERAL, literal_length) + b"".join(literal)
+                    literal, literal_length = [], 0
+
+            elif copy_length and copy_offset + copy_length == source_offset:
+                copy_length += len(data)  # Extends the running copy
+
+            else:
+                if copy_length:
+                    yield _COPY.pack(COPY, copy_offset, copy_length)
+                if literal:
+                    yield _LITERAL.pack(LITERAL, literal_length) + b"".join(literal)
+                    literal, literal_length = [], 0
+
+                copy_offset, copy_length = source_offset, len(data)
+
+            block_number += 1
+
+    if copy_length:
+        yield _COPY.pack(COPY, copy_offset, copy_length)
+    if literal:
+        yield _LITERAL.pack(LITERAL, literal_length) + b"".join(literal)
+
+
+def encode_delta(parent, target, destination, block_size=DEFAULT_BLOCK_SIZE,
+                 max_ratio=DEFAULT_MAX_RATIO, codec="lzma", preset=None, metadata=None):
+    """
+    Writes target as a delta against parent
+    :param parent: path of the parent version (uncompressed)
+    :param target: path of the new version
+    :param destination: path of the delta to write. Removed again if DeltaTooLarge is raised.
+    :param block_size: bytes per block
+    :param max_ratio: see iter_delta_ops
+    :param codec: codec the op stream is compressed with
+    :param preset: compression level
+    :param metadata: extra entries for the header
+    :return: metadata dict recorded in the header
+    """
+
+    metadata = dict(metadata or {})
+    metadata.update({"codec": codec, "preset": preset, "size": os.path.getsize(target)})
+    metadata.setdefault("delta", {}).update({"parent_size": os.path.getsize(parent),
+                                             "block_size": block_size})
+
+    try:
+        with open(destination, 'wb') as f:
+            write_header(f, metadata)
+            for data in iter_encode(iter_delta_ops(parent, target, block_size, max_ratio), codec,
+                                    preset):
+                f.write(data)
+    except DeltaTooLarge:
+        os.remove(destination)
+        raise
+
+    return metadata
+
+
+def apply_delta(parent, delta, destination):
+    """
+    Rebuilds a version from its parent and a delta written by encode_delta
+    :param parent: path of the parent version (uncompressed)
+    :param delta: path of the delta, or a binary file object positioned at its start
+    :param destination: path of the file to write
+    :return: None
+    """
+
+    with open_source(delta) as f_delta:
+        metadata = read_header(f_delta)
+        if metadata is None or "delta" not in metadata:
+            raise ValueError("{} is not a delta".format(delta))
+
+        if os.path.getsize(parent) != metadata["delta"]["parent_size"]:
+            raise ValueError("{0} is not the parent of {1}".format(parent, delta))
+
+        ops = ChunkReader(iter_decode(iter(lambda: f_delta.read(1024 * 1024), b""),
+                                    metadata["codec"]))
+
+        with open(parent, 'rb') as f_parent, open(destination, 'wb') as f_out:
+            while True:
+                op = ops.read(1)
+                if not op:
+                    break
+
+                if op == COPY:
+                    offset, length = struct.unpack("<QQ", ops.read(16))
+                    f_parent.seek(offset)
+                    while length:
+                        data = f_parent.read(min(length, 1024 * 1024))
+                        if not data:
+                            raise ValueError("Delta copies past the end of {}".format(parent))
+                        f_out.write(data)
+                        length -= len(data)
+
+                elif op == LITERAL:
+                    length = struct.unpack("<Q", ops.read(8))[0]
+                    while length:
+                        data = ops.read(min(length, 1024 * 1024))
+                        if not data:
+                            raise ValueError("{} is truncated".format(delta))
+                        f_out.write(data)
+                        length -= len(data)
+
+                else:
+                    raise ValueError("Unknown delta op {!r}".format(op))
+
+    if os.path.getsize(destination) != metadata["size"]:
+        raise ValueError("{0} rebuilt to the wrong size from {1}".format(destination, delta))
+
@@ -0,0 +1,226 @@
+"""
+Pre-filters for uncompressed rasters. Neighbouring pixels are similar, so replacing each sample
+with its difference to the one on its left ("delta", as TIFF predictor 2 does) and grouping the
+bytes of the samples by significance ("shuffle") leaves the codec long runs of small values.
+Only the pixel blocks of a file are filtered (filesystem_utils.rasters.pixel_blocks); headers and
+everything else pass through. The filters and the regions they cover are recorded in the header
+so iter_unfilter can reverse them.
+
+Needs NumPy, which is optional. Without it rasters are compressed unfiltered (a warning is logged
+once), and files that were filtered can't be decompressed.
+"""
+
+import os
+import logging
+from compressor.codecs import ChunkReader, SAMPLE_COUNT, SAMPLE_SIZE
+from filesystem_utils.rasters import pixel_blocks
+
+try:
+    import numpy  # Optional. Filters are skipped without it.
+except ImportError:
+    numpy = None
+
+FILTERS = ("delta", "shuffle")
+# numpy kind of the samples -> filters. Shuffling after delta only pays off for floats, whose
+# differences still vary in every byte.
+DEFAULT_FILTERS = {"u": ["delta"], "i": ["delta"], "f": ["delta", "shuffle"]}
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # Rows are filtered this many bytes at a time
+
+_missing_numpy_logged = False
+
+
+def pixel_regions(path):
+    """
+    Finds the pixel data of an uncompressed raster, merging neighbouring blocks with the same
+    layout
+    :param path: path to file
+    :return: list of [offset, length, numpy dtype string, samples per pixel, samples per row]
+    """
+
+    regions = []
+    for block in sorted(pixel_blocks(path)):
+        if regions and regions[-1][0] + regions[-1][1] == block[0] and \
+                regions[-1][2:] == list(block[2:]):
+            regions[-1][1] += block[1]
+        else:
+            regions.append(list(block))
+
+    return regions
+
+
+def filter_spec(path, filters=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Decides how a file is filtered
+    :param path: path to file
+    :param filters: names from FILTERS, applied in order. None picks them by sample type
+    (DEFAULT_FILTERS).
+    :param chunk_size: bytes filtered at a time
+    :return: dict for the "filter" entry of the header, or None if the file can't be filtered
+    """
+
+    global _missing_numpy_logged
+
+    if filters == []:
+        return None
+
+    unknown = set(filters or []) - set(FILTERS)
+    if unknown:
+        raise ValueError("Unknown filter(s) {0}. Available: {1}".format(
+            ", ".join(sorted(unknown)), ", ".join(FILTERS)))
+
+    regions = pixel_regions(path)
+    if not regions:
+        return None
+
+    if numpy is None:
+        if not _missing_numpy_logged:
+            logging.warning("NumPy is not installed, so uncompressed rasters are compressed "
+                            "without pre-filters and take more space. Install numpy to filter "
+                            "them.")
+            _missing_numpy_logged = True
+        return None
+
+    for region in regions:
+        region.append(list(filters or DEFAULT_FILTERS[numpy.dtype(region[2]).kind]))
+
+    return {"chunk_size": chunk_size, "regions": regions}
+
+
+def _segments(spec, size):
+    """
+    Splits a file into the pieces it is filtered in: plain data, or whole rows of one region
+    :param spec: filter_spec
+    :param size: file size
+    :return: generator of (length, region or None)
+    """
+
+    chunk_size = spec["chunk_size"]
+    position = 0
+
+    def plain(end):
+        for start in range(position, end, chunk_size):
+            yield min(chunk_size, end - start), None
+
+    for region in spec["regions"]:
+        offset, length, dtype, samples, row_samples, _ = region
+        if offset < position or offset + length > size:  # Overlapping or damaged
+            continue
+
+        for segment in plain(offset):
+            yield segment
+
+        row_size = numpy.dtype(dtype).itemsize * row_samples
+        step = max(1, chunk_size // row_size) * row_size
+        end = offset + length - length % row_size  # A partial last row passes through
+
+        for start in range(offset, end, step):
+            yield min(step, end - start), region
+
+        position = end
+
+    for segment in plain(size):
+        yield segment
+
+
+def filtered_samples(path, spec, sample_count=SAMPLE_COUNT, sample_size=SAMPLE_SIZE):
+    """
+    Filters evenly spaced pieces of the pixel data, for choosing a codec
+    (compressor.codecs.choose_codec)
+    :param path: path to file
+    :param spec: filter_spec of the file
+    :return: list of bytes
+    """
+
+    pieces = []
+    offset = 0
+    for length, region in _segments(spec, os.path.getsize(path)):
+        if region is not None:
+            pieces.append((offset, length, region))
+        offset += length
+
+    step = max(1, len(pieces) // sample_count)
+    samples = []
+
+    with open(path, 'rb') as f:
+        for offset, length, region in pieces[::step][:sample_count]:
+            row_size = numpy.dtype(region[2]).itemsize * region[4]
+            f.seek(offset)
+            data = f.read(min(length, max(1, sample_size // row_size) * row_size))
+            samples.append(_apply(data, region, False))
+
+    return samples
+
+
+def _apply(data, region, inverse):
+    """
+    Runs the filters of a region over whole rows of it
+    :return: bytes
+    """
+
+    _, _, dtype, samples, row_samples, filters = region
+    dtype = numpy.dtype(dtype)
+    # Samples are differenced as unsigned integers of the same size, so the filter is lossless
+    # for floats and wraps around instead of overflowing
+    unsigned = numpy.dtype("u{}".format(dtype.itemsize)).newbyteorder(dtype.byteorder)
+
+    for name in reversed(filters) if inverse else filters:
+        if name == "delta":
+            pixels = numpy.frombuffer(data, unsigned).reshape(-1, row_samples // samples, samples)
+            if inverse:
+                pixels = numpy.cumsum(pixels, axis=1, dtype=unsigned)
+            else:
+                pixels = numpy.concatenate((pixels[:, :1], pixels[:, 1:] - pixels[:, :-1]),
+                                           axis=1)
+            data = pixels.astype(unsigned, copy=False).tobytes()
+
+        elif name == "shuffle" and dtype.itemsize > 1:
+            planes = numpy.frombuffer(data, numpy.uint8)
+            if inverse:
+                data = planes.reshape(dtype.itemsize, -1).T.tobytes()
+            else:
+                data = planes.reshape(-1, dtype.itemsize).T.tobytes()
+
+    return data
+
+
+def _iter_apply(pieces, spec, size, inverse):
+    """
+    Re-cuts a stream into the segments of a file and filters, or unfilters, each of them
+    :return: generator of bytes
+    """
+
+    if numpy is None:
+        raise ImportError("Raster filters need NumPy")
+
+    reader = ChunkReader(iter(pieces))
+
+    for length, region in _segments(spec, size):
+        data = reader.read(length)
+        if len(data) < length:
+            raise EOFError("Data ended {} bytes early".format(length - len(data)))
+
+        yield data if region is None else _apply(data, region, inverse)
+
+
+def iter_filter(pieces, spec, size):
+    """
+    Filters a file
+    :param pieces: generator of the file's bytes
+    :param spec: filter_spec of the file
+    :param size: file size
+    :return: generator of filtered bytes
+    """
+
+    return _iter_apply(pieces, spec, size, False)
+
+
+def iter_unfilter(pieces, spec, size):
+    """
+    Reverses iter_filter
+    :param pieces: generator of filtered bytes
+    :param spec: "filter" entry of the header
+    :param size: size of the original file
+    :return: generator of the original bytes
+    """
+
+    return _iter_apply(pieces, spec, size, True)
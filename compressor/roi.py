@@ -0,0 +1,299 @@
+"""
+Region of interest checkout. A window of a TIFF is cut out of a compressed version without
+decompressing the rest: the image directory is read through random access to the uncompressed
+bytes, and only the strips or tiles covering the window are copied into a new TIFF. Random
+access needs a seekable layout, i.e. a block container (Compressor.compress_blocks) or a stored
+(uncompressed) object.
+"""
+
+import os
+import struct
+from compressor.container import BlockReader, is_block_container
+from compressor.codecs import read_header
+from filesystem_utils.rasters import TiffFile, TIFF_TYPES, IMAGE_WIDTH, IMAGE_LENGTH, \
+    ROWS_PER_STRIP, TILE_WIDTH, TILE_LENGTH, TILE_OFFSETS, TILE_BYTE_COUNTS, STRIP_OFFSETS, \
+    STRIP_BYTE_COUNTS, MODEL_PIXEL_SCALE, MODEL_TIEPOINT, MODEL_TRANSFORMATION
+
+# Tags that point at data which isn't copied
+_DROPPED_TAGS = {273, 279, 288, 289, 324, 325, 330, 513, 514, 34665, 34853, 40965}
+
+
+class FileReader:
+    """
+    read_at() over an uncompressed file, or over the data of a stored object after its header
+    """
+
+    def __init__(self, path, start=0):
+        """
+        :param path: path to file
+        :param start: offset the data starts at
+        """
+
+        self.f = open(path, 'rb')
+        self.start = start
+        self.size = os.fstat(self.f.fileno()).st_size - start  # Same as BlockReader.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def read_at(self, offset, length):
+        """
+        Reads a byte range of the data
+        :return: bytes. Reads past the end return fewer bytes.
+        """
+
+        self.f.seek(self.start + offset)
+        return self.f.read(length)
+
+
+class _ReaderFile:
+    """
+    The seek()/read() interface TiffFile uses, on top of read_at()
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.position = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.position = offset
+        elif whence == os.SEEK_END:
+            self.position = self.reader.size + offset
+        else:
+            self.position += offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, length):
+        data = self.reader.read_at(self.position, length)
+        self.position += len(data)
+        return data
+
+
+def open_random_access(path):
+    """
+    Opens a compressed file for reading byte ranges of its uncompressed contents
+    :param path: path of a block container or a file written by compress_file
+    :return: reader with read_at(offset, length) and close(); usable as a context manager
+    """
+
+    if is_block_container(path):
+        return BlockReader(path)
+
+    with open(path, 'rb') as f:
+        metadata = read_header(f)
+        start = f.tell()
+
+    if metadata is not None and metadata.get("codec") == "store" and "delta" not in metadata:
+        return FileReader(path, start)
+
+    raise ValueError("{} can't be read at random. Compress it with Compressor.compress_blocks "
+                     "for region of interest checkouts.".format(path))
+
+
+def extract_window(reader, destination, window=None, tiles=None):
+    """
+    Writes part of the full resolution image of a TIFF as a new TIFF. The strips or tiles are
+    copied as stored, still compressed with the TIFF's own compression, so the output is
+    aligned to the source's block grid: it can reach up to a tile further than the window on
+    each side, and stripped TIFFs keep their full width. GeoTIFF tie points and transformations
+    are moved to the new origin; overviews aren't copied.
+    :param reader: object with read_at(offset, length) giving the uncompressed TIFF, e.g. from
+    open_random_access
+    :param destination: path of the TIFF to write
+    :param window: (x offset, y offset, width, height) in pixels
+    :param tiles: indices into the tile (or strip) table, instead of a window. The output covers
+    their bounding box.
+    :return: (x offset, y offset, width, height) of the written image within the source
+    """
+
+    tiff = TiffFile(_ReaderFile(reader))
+    width = tiff.tag(0, IMAGE_WIDTH)[0]
+    height = tiff.tag(0, IMAGE_LENGTH)[0]
+    block_type, offsets, byte_counts = tiff.data_blocks(0)
+
+    if block_type == "tile":
+        block_width, block_height = tiff.tag(0, TILE_WIDTH)[0], tiff.tag(0, TILE_LENGTH)[0]
+    else:
+        block_width = width
+        block_height = min(tiff.tag(0, ROWS_PER_STRIP, [height])[0], height)
+
+    across = -(-width // block_width)
+    per_plane = across * -(-height // block_height)
+
+    if not per_plane or not offsets or len(offsets) % per_plane or \
+            len(byte_counts) != len(offsets):
+        raise ValueError("The {} table of the TIFF doesn't match its size".format(block_type))
+
+    if tiles is not None:
+        if not tiles or not all(0 <= tile < len(offsets) for tile in tiles):
+            raise ValueError("Tiles must be between 0 and {}".format(len(offsets) - 1))
+
+        rows = [tile % per_plane // across for tile in tiles]
+        columns = [tile % per_plane % across for tile in tiles]
+        window = (min(columns) * block_width, min(rows) * block_height,
+                  (max(columns) + 1 - min(columns)) * block_width,
+                  (max(rows) + 1 - min(rows)) * block_height)
+
+    if window is None:
+        raise ValueError("Give a window or a list of tiles")
+
+    x, y, window_width, window_height = window
+    x_end, y_end = min(x + window_width, width), min(y + window_height, height)
+    x, y = max(x, 0), max(y, 0)
+
+    if x >= x_end or y >= y_end:
+        raise ValueError("Window {0} is outside the {1}x{2} image".format(window, width, height))
+
+    first_column, last_column = x // block_width, (x_end - 1) // block_width
+    first_row, last_row = y // block_height, (y_end - 1) // block_height
+    x_offset, y_offset = first_column * block_width, first_row * block_height
+    output_width = min((last_column + 1) * block_width, width) - x_offset
+    output_height = min((last_row + 1) * block_height, height) - y_offset
+
+    selected = [plane * per_plane + row * across + column
+                for plane in range(len(offsets) // per_plane)
+                for row in range(first_row, last_row + 1)
+                for column in range(first_column, last_column + 1)]
+
+    order = tiff.byte_order
+    entries = {}
+    for tag in tiff.ifds[0]:
+        if tag not in _DROPPED_TAGS and tiff.ifds[0][tag][0] in TIFF_TYPES:
+            entries[tag] = tiff.raw_tag(0, tag)
+
+    entries[IMAGE_WIDTH] = (4, 1, struct.pack(order + "I", output_width))
+    entries[IMAGE_LENGTH] = (4, 1, struct.pack(order + "I", output_height))
+    _shift_georeferencing(entries, order, x_offset, y_offset)
+
+    with open(destination, 'wb') as f:
+        f.write(b"II" if order == "<" else b"MM")
+        if tiff.big_tiff:
+            f.write(struct.pack(order + "HHHQ", 43, 8, 0, 0))
+        else:
+            f.write(struct.pack(order + "HI", 42, 0))
+
+        new_offsets, new_byte_counts = [], []
+        for index in selected:
+            length = byte_counts[index]
+            if not length:  # Sparse block
+                new_offsets.append(0)
+                new_byte_counts.append(0)
+                continue
+
+            data = reader.read_at(offsets[index], length)
+            if len(data) < length:
+                raise ValueError("TIFF is truncated")
+
+            new_offsets.append(f.tell())
+            new_byte_counts.append(length)
+            f.write(data)
+            if f.tell() % 2:  # TIFF offsets are word aligned
+                f.write(b"\0")
+
+        offset_type, offset_format = (16, "Q") if tiff.big_tiff else (4, "I")
+        offsets_tag, byte_counts_tag = (TILE_OFFSETS, TILE_BYTE_COUNTS) \
+            if block_type == "tile" else (STRIP_OFFSETS, STRIP_BYTE_COUNTS)
+        entries[offsets_tag] = (offset_type, len(selected), struct.pack(
+            order + offset_format * len(selected), *new_offsets))
+        entries[byte_counts_tag] = (offset_type, len(selected), struct.pack(
+            order + offset_format * len(selected), *new_byte_counts))
+
+        ifd_offset = _write_ifd(f, entries, order, tiff.big_tiff)
+        f.seek(8 if tiff.big_tiff else 4)
+        f.write(struct.pack(order + offset_format, ifd_offset))
+
+    return x_offset, y_offset, output_width, output_height
+
+
+def _shift_georeferencing(entries, byte_order, x_offset, y_offset):
+    """
+    Moves the GeoTIFF georeferencing of an image to a new raster origin
+    :param entries: {tag: (field type, count, raw values)}, changed in place
+    :return: None
+    """
+
+    if not x_offset and not y_offset:
+        return
+
+    transformation = entries.get(MODEL_TRANSFORMATION)
+    if transformation is not None and transformation[:2] == (12, 16):
+        matrix = list(struct.unpack(byte_order + "d" * 16, transformation[2]))
+        for row in range(3):
+            matrix[row * 4 + 3] += matrix[row * 4] * x_offset + matrix[row * 4 + 1] * y_offset
+        entries[MODEL_TRANSFORMATION] = (12, 16, struct.pack(byte_order + "d" * 16, *matrix))
+
+    tie_points = entries.get(MODEL_TIEPOINT)
+    if tie_points is not None and tie_points[0] == 12:
+        count = tie_points[1]
+        points = list(struct.unpack(byte_order + "d" * count, tie_points[2]))
+        scale = entries.get(MODEL_PIXEL_SCALE)
+
+        if count == 6 and scale is not None and scale[0] == 12 and scale[1] >= 2:
+            scale_x, scale_y = struct.unpack(byte_order + "dd", scale[2][:16])
+            points[3] += x_offset * scale_x
+            points[4] -= y_offset * scale_y
+        else:  # Ground control points: move their raster positions instead
+            for position in range(0, count - count % 6, 6):
+                points[position] -= x_offset
+                points[position + 1] -= y_offset
+
+        entries[MODEL_TIEPOINT] = (12, count, struct.pack(byte_order + "d" * count, *points))
+
+
+def _write_ifd(f, entries, byte_order, big_tiff):
+    """
+    Writes an image directory at the end of a file. Values that don't fit in their entry are
+    written in front of it.
+    :param entries: {tag: (field type, count, raw values)}
+    :return: offset of the directory
+    """
+
+    if big_tiff:
+        count_format, entry_format, pointer_format, inline_size = "Q", "HHQ", "Q", 8
+    else:
+        count_format, entry_format, pointer_format, inline_size = "H", "HHI", "I", 4
+
+    fields = []
+    for tag in sorted(entries):
+        field_type, count, value = entries[tag]
+
+        if len(value) > inline_size:
+            offset = f.tell()
+            f.write(value)
+            if f.tell() % 2:
+                f.write(b"\0")
+            value = struct.pack(byte_order + pointer_format, offset)
+
+        fields.append(struct.pack(byte_order + entry_format, tag, field_type, count) +
+                      value.ljust(inline_size, b"\0"))
+
+    ifd_offset = f.tell()
+    f.write(struct.pack(byte_order + count_format, len(fields)))
+    f.write(b"".join(fields))
+    f.write(struct.pack(byte_order + pointer_format, 0))
+
+    return ifd_offset
+
+
+def decompress_window(source, destination, window=None, tiles=None):
+    """
+    Checks out part of a compressed TIFF
+    :param source: path of a block container or a stored object
+    :param destination: path of the TIFF to write
+    :param window: see extract_window
+    :param tiles: see extract_window
+    :return: (x offset, y offset, width, height) of the written image within the source
+    """
+
+    with open_random_access(source) as reader:
+        return extract_window(reader, destination, window, tiles)
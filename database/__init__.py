@@ -1,10 +1,25 @@
 from database.base import Base
-from database.models import Users, Projects, Directories, Imagery, Changelist, Versions, \
-    Checkouts, Tasklists, project_tasks, user_projects
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, exc
-from os.path import join
+from database.cache import LookupCache
+from database.migrations import ensure_schema, SchemaTooNew
+from database.pragmas import read_pragmas, network_safe_pragmas, set_connection_profile
+from database.models import Users, Projects, Directories, DirectoryDigests, Imagery, ImageryBlocks, \
+    Changelist, Versions, Checkouts, Tasklists, project_tasks, user_projects
+from sqlalchemy import create_engine, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker, scoped_session
+from os.path import join, abspath
+import datetime
+import itertools
 import logging
+import threading
+import time
+import uuid
+
+BULK_BATCH_SIZE = 10000  # Rows per executemany in bulk_add_files
+STREAM_BATCH_SIZE = 5000  # Rows fetched at a time by iter_remote_files
+# Order of the values in a block manifest entry
+BLOCK_COLUMNS = ("block_type", "block_index", "block_count", "block_offset", "block_length",
+                 "block_hash")
 
 
 class ImageryDatabase:
@@ -12,21 +27,60 @@ class ImageryDatabase:
     Functions for manipulating imagery database
     """
 
-    def __init__(self, path):
+    def __init__(self, path, pragmas=None):
+        """
+        :param path: directory containing ivcs.db and ivcs.ini
+        :param pragmas: SQLite connection profile (see database.pragmas). None reads it from the
+        [database] section of ivcs.ini. WAL and mmap are turned off on network shares either way.
+        """
+
         self.base = Base
         self.db_path = join(path, "ivcs.db")
+        self.pragmas = network_safe_pragmas(read_pragmas(path) if pragmas is None else pragmas,
+                                            self.db_path)
         self.engine = create_engine("sqlite:///{}".format(self.db_path))
-        base.Base.metadata.create_all(self.engine, checkfirst=True)
-        self._session = sessionmaker(bind=self.engine)
-        self.session = self._session()
+        set_connection_profile(self.engine, self.pragmas)
+        ensure_schema(self.engine)
+        self.cache = LookupCache()  # Shared by every DatabaseQueries on this database
+        self._session = scoped_session(sessionmaker(bind=self.engine))
 
     def load_session(self):
         """
-        Load DB session
+        Load DB session. Every call from the same thread returns the same session.
         :return: Session object
         """
 
-        return self.session
+        return self._session()
+
+    def remove_session(self):
+        """
+        Closes the calling thread's session. Threads other than the GUI thread call this when
+        they are done with the database.
+        :return: None
+        """
+
+        self._session.remove()
+
+
+_databases = {}  # ivcs.db path -> ImageryDatabase, shared by the whole process
+_databases_lock = threading.Lock()
+
+
+def get_database(path):
+    """
+    Gets the process-wide ImageryDatabase for a directory. The engine is created, and the schema
+    checked, the first time a directory is opened; later calls reuse them.
+    :param path: directory containing ivcs.db and ivcs.ini
+    :return: ImageryDatabase
+    """
+
+    db_path = abspath(join(path, "ivcs.db"))
+
+    with _databases_lock:
+        if db_path not in _databases:
+            _databases[db_path] = ImageryDatabase(path)
+
+        return _databases[db_path]
 
 
 class DatabaseQueries:
@@ -37,8 +91,9 @@ class DatabaseQueries:
 
     def __init__(self, path):
         self.db_filter = None
-        db_init = ImageryDatabase(path)
-        self.session = db_init.load_session()
+        self.database = get_database(path)
+        self.session = self.database.load_session()
+        self.cache = self.database.cache
 
     def query_all_users(self):
         """
@@ -62,15 +117,15 @@ class DatabaseQueries:
         :return: List of projects
         """
 
-        try:
-            result = self.session.query(Users).filter_by(username=user).one()
+        user_id = self.cache.get("user", user, lambda: self.session.query(Users.id).
+                                 filter_by(username=user).scalar())
 
-        except exc.NoResultFound:
+        if user_id is None:
             print("Could not find any results for user '{}' in query_users().".
                                     format(user))
-            result = ValueError
+            return ValueError
 
-        return result
+        return self.session.get(Users, user_id)
 
     def query_projects_for_user(self, username):
         """
@@ -109,9 +164,19 @@ class DatabaseQueries:
         :return: int
         """
 
-        project = self.session.query(Projects).filter_by(name=project_name).first()
+        def load():
+            project = self.session.query(Projects).filter_by(name=project_name).first()
+            return project.id
 
-        return project.id
+        return self.cache.get("project_id", project_name, load)
+
+    def get_cache_stats(self):
+        """
+        Gets the hit and miss counters of the lookup cache
+        :return: dict of lookup: (hits, misses)
+        """
+
+        return self.cache.stats()
 
     def get_all_projects(self):
         """
@@ -119,58 +184,29 @@ class DatabaseQueries:
         :return: list
         """
 
-        projects_info = []
-
-        projects = self.session.query(Projects).all()
-
-        for project in projects:
-            project_id = project.id
-            project_name = project.name
-
-            project_info = (project_id, project_name)
-            projects_info.append(project_info)
+        def load():
+            projects = self.session.query(Projects.id, Projects.name).order_by(Projects.id)
+            return tuple(tuple(project) for project in projects)
 
-        return projects_info
+        return list(self.cache.get("all_projects", None, load))
 
     def get_users_for_project(self, project):
         """
-        Gets the users associated with a specific project
+        Gets the users associated with a specific project, in one query
+        :param project: project name
         :return: List of usernames associated with a project ID (project.id, project.name, username)
         """
 
-        users_per_project = []
-        associations = None
+        users_per_project = self.session.query(Projects.id, Projects.name, Users.username).\
+            join(user_projects, user_projects.c.project_id == Projects.id).\
+            join(Users, Users.id == user_projects.c.user_id).\
+            filter(Projects.name == project).\
+            order_by(Users.id).all()
 
-        project = self.session.query(Projects).filter_by(name=project).first()
+        if not users_per_project:
+            logging.info("No users are assigned to project {}".format(project))
 
-        try:
-            associations = self.session.query(user_projects).filter_by(project_id=project.id)
-
-        except Exception as e:  # TODO: Make this specific to sqlalchemy.exc.InvalidRequestError
-            logging.warning("Error querying the project_users table in get_users_for_project. "
-                            "Perhaps there are no users assigned to project.")
-            print(e)
-
-        for association in associations:
-            project_id = association.project_id
-            project_name = project.name
-            user_id = association.user_id
-            user = self.session.query(Users).filter_by(id=user_id).one()
-
-            try:
-                user_name = user.username
-                result = (project_id, project_name, user_name)
-                users_per_project.append(result)
-
-            except AttributeError as e:
-                text = "Could not find row in Users db for user {0} when trying to get users " \
-                       "for project {1}. Perhaps the project is not associated with any users. " \
-                       "The function returned: {2}".format(user_id, project_name, e)
-
-                logging.info(text)
-                print(text)
-
-        return users_per_project
+        return [tuple(row) for row in users_per_project]
 
     def get_directories_for_project(self, project):
         """
@@ -218,8 +254,15 @@ class DatabaseQueries:
                 name=project_name
             )
 
-            self.session.add(new_project)
-            self.session.commit()
+            try:
+                self.session.add(new_project)
+                self.session.commit()
+            except IntegrityError:  # Added from another workstation since the check
+                self.session.rollback()
+                return 1
+            finally:
+                self.cache.invalidate("project_id", "all_projects")
+
             return 0
         else:
             return 1
@@ -233,6 +276,7 @@ class DatabaseQueries:
 
         self.session.query(Projects).filter_by(name=project).delete()
         self.session.commit()
+        self.cache.invalidate("project_id", "all_projects")
 
     def add_project_directory(self, project, path):
         """
@@ -267,6 +311,33 @@ class DatabaseQueries:
 
             return None
 
+    def get_all_directories(self):
+        """
+        Gets every directory of every project
+        :return: list of (directory_id, project_id, root)
+        """
+
+        directories = self.session.query(Directories.id, Directories.project_id,
+                                         Directories.root).all()
+
+        return [tuple(directory) for directory in directories]
+
+    def get_directory_id(self, project_id, path):
+        """
+        Gets the id of a directory that is already part of a project
+        :param project_id: Projects.id
+        :param path: root path of the directory
+        :return: int, or None if the directory isn't part of the project
+        """
+
+        directory = self.session.query(Directories).filter_by(project_id=project_id,
+                                                              root=path).first()
+
+        if directory:
+            return directory.id
+
+        return None
+
     def delete_project_directory(self, project_name, selected_dir):
         """
         Deletes a directory reference for a project
@@ -291,18 +362,11 @@ class DatabaseQueries:
         email_address = user_info['email']
 
         # Check if any of the values are already in the db
-        current_users = self.query_users(uname)
-        try:
-            current_email = result = self.session.query(Users).filter_by(email=email_address).one()
+        if self.query_users(uname) is not ValueError:
+            result = -1
 
-            if uname == current_users:
-                result = -1
-
-            elif email_address == current_email.email:
-                result = -2
-
-        except exc.NoResultFound:
-            pass  # This is good! We don't want there to be another instance of this.
+        elif self.session.query(Users.id).filter_by(email=email_address).first() is not None:
+            result = -2
 
         if result is None:
             try:
@@ -320,10 +384,17 @@ class DatabaseQueries:
 
                 self.session.add(new_user)
                 self.session.commit()
+                self.cache.invalidate("user")
 
                 result = 0
 
+            except IntegrityError:  # Added from another workstation since the check
+                self.session.rollback()
+                self.cache.invalidate("user")
+                result = -1
+
             except Exception as e:
+                self.session.rollback()
                 text = "Could not add new user to database. The add_new_user function returned " \
                        "{}".format(e)
                 logging.warning(text)
@@ -342,36 +413,37 @@ class DatabaseQueries:
 
     def query_all_tasks(self):
         """
-        Returns list of tuples containing projects and tasks
+        Returns list of tuples containing projects and tasks, in one query
         :return: [(project_name, task_name) .. ]
         """
 
-        task_list = []
-        tasks = self.session.query(Tasklists).all()
+        tasks = self.session.query(Projects.name, Tasklists.taskname).\
+            join(Projects, Projects.name == Tasklists.project).\
+            order_by(Tasklists.id).all()
+
+        return [tuple(task) for task in tasks]
 
-        for task in tasks:
-            project_name = task.project
-            task_id = task.id
-            task_name = task.taskname
+    def get_task_by_project(self, project_id):
+        """Get list of tasks by project"""
+        return self.get_tasks_by_project([project_id]).get(project_id, [])
 
-            project = self.session.query(Projects).filter_by(name=project_name).one()
-            project_name = project.name
+    def get_tasks_by_project(self, project_ids=None):
+        """
+        Gets the task names of several projects in one query
+        :param project_ids: iterable of project ids. None gets the tasks of every project.
+        :return: dict of project id: [task name, ..]
+        """
 
-            result = (project_name, task_name)
-            task_list.append(result)
+        tasks_by_project = {}
 
-        return task_list
+        query = self.session.query(Tasklists.project_id, Tasklists.taskname)
+        if project_ids is not None:
+            query = query.filter(Tasklists.project_id.in_(list(project_ids)))
 
-    def get_task_by_project(self, project_id):
-        """Get list of tasks by project"""
-        taskllist = []
-        tasks = self.session.query(Tasklists).filter_by(project_id=project_id).all()
-        for task in tasks:
-            task_name = task.taskname
-            print(task_name)
-            taskllist.append(task_name)
+        for project_id, task_name in query.order_by(Tasklists.id):
+            tasks_by_project.setdefault(project_id, []).append(task_name)
 
-        return taskllist
+        return tasks_by_project
 
     def get_task_id(self, task_name):
         """
@@ -380,8 +452,10 @@ class DatabaseQueries:
         :return: Int
         """
 
-        task = self.session.query(Tasklists).filter_by(taskname=task_name).one()
-        return task
+        task_id = self.cache.get("task", task_name, lambda: self.session.query(Tasklists.id).
+                                 filter_by(taskname=task_name).one()[0])
+
+        return self.session.get(Tasklists, task_id)
 
     def add_new_task(self, task_info):
         """
@@ -419,6 +493,7 @@ class DatabaseQueries:
 
         self.session.add(new_task)
         self.session.commit()
+        self.cache.invalidate("task")
 
     def delete_task(self, task_name):
         """
@@ -429,6 +504,7 @@ class DatabaseQueries:
         task_id = (self.get_task_id(task_name)).id
         self.session.query(Tasklists).filter_by(id=task_id).delete()
         self.session.commit()
+        self.cache.invalidate("task")
 
         # TODO: Add code to blocker/blockee
 
@@ -443,42 +519,537 @@ class DatabaseQueries:
                 'image_extension':          image_extension,
                 'image_size':               image_size,
                 'image_hash':               image_hash,
+                'image_hash_algorithm':     image_hash_algorithm,
                 'image_modification_time':  image_modification_time,
                 'image_first_seen':         image_first_seen,
                 'image_last_scanned':       image_last_scanned,
-                'image_on_disk':            image_on_disk
+                'image_on_disk':            image_on_disk,
+                'image_mtime_ns':           image_mtime_ns,
+                'image_inode':              image_inode,
+                'image_block_manifest':     image_block_manifest (optional)
+                'image_fingerprint':        image_fingerprint (optional)
 
         :return:
         """
-        # First, check that file isn't already in DB.
-        new_file = Imagery(
-            project_id=file_info['project_id'],
-            directory_id=file_info['directory_id'],
-            image_path = file_info['image_path'],
-            image_extension = file_info['image_extension'],
-            image_size = file_info['image_size'],
-            image_hash = file_info['image_hash'],
-            image_modified_time = file_info['image_modification_time'],
-            image_first_seen = file_info['image_first_seen'],
-            image_last_scanned = file_info['image_last_scanned'],
-            image_on_disk = file_info['image_on_disk']
+        self.add_files_to_database([file_info])
+
+    def add_files_to_database(self, files_info):
+        """
+        Adds a batch of files to the database in a single commit
+        :param files_info: list of dicts with the same structure as add_file_to_database
+        :return: None
+        """
+
+        self.bulk_add_files(files_info)
+
+    def bulk_add_files(self, files_info, batch_size=BULK_BATCH_SIZE):
+        """
+        Adds many files in one transaction. Rows are written with executemany, batch_size at a
+        time, instead of going through the ORM; ids are assigned up front so block manifests can
+        be written the same way.
+        :param files_info: iterable of dicts with the same structure as add_file_to_database
+        :param batch_size: rows per executemany
+        :return: list of the new Imagery ids, in the order of files_info
+        """
+
+        started = time.perf_counter()
+        files_info = iter(files_info)
+        ids = []
+
+        try:
+            next_id = self._next_id(Imagery)
+
+            while True:
+                batch = list(itertools.islice(files_info, batch_size))
+                if not batch:
+                    break
+
+                rows = []
+                blocks = []
+                for file_info in batch:
+                    row = self._imagery_values(file_info)
+                    row['id'] = next_id
+                    rows.append(row)
+
+                    for block in file_info.get('image_block_manifest') or []:
+                        blocks.append(dict(zip(BLOCK_COLUMNS, block), image_id=next_id))
+
+                    ids.append(next_id)
+                    next_id += 1
+
+                self.session.execute(Imagery.__table__.insert(), rows)
+                if blocks:
+                    self.session.execute(ImageryBlocks.__table__.insert(), blocks)
+
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+        elapsed = time.perf_counter() - started
+        logging.info("Added {0} files in {1:.2f} s ({2:.0f} rows/sec)".format(
+            len(ids), elapsed, len(ids) / elapsed if elapsed else 0))
+
+        return ids
+
+    def update_file_in_database(self, file_info):
+        """
+        Updates an existing file after a rescan found that it changed on disk
+        :param file_info: dict with the same structure as add_file_to_database. project_id and
+        image_first_seen are left as they are.
+        :return: None
+        """
+
+        self._update_imagery(file_info)
+        self.session.commit()
+
+    def update_files_in_database(self, files_info):
+        """
+        Updates a batch of existing files in a single commit
+        :param files_info: list of dicts with the same structure as add_file_to_database
+        :return: None
+        """
+
+        for file_info in files_info:
+            self._update_imagery(file_info)
+
+        self.session.commit()
+
+    def _new_imagery(self, file_info):
+        """
+        Builds an Imagery row from a file_info dict
+        :return: Imagery
+        """
+
+        return Imagery(**self._imagery_values(file_info))
+
+    def _imagery_values(self, file_info):
+        """
+        Maps a file_info dict onto the columns of Imagery
+        :return: dict of {column name: value}
+        """
+
+        return {
+            'project_id': file_info['project_id'],
+            'directory_id': file_info['directory_id'],
+            'image_path': file_info['image_path'],
+            'image_extension': file_info['image_extension'],
+            'image_size': file_info['image_size'],
+            'image_hash': file_info['image_hash'],
+            'image_hash_algorithm': file_info['image_hash_algorithm'],
+            'image_modified_time': file_info['image_modification_time'],
+            'image_first_seen': file_info['image_first_seen'],
+            'image_last_scanned': file_info['image_last_scanned'],
+            'image_on_disk': file_info['image_on_disk'],
+            'image_mtime_ns': file_info['image_mtime_ns'],
+            'image_inode': file_info['image_inode'],
+            'image_fingerprint': file_info.get('image_fingerprint')
+        }
+
+    def _update_imagery(self, file_info):
+        """
+        Copies the rescanned values in file_info onto the stored Imagery row
+        :return: None
+        """
+
+        file = self.session.query(Imagery).filter_by(directory_id=file_info['directory_id'],
+                                                     image_path=file_info['image_path']).one()
+        self._copy_file_info(file, file_info)
+
+        if file_info.get('image_block_manifest'):
+            self._save_block_manifest(file.id, file_info['image_block_manifest'])
+
+    def _copy_file_info(self, file, file_info):
+        """
+        Copies the scanned values in file_info onto an Imagery row. Scans that didn't hash the
+        file ("modification_time" mode) leave the stored hash alone.
+        :return: None
+        """
+
+        file.image_size = file_info['image_size']
+        if file_info['image_hash'] is not None:
+            file.image_hash = file_info['image_hash']
+            file.image_hash_algorithm = file_info['image_hash_algorithm']
+        file.image_modified_time = file_info['image_modification_time']
+        file.image_last_scanned = file_info['image_last_scanned']
+        file.image_on_disk = file_info['image_on_disk']
+        file.image_mtime_ns = file_info['image_mtime_ns']
+        file.image_inode = file_info['image_inode']
+        file.image_fingerprint = file_info.get('image_fingerprint')
+
+    def _next_id(self, table):
+        """
+        Gets the next id for tables whose primary key also includes the uuid column, which SQLite
+        won't autoincrement, or whose ids are assigned up front (bulk_add_files). The write lock
+        is taken first and held until the commit, so the watcher thread or another workstation
+        can't take the same id in the meantime.
+        :param table: model class
+        :return: int
+        """
+
+        self._lock_for_writing()
+        max_id = self.session.query(func.max(table.id)).scalar()
+
+        return (max_id or 0) + 1
+
+    def _lock_for_writing(self):
+        """
+        Starts the session's transaction with BEGIN IMMEDIATE, which takes SQLite's write lock
+        (waiting up to busy_timeout for other writers). pysqlite only begins a transaction before
+        a write, so if one is already open this connection holds the lock.
+        :return: None
+        """
+
+        connection = self.session.connection()
+
+        if not connection.connection.dbapi_connection.in_transaction:
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+    def record_file_change(self, change_type, file_info):
+        """
+        Records a change seen by the filesystem watcher. Brings the Imagery row up to date and
+        adds a Changelist row.
+        :param change_type: 0 -> added 1 -> modified 2 -> deleted
+        :param file_info: dict with the same structure as add_file_to_database. Deletions only
+        need project_id, directory_id and image_path.
+        :return: id of the new Changelist row, or None if nothing actually changed. Recording the
+        same change again returns None, so a failed batch can be retried.
+        """
+
+        try:
+            file = self.session.query(Imagery).filter_by(directory_id=file_info['directory_id'],
+                                                         image_path=file_info['image_path']).first()
+
+            if change_type == 2:
+                if file is None or not file.image_on_disk:
+                    return None
+                file.image_on_disk = False
+
+            elif file is None:
+                file = self._new_imagery(file_info)
+                self.session.add(file)
+                self.session.flush()  # Assigns file.id
+                change_type = 0
+
+                if file_info.get('image_block_manifest'):
+                    self._save_block_manifest(file.id, file_info['image_block_manifest'])
+
+            else:
+                stat_unchanged = (file.image_size, file.image_mtime_ns, file.image_inode) == \
+                                 (file_info['image_size'], file_info['image_mtime_ns'],
+                                  file_info['image_inode'])
+                if stat_unchanged and file.image_on_disk:
+                    return None  # Spurious event, e.g. the file was only opened for writing
+
+                change_type = 1 if file.image_on_disk else 0  # A file that reappeared was added
+                self._copy_file_info(file, file_info)
+
+                manifest = file_info.get('image_block_manifest')
+                if manifest:
+                    changed_blocks = self.get_changed_blocks(file.id, manifest)
+                    logging.info("{0} of {1} blocks changed in {2}".format(
+                        len(changed_blocks), len(manifest), file.image_path))
+                    self._save_block_manifest(file.id, manifest)
+
+            change = Changelist(
+                id=self._next_id(Changelist),
+                uuid=str(uuid.uuid4()),
+                project_id=file_info['project_id'],
+                directory_id=file_info['directory_id'],
+                image_id=file.id,
+                change_type=change_type,
+                change_time=datetime.datetime.now()
+            )
+
+            self.session.add(change)
+            self.session.commit()
+
+            return change.id
+        except Exception:
+            self.session.rollback()  # Leave the session usable for the watcher's retry
+            raise
+
+    def add_version(self, version_info):
+        """
+        Adds a version of an image
+        :param version_info: dict with structure:
+
+                'project_id':           project_id,
+                'directory_id':         directory_id,
+                'image_id':             image_id,
+                'change_id':            change_id,
+                'checkout_id':          checkout_id,
+                'path_to_version':      path_to_version,
+                'commit_message':       commit_message,
+                'parent_version_id':    parent_version_id (None for the first version),
+                'storage_type':         "full" or "delta",
+                'chain_depth':          chain_depth,
+                'uuid':                 uuid (optional)
+
+        :return: id of the new Versions row
+        """
+
+        version = Versions(
+            id=self._next_id(Versions),
+            uuid=version_info.get('uuid') or str(uuid.uuid4()),
+            project_id=version_info['project_id'],
+            directory_id=version_info['directory_id'],
+            image_id=version_info['image_id'],
+            change_id=version_info['change_id'],
+            checkout_id=version_info['checkout_id'],
+            path_to_version=version_info['path_to_version'],
+            commit_message=version_info['commit_message'],
+            parent_version_id=version_info['parent_version_id'],
+            storage_type=version_info['storage_type'],
+            chain_depth=version_info['chain_depth']
         )
 
-        self.session.add(new_file)
+        self.session.add(version)
         self.session.commit()
 
-    def get_all_remote_files(self):
-        """Get a list of all remote files"""
-        files = []
-        file_query = self.session.query(Imagery).all()
+        return version.id
+
+    def get_latest_version_id(self, image_id):
+        """
+        Gets the newest version of an image
+        :param image_id: Imagery.id
+        :return: Versions.id, or None if the image has no versions
+        """
+
+        return self.session.query(func.max(Versions.id)).\
+            filter(Versions.image_id == image_id).scalar()
+
+    def get_version_chain(self, version_id):
+        """
+        Gets the lineage of a version back to its last full snapshot. Rebuilding a version only
+        needs its path_to_version (see storage.VersionStore.restore).
+        :param version_id: Versions.id
+        :return: list of (version_id, path_to_version, storage_type), full snapshot first
+        """
+
+        chain = []
+
+        while version_id is not None:
+            version = self.session.query(Versions.id, Versions.path_to_version,
+                                         Versions.storage_type, Versions.parent_version_id).\
+                filter(Versions.id == version_id).first()
+
+            if version is None:
+                raise ValueError("Version {} is missing from the chain".format(version_id))
+
+            chain.append((version.id, version.path_to_version, version.storage_type or "full"))
+
+            if version.storage_type != "delta":
+                break
+            version_id = version.parent_version_id
+
+        chain.reverse()
+
+        return chain
+
+    def get_block_manifest(self, image_id):
+        """
+        Gets the stored per-block hash manifest of an image
+        :param image_id: Imagery.id
+        :return: list of (block_type, block_index, block_count, block_offset, block_length,
+        block_hash), in file order
+        """
+
+        blocks = self.session.query(ImageryBlocks.block_type, ImageryBlocks.block_index,
+                                    ImageryBlocks.block_count, ImageryBlocks.block_offset,
+                                    ImageryBlocks.block_length, ImageryBlocks.block_hash).\
+            filter(ImageryBlocks.image_id == image_id).\
+            order_by(ImageryBlocks.block_offset)
+
+        return [tuple(block) for block in blocks]
+
+    def get_changed_blocks(self, image_id, manifest):
+        """
+        Compares a freshly built manifest against the stored one
+        :param image_id: Imagery.id
+        :param manifest: list of (block_type, block_index, block_count, block_offset, block_length,
+        block_hash), as built by filesystem_utils.hashing.hash_file_blocks
+        :return: the entries of manifest that are new or whose hash changed
+        """
+
+        stored_hashes = {}
+        for block in self.get_block_manifest(image_id):
+            stored_hashes[block[:3]] = block[5]
+
+        return [block for block in manifest if stored_hashes.get(tuple(block[:3])) != block[5]]
+
+    def _save_block_manifest(self, image_id, manifest):
+        """
+        Replaces the stored manifest of an image. Doesn't commit.
+        :return: None
+        """
+
+        self.session.query(ImageryBlocks).filter_by(image_id=image_id).delete()
+
+        self.session.add_all([ImageryBlocks(image_id=image_id,
+                                            block_type=block_type,
+                                            block_index=block_index,
+                                            block_count=block_count,
+                                            block_offset=block_offset,
+                                            block_length=block_length,
+                                            block_hash=block_hash)
+                              for block_type, block_index, block_count, block_offset,
+                              block_length, block_hash in manifest])
+
+    def get_pending_changes(self):
+        """
+        Gets the changes that haven't been committed to a version yet
+        :return: list of (image_path, change_type, change_time), oldest first
+        """
+
+        changes = self.session.query(Imagery.image_path, Changelist.change_type,
+                                     Changelist.change_time).\
+            join(Changelist, Changelist.image_id == Imagery.id).\
+            outerjoin(Versions, Versions.change_id == Changelist.id).\
+            filter(Versions.id.is_(None)).\
+            order_by(Changelist.change_time)
+
+        return [tuple(change) for change in changes]
+
+    def get_file_stats(self, directory_id=None):
+        """
+        Gets the stored stat values of every file in a directory, for incremental rescans
+        :param directory_id: Directories.id. None gets every file in the database.
+        :return: dict of {image_path: (image_size, image_mtime_ns, image_inode, image_hash,
+        image_fingerprint)}
+        """
+
+        file_stats = {}
+        files = self.session.query(Imagery.image_path, Imagery.image_size, Imagery.image_mtime_ns,
+                                   Imagery.image_inode, Imagery.image_hash,
+                                   Imagery.image_fingerprint)
+
+        if directory_id is not None:
+            files = files.filter(Imagery.directory_id == directory_id)
+
+        for image_path, image_size, image_mtime_ns, image_inode, image_hash, image_fingerprint \
+                in files:
+            if image_size is not None:
+                image_size = int(image_size)  # Stored as a float
+
+            file_stats[image_path] = (image_size, image_mtime_ns, image_inode, image_hash,
+                                      image_fingerprint)
+
+        return file_stats
+
+    def get_directory_digests(self, directory_id):
+        """
+        Gets the Merkle digests stored by the last scan of a directory
+        :param directory_id: Directories.id
+        :return: dict of {path: (directory_mtime_ns, files_digest, tree_digest)}
+        """
+
+        digests = self.session.query(DirectoryDigests.path, DirectoryDigests.directory_mtime_ns,
+                                     DirectoryDigests.files_digest, DirectoryDigests.tree_digest).\
+            filter(DirectoryDigests.directory_id == directory_id)
+
+        return {path: (directory_mtime_ns, files_digest, tree_digest)
+                for path, directory_mtime_ns, files_digest, tree_digest in digests}
+
+    def save_directory_digests(self, directory_id, digests):
+        """
+        Replaces the stored Merkle digests of a directory. Only rows that changed are written.
+        :param directory_id: Directories.id
+        :param digests: dict of {path: (directory_mtime_ns, files_digest, tree_digest)}
+        :return: None
+        """
+
+        stored = {row.path: row for row in self.session.query(DirectoryDigests).
+                  filter(DirectoryDigests.directory_id == directory_id)}
+
+        for path, (directory_mtime_ns, files_digest, tree_digest) in digests.items():
+            row = stored.pop(path, None)
+
+            if row is None:
+                self.session.add(DirectoryDigests(directory_id=directory_id, path=path,
+                                                  directory_mtime_ns=directory_mtime_ns,
+                                                  files_digest=files_digest,
+                                                  tree_digest=tree_digest))
+            elif (row.directory_mtime_ns, row.files_digest, row.tree_digest) != \
+                    (directory_mtime_ns, files_digest, tree_digest):
+                row.directory_mtime_ns = directory_mtime_ns
+                row.files_digest = files_digest
+                row.tree_digest = tree_digest
+
+        for row in stored.values():  # Directories that no longer exist
+            self.session.delete(row)
+
+        self.session.commit()
+
+    def mark_directories_removed(self, directory_id, paths):
+        """
+        Marks the images under directories that were removed since the last scan as no longer on
+        disk. Their digests are dropped by the next save_directory_digests.
+        :param directory_id: Directories.id
+        :param paths: removed directory paths, see filesystem_utils.merkle.removed_directories
+        :return: number of images marked
+        """
+
+        marked = 0
+
+        for path in paths:
+            marked += self.session.query(Imagery).filter(
+                Imagery.directory_id == directory_id, Imagery.image_on_disk.is_not(False),
+                Imagery.image_path.startswith(join(path, ""), autoescape=True)).\
+                update({Imagery.image_on_disk: False}, synchronize_session=False)
+
+        self.session.commit()
+
+        return marked
+
+    def get_all_remote_files(self, project_id=None, directory_id=None, on_disk=None):
+        """
+        Get a list of all remote files
+        :return: list of (image_path, project_id). See iter_remote_files for the filters.
+        """
+
+        return list(self.iter_remote_files(project_id, directory_id, on_disk))
+
+    def iter_remote_files(self, project_id=None, directory_id=None, on_disk=None,
+                          batch_size=STREAM_BATCH_SIZE):
+        """
+        Yields remote files without loading Imagery objects. Only the two columns are selected,
+        and rows are fetched from the cursor batch_size at a time, so memory doesn't grow with
+        the number of files. Don't write through this session until the generator is exhausted.
+        :param project_id: only files in this project
+        :param directory_id: only files in this project directory
+        :param on_disk: True/False for only files that are/aren't on disk. None for all.
+        :param batch_size: rows per fetch
+        :return: generator of (image_path, project_id), in the order the files were added
+        """
+
+        files = self.session.query(Imagery.image_path, Imagery.project_id)
+
+        if project_id is not None:
+            files = files.filter(Imagery.project_id == project_id)
+        if directory_id is not None:
+            files = files.filter(Imagery.directory_id == directory_id)
+        if on_disk is not None:
+            files = files.filter(Imagery.image_on_disk == on_disk)
+
+        for image_path, image_project_id in files.order_by(Imagery.id).yield_per(batch_size):
+            yield image_path, image_project_id
+
+    def get_stored_hashes(self):
+        """
+        Gets the stored hash of every file, with the algorithm it was made with
+        :return: dict of {image_path: (image_hash, image_hash_algorithm)}
+        """
 
-        for file in file_query:
-            file_path = file.image_path
-            file_project = file.project_id
+        stored_hashes = {}
+        files = self.session.query(Imagery.image_path, Imagery.image_hash,
+                                   Imagery.image_hash_algorithm)
 
-            files.append((file_path, file_project))
+        for image_path, image_hash, image_hash_algorithm in files:
+            # Rows from before the algorithm was recorded were hashed with sha1
+            stored_hashes[image_path] = (image_hash, image_hash_algorithm or "sha1")
 
-        return files
+        return stored_hashes
 
     def check_file_hash(self, file, current_hash):
         """Checks the file hash in the db against current hash"""
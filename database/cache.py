@@ -0,0 +1,95 @@
+"""
+Read-through cache for the small lookups the GUI repeats during a single action (project ids,
+users, tasks). One cache is shared by every DatabaseQueries on the same database, and the methods
+that add or delete rows invalidate the lookups they affect. Rows added or deleted from another
+workstation show up once the entry expires, after at most DEFAULT_CACHE_TTL seconds.
+"""
+
+import threading
+import time
+from collections import OrderedDict, Counter
+
+DEFAULT_CACHE_SIZE = 1024  # Entries across all lookups
+DEFAULT_CACHE_TTL = 5.0  # Seconds an entry is used for. Long enough to cover one GUI action.
+
+_MISSING = object()
+
+
+class LookupCache:
+    """
+    LRU cache keyed by (lookup, argument), with entries that expire after ttl seconds. Only plain
+    values are stored: lookups that return ORM objects cache the primary key, since an object
+    belongs to the session of one thread. None (nothing found) is never stored, so a row that
+    appears later is found on the next lookup.
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = Counter()    # lookup -> hits
+        self.misses = Counter()  # lookup -> misses
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, lookup, argument, load):
+        """
+        Gets a cached value, calling load on a miss or when the entry has expired. Nothing is
+        cached if load raises or returns None.
+        :param lookup: name of the lookup, e.g. "project_id"
+        :param argument: hashable argument of the lookup
+        :param load: callable returning the value
+        :return: value
+        """
+
+        key = (lookup, argument)
+
+        with self._lock:
+            value, expires = self._entries.get(key, (_MISSING, 0))
+            if value is not _MISSING and expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits[lookup] += 1
+                return value
+
+            self.misses[lookup] += 1
+
+        value = load()  # Outside the lock, so a slow query doesn't block other threads
+        if value is None:
+            return value
+
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return value
+
+    def invalidate(self, *lookups):
+        """
+        Drops every cached value of some lookups
+        :param lookups: lookup names
+        :return: None
+        """
+
+        with self._lock:
+            for key in [key for key in self._entries if key[0] in lookups]:
+                del self._entries[key]
+
+    def clear(self):
+        """
+        Drops every cached value. The counters are kept.
+        :return: None
+        """
+
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Gets the hit and miss counters
+        :return: dict of lookup: (hits, misses)
+        """
+
+        with self._lock:
+            return {lookup: (self.hits[lookup], self.misses[lookup])
+                    for lookup in set(self.hits) | set(self.misses)}
@@ -0,0 +1,165 @@
+"""
+Versioned schema migrations. The schema version of a database is kept in SQLite's user_version
+pragma, and every migration brings an existing ivcs.db one version further in place. create_all
+adds tables that are missing; migrations add what it can't, i.e. new columns and indexes on tables
+that already exist. SQLite commits DDL statements one at a time, so each migration is written to
+be safe to run again after an interruption.
+
+A database whose user_version is SCHEMA_VERSION is opened without looking at its tables, so a
+change to the models (new tables included) needs a new entry in MIGRATIONS. One whose
+user_version is higher was written by a newer IVCS and is not opened at all.
+"""
+
+import logging
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from database.base import Base
+import database.models  # Registers the tables with Base.metadata
+
+# Columns added to tables that already existed in the first released schema
+ADDED_COLUMNS = {
+    "Imagery": ("image_hash_algorithm", "image_fingerprint", "image_mtime_ns", "image_inode"),
+    "Versions": ("parent_version_id", "storage_type", "chain_depth"),
+}
+
+
+class SchemaTooNew(Exception):
+    """
+    Raised for a database written by a newer version of IVCS, whose schema this version doesn't
+    know. Opening it anyway could drop data in columns or tables this version doesn't map.
+    """
+
+    def __init__(self, version):
+        super(SchemaTooNew, self).__init__(
+            "The database has schema version {0}, but this version of IVCS only knows up to "
+            "{1}. Upgrade IVCS to open it.".format(version, SCHEMA_VERSION))
+        self.version = version
+
+
+def get_schema_version(connection):
+    """
+    Reads the schema version of a database
+    :param connection: SQLAlchemy connection
+    :return: int. 0 for databases that were never migrated.
+    """
+
+    return connection.execute(text("PRAGMA user_version")).scalar()
+
+
+def set_schema_version(connection, version):
+    """
+    Records the schema version of a database
+    :param connection: SQLAlchemy connection
+    :param version: int
+    :return: None
+    """
+
+    connection.execute(text("PRAGMA user_version = {:d}".format(version)))
+
+
+def add_columns(connection):
+    """
+    Adds the columns in ADDED_COLUMNS that a table doesn't have yet, typed as in the models
+    :param connection: SQLAlchemy connection
+    :return: None
+    """
+
+    quote = connection.dialect.identifier_preparer.quote
+
+    for table_name, column_names in ADDED_COLUMNS.items():
+        existing = {row[1] for row in
+                    connection.execute(text("PRAGMA table_info({})".format(quote(table_name))))}
+
+        for column_name in column_names:
+            if column_name in existing:
+                continue
+
+            column_type = Base.metadata.tables[table_name].c[column_name].type.compile(
+                dialect=connection.dialect)
+            connection.execute(text("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+                quote(table_name), quote(column_name), column_type)))
+            logging.info("Added column {0}.{1}".format(table_name, column_name))
+
+
+def add_indexes(connection):
+    """
+    Creates the indexes declared in the models that a database doesn't have yet. A unique index
+    that existing rows violate is created without its unique constraint, so the lookup is still
+    fast; the duplicates are logged to be cleaned up by hand.
+    :param connection: SQLAlchemy connection
+    :return: None
+    """
+
+    quote = connection.dialect.identifier_preparer.quote
+    statement = "CREATE {0}INDEX IF NOT EXISTS {1} ON {2} ({3})"
+
+    for table in Base.metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            columns = ", ".join(quote(column.name) for column in index.columns)
+
+            try:
+                connection.execute(text(statement.format("UNIQUE " if index.unique else "",
+                                                         quote(index.name), quote(table.name),
+                                                         columns)))
+            except IntegrityError:
+                logging.warning("{0} has duplicate values in {1}; {2} is created without its "
+                                "unique constraint".format(table.name, columns, index.name))
+                connection.execute(text(statement.format("", quote(index.name),
+                                                         quote(table.name), columns)))
+
+
+# (schema version, description, function taking a connection), in order
+MIGRATIONS = [
+    (1, "columns for incremental rescans, fingerprints and delta versions", add_columns),
+    (2, "indexes and unique constraints on the lookup columns", add_indexes),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(engine):
+    """
+    Brings a database up to SCHEMA_VERSION. Run after create_all, so every table exists.
+    :param engine: SQLAlchemy engine
+    :return: schema version the database had before. Raises SchemaTooNew if it was newer.
+    """
+
+    with engine.begin() as connection:
+        version = get_schema_version(connection)
+
+        if version > SCHEMA_VERSION:
+            raise SchemaTooNew(version)
+
+        for migration_version, description, migration in MIGRATIONS:
+            if migration_version <= version:
+                continue
+
+            logging.info("Migrating database to schema version {0}: {1}".format(
+                migration_version, description))
+            migration(connection)
+            set_schema_version(connection, migration_version)
+
+    return version
+
+
+def ensure_schema(engine):
+    """
+    Checks the schema version of a database and only creates missing tables and migrates when it
+    differs from SCHEMA_VERSION. Opening an up-to-date database costs a single pragma read.
+    :param engine: SQLAlchemy engine
+    :return: True if the schema was created or migrated. Raises SchemaTooNew, before anything is
+    written, for a database from a newer version of IVCS.
+    """
+
+    with engine.connect() as connection:
+        version = get_schema_version(connection)
+
+    if version == SCHEMA_VERSION:
+        return False
+    if version > SCHEMA_VERSION:
+        raise SchemaTooNew(version)
+
+    Base.metadata.create_all(engine, checkfirst=True)
+    migrate(engine)
+
+    return True
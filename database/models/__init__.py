@@ -2,7 +2,8 @@
 Contains the SQL database definitions
 """
 
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Table, ForeignKeyConstraint
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Table, ForeignKeyConstraint, \
+    Index
 from sqlalchemy.types import DateTime, Boolean, Text
 from sqlalchemy.orm import relationship, validates
 from database.base import Base
@@ -11,17 +12,17 @@ import bcrypt
 from hashlib import sha1
 #from passlib.hash import bcrypt
 
-__all__ = ['projects_associations', 'Users', 'Projects', 'Directories', 'Imagery', 'Changelist',
-           'Versions', 'Checkouts', 'Tasklists']
+__all__ = ['projects_associations', 'Users', 'Projects', 'Directories', 'DirectoryDigests',
+           'Imagery', 'ImageryBlocks', 'Changelist', 'Versions', 'Checkouts', 'Tasklists']
 
 # This stores associations between tasks and projects (many to many)
 project_tasks = Table("tasks-projects_associations", Base.metadata,
-                      Column("project_id", Integer, ForeignKey("Projects.id")),
+                      Column("project_id", Integer, ForeignKey("Projects.id"), index=True),
                       Column("task_id", Integer, ForeignKey("TaskLists.id")))
 
 user_projects = Table("user-projects_associations", Base.metadata,
-                      Column("user_id", Integer, ForeignKey("Users.id")),
-                      Column("project_id", Integer, ForeignKey("Projects.id")))
+                      Column("user_id", Integer, ForeignKey("Users.id"), index=True),
+                      Column("project_id", Integer, ForeignKey("Projects.id"), index=True))
 
 
 class Users(Base):
@@ -32,7 +33,7 @@ class Users(Base):
     __tablename__ = "Users"
     id = Column(Integer, primary_key=True, index=True)
     full_name = Column(String)
-    username = Column(String)
+    username = Column(String, unique=True, index=True)
     password = Column(String)
     email = Column(String)
     role = Column(Integer)
@@ -52,7 +53,7 @@ class Projects(Base):
 
     __tablename__ = "Projects"
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String)
+    name = Column(String, unique=True, index=True)
     working_directory = Column(String)
     tasks = relationship("Tasklists", secondary=project_tasks)
 
@@ -64,28 +65,67 @@ class Directories(Base):
     """
 
     __tablename__ = "Directories"
+    __table_args__ = (Index("ix_Directories_project_id_root", "project_id", "root"),)
     id = Column(Integer, primary_key=True, index=True)
     project_id = Column(Integer, ForeignKey("Projects.id"))
     root = Column(String)
 
 
+class DirectoryDigests(Base):
+    """
+    Merkle digests of every directory under a project directory, from its last scan. A rescan
+    still lists the directories and stats their images to build fresh digests, but the images of
+    directories whose digests are unchanged are neither looked up in the database nor hashed.
+    """
+
+    __tablename__ = "DirectoryDigests"
+    id = Column(Integer, primary_key=True)
+    directory_id = Column(Integer, ForeignKey("Directories.id"), index=True)
+    path = Column(String)
+    directory_mtime_ns = Column(Integer)
+    files_digest = Column(String)  # Stats of the images directly in this directory
+    tree_digest = Column(String)  # files_digest plus the tree digests of every subdirectory
+
+
 class Imagery(Base):
     """
     Stores the image file data
     """
 
     __tablename__ = "Imagery"
+    __table_args__ = (Index("ix_Imagery_directory_id_image_path", "directory_id", "image_path"),)
     id = Column(Integer, primary_key=True, index=True)
-    project_id = Column(Integer, ForeignKey("Projects.id"))
+    project_id = Column(Integer, ForeignKey("Projects.id"), index=True)
     directory_id = Column(Integer, ForeignKey("Directories.id"))
-    image_path = Column(String)
+    image_path = Column(String, index=True)
     image_extension = Column(String)
     image_size = Column(Float)
     image_hash = Column(String)
+    image_hash_algorithm = Column(String)  # NULL for rows hashed before this was recorded (sha1)
+    image_fingerprint = Column(String)  # Size plus head/middle/tail samples, see quick_fingerprint
     image_modified_time = Column(DateTime)
     image_first_seen = Column(DateTime)
     image_last_scanned = Column(DateTime)
     image_on_disk = Column(Boolean)
+    image_mtime_ns = Column(Integer)  # Together with size and inode, used to skip unchanged files
+    image_inode = Column(Integer)
+
+
+class ImageryBlocks(Base):
+    """
+    Per-block hash manifest of an image. Lets change detection narrow an edit down to the tiles,
+    strips or chunks that changed.
+    """
+
+    __tablename__ = "ImageryBlocks"
+    id = Column(Integer, primary_key=True)
+    image_id = Column(Integer, ForeignKey("Imagery.id"), index=True)
+    block_type = Column(String)  # e.g. tile:0, strip:0, block:Layer_1, chunk, other
+    block_index = Column(Integer)  # Index of the first tile/strip/block in this entry
+    block_count = Column(Integer)  # Neighbouring blocks merged into this entry
+    block_offset = Column(Integer)
+    block_length = Column(Integer)
+    block_hash = Column(String)
 
 
 class Changelist(Base):
@@ -98,7 +138,7 @@ class Changelist(Base):
     uuid = Column(String, primary_key=True, index=True)
     project_id = Column(Integer, ForeignKey("Projects.id"))
     directory_id = Column(Integer, ForeignKey("Directories.id"))
-    image_id = Column(Integer, ForeignKey("Imagery.id"))
+    image_id = Column(Integer, ForeignKey("Imagery.id"), index=True)
     change_type = Column(Integer)  # 0->added 1-> modified 2-> deleted
     change_time = Column(DateTime)
 
@@ -113,11 +153,14 @@ class Versions(Base):
     uuid = Column(String, primary_key=True, index=True)
     project_id = Column(Integer, ForeignKey("Projects.id"))
     directory_id = Column(Integer, ForeignKey("Directories.id"))
-    image_id = Column(Integer, ForeignKey("Imagery.id"))
+    image_id = Column(Integer, ForeignKey("Imagery.id"), index=True)
     change_id = Column(String, ForeignKey("Changelist.id"))
     checkout_id = Column(Integer, ForeignKey("Checkouts.id"))
     path_to_version = Column(String)
     commit_message = Column(String)
+    parent_version_id = Column(Integer)  # Versions.id this one is a delta against, if any
+    storage_type = Column(String)  # "full" or "delta"
+    chain_depth = Column(Integer)  # Deltas between this version and its full snapshot
 
 
 class Checkouts(Base):
@@ -142,13 +185,13 @@ class Tasklists(Base):
 
     __tablename__ = "TaskLists"
     id = Column(Integer, primary_key=True)
-    taskname = Column(String)
+    taskname = Column(String, index=True)  # Not unique: the same task can recur across projects
     task_description = Column(String)
     task_input_directory = Column(String)
     task_output_directory = Column(String)
     projects = relationship("Projects", secondary=project_tasks)
     project = Column(String, ForeignKey("Projects.id"))
-    project_id = Column(Integer)
+    project_id = Column(Integer, index=True)
     task_complete = Column(Boolean)
     estimated_completion = Column(DateTime)
 
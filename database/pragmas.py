@@ -0,0 +1,140 @@
+"""
+SQLite connection profile. The pragmas are applied to every connection ImageryDatabase opens and
+are read from the [database] section of ivcs.ini, e.g.
+
+    [database]
+    journal_mode = wal
+    synchronous = normal
+    cache_size = -65536
+
+WAL lets the watcher write while the windows read, and with synchronous = normal a commit no longer
+waits for the disk twice. WAL and memory mapping are only safe on a local filesystem: SQLite accepts
+WAL on NFS/SMB without complaint but its shared-memory index doesn't work across hosts. When ivcs.db
+is on a network share, journal_mode and mmap_size are forced to NETWORK_PRAGMAS.
+"""
+
+import logging
+import configparser
+from collections import OrderedDict
+from os.path import join
+from sqlalchemy import event
+from filesystem_utils.mounts import is_network_mount
+
+CONFIG_SECTION = "database"
+
+# Applied in this order. busy_timeout comes first so switching the journal mode waits for other
+# connections instead of failing.
+DEFAULT_PRAGMAS = OrderedDict([
+    ("busy_timeout", 5000),         # ms to wait for a lock before "database is locked"
+    ("journal_mode", "wal"),
+    ("synchronous", "normal"),
+    ("cache_size", -64 * 1024),     # Negative: KiB, i.e. 64 MiB of page cache per connection
+    ("mmap_size", 256 * 1024 * 1024),
+    ("temp_store", "memory"),
+])
+
+# Overrides for databases on network filesystems
+NETWORK_PRAGMAS = OrderedDict([
+    ("journal_mode", "delete"),
+    ("mmap_size", 0),
+])
+
+# Pragma -> allowed values. None means any integer.
+PRAGMA_VALUES = {
+    "busy_timeout": None,
+    "journal_mode": ("delete", "truncate", "persist", "memory", "wal", "off"),
+    "synchronous": ("off", "normal", "full", "extra"),
+    "cache_size": None,
+    "mmap_size": None,
+    "temp_store": ("default", "file", "memory"),
+}
+
+
+def read_pragmas(path):
+    """
+    Reads the connection profile from the ivcs.ini in a directory. Pragmas that are missing or
+    invalid keep their defaults.
+    :param path: directory containing ivcs.ini
+    :return: OrderedDict of pragma: value
+    """
+
+    pragmas = OrderedDict(DEFAULT_PRAGMAS)
+
+    config = configparser.ConfigParser()
+    config.read(join(path, "ivcs.ini"))
+
+    if not config.has_section(CONFIG_SECTION):
+        return pragmas
+
+    for name, value in config.items(CONFIG_SECTION):
+        if name not in PRAGMA_VALUES:
+            logging.error("Unknown option '{0}' in the [{1}] section of the configuration file. "
+                          "Available: {2}".format(name, CONFIG_SECTION,
+                                                  ", ".join(DEFAULT_PRAGMAS)))
+            continue
+
+        value = value.strip().lower()
+        allowed = PRAGMA_VALUES[name]
+
+        try:
+            pragmas[name] = int(value) if allowed is None else allowed[allowed.index(value)]
+        except ValueError:
+            logging.error("Invalid value '{0}' for {1} in the configuration file. Using {2} "
+                          "instead.".format(value, name, DEFAULT_PRAGMAS[name]))
+
+    return pragmas
+
+
+def network_safe_pragmas(pragmas, db_path):
+    """
+    Replaces the pragmas that are unsafe on a network filesystem if the database lives on one
+    :param pragmas: dict of pragma: value
+    :param db_path: path to ivcs.db
+    :return: OrderedDict of pragma: value
+    """
+
+    pragmas = OrderedDict(pragmas)
+
+    if is_network_mount(db_path):
+        for name, value in NETWORK_PRAGMAS.items():
+            if pragmas.get(name, value) != value:
+                logging.info("{0} is on a network filesystem. Using {1} = {2} instead of "
+                             "{3}.".format(db_path, name, value, pragmas[name]))
+            pragmas[name] = value
+
+    return pragmas
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    """
+    Applies a connection profile to a DB-API connection
+    :param dbapi_connection: sqlite3 connection
+    :param pragmas: dict of pragma: value, validated by read_pragmas
+    :return: None
+    """
+
+    cursor = dbapi_connection.cursor()
+
+    try:
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA {0} = {1}".format(name, value))
+
+            if name == "journal_mode":
+                mode = cursor.fetchone()[0]
+                if mode != value:  # e.g. WAL on a filesystem without shared memory
+                    logging.warning("SQLite journal mode is {0}, not {1}".format(mode, value))
+    finally:
+        cursor.close()
+
+
+def set_connection_profile(engine, pragmas):
+    """
+    Applies a connection profile to every connection an engine opens
+    :param engine: SQLAlchemy engine
+    :param pragmas: dict of pragma: value
+    :return: None
+    """
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, pragmas)
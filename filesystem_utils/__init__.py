@@ -1,5 +1,6 @@
 """
-Utilities for parsing files, creating hashes, etc.
+Utilities for parsing files, creating hashes, etc. Nothing here needs Qt; the QThread workers used
+by the GUI are in filesystem_utils.threads.
 """
 
 import os
@@ -7,10 +8,14 @@ import logging
 import sys
 import datetime
 import hashlib
-from PyQt4.QtCore import QThread, SIGNAL, QUrl, pyqtSignal, QObject
-from PyQt4.QtNetwork import QNetworkAccessManager, QNetworkRequest
 import platform
-from ivcs import CheckoutStatusWindow
+from filesystem_utils import hashing
+from filesystem_utils.hashing import HashingEngine
+from filesystem_utils.pipeline import ScanPipeline, iter_image_paths, iter_directory_images, \
+    stat_image, needs_full_hash, build_image_result
+from filesystem_utils.merkle import build_directory_digests, changed_directories, \
+    removed_directories, tree_changed
+from filesystem_utils.watcher import DirectoryWatcher
 
 
 if platform.system == "Windows":
@@ -18,204 +23,201 @@ if platform.system == "Windows":
     import win32api, win32con, os
 
 
-class FileSystemWalker(QThread):
+class GeneralFunctions:
     """
-    Traverses the FS and finds files
+    Functions that don't need to be threaded
     """
 
-    def __init__(self, path, image_extensions):
-        super(FileSystemWalker, self).__init__()
-        self.path = path
-        self.image_extensions = image_extensions
-        self.hash_chunksize = 4096
-
-        self.files = []
-        self.subdirs = []
-        self.file_modified_time = None
+    def __init__(self, hash_algorithm=None):
+        self.file = None
+        self.hashing_engine = HashingEngine(algorithm=hash_algorithm or hashing.DEFAULT_ALGORITHM,
+                                            block_manifests=True)
 
-    def __del__(self):
-        self.wait()
+    def hide_file(self, file):
+        """
+        Hides files in windows
+        :return:
+        """
+        self.file = file
+        if platform.system == "Windows":
+            win32api.SetFileAttributes(self.file, win32con.FILE_ATTRIBUTE_HIDDEN)
 
-    def run(self):
+    def get_application_path(self):
         """
-        Walks paths and files, and returns sets of files and directories
-        :return: sets of files and directories
+        Gets the location of the executable file for storing data
+        :return: None
         """
 
-        for root, dirs, filenames in os.walk(self.path):
-            for subdir in dirs:
-                self.subdirs.append(os.path.join(root, subdir))
+        application_path = None
 
-            for file in filenames:
-                if os.path.splitext(file)[1] in self.image_extensions:
-                    self.files.append(os.path.join(root, file))
+        if getattr(sys, 'frozen', False):
+            application_path = os.path.dirname(sys.executable)
 
-        return self.files, self.subdirs
+        elif __file__:
+            application_path = os.path.join(os.path.dirname(__file__), '..')
 
+        return application_path
 
-class FileHasher(QThread):
-    """
-    Contains the methods for hashing files and directories
-    """
+    def search_for_images(self, image_extensions, directory, known_files=None,
+                          change_detection_method="hash"):
+        """
+        Searches for imagery in directory specified. If known_files is given the scan is
+        incremental: files whose (size, mtime_ns, inode) match the stored values are skipped
+        without being read.
+        :param image_extensions: list of extensions to search for
+        :param directory: directory to search
+        :param known_files: dict of {image_path: (size, mtime_ns, inode, hash, fingerprint)} from
+        the database
+        :param change_detection_method: "hash", "fingerprint" or "modification_time". With
+        "modification_time", known files whose stats changed are returned without being rehashed
+        (hash is None). With "fingerprint", only files that need confirming are fully hashed (see
+        filesystem_utils.pipeline.needs_full_hash).
+        :return: List of new or changed images
+        """
+        if known_files is None:
+            known_files = {}
 
-    def __init__(self, file):
-        super(FileHasher, self).__init__()
-        self.file = file
-        self.hash_chunksize = 4096
+        known_fingerprints = {known_file[4] for known_file in known_files.values()
+                              if known_file[4] is not None}
 
-    def __del__(self):
-        self.wait()
+        found_images = []
+        for image_path, image_extension in iter_image_paths(image_extensions, directory):
+            try:
+                stat_result = stat_image(image_path, known_files, change_detection_method)
 
-    def run(self):
-        """
-        Generates SHA256 for file.
-        :param file: file to check
-        :return: an sha256 hex
-        """
+                if stat_result is None:  # Unchanged since the last scan
+                    continue
 
-        sha = hashlib.sha256()
+                image_stat, needs_hash = stat_result
+                image_fingerprint = None
 
-        with open(self.file, 'rb') as f:
-            while True:
-                data = f.read(self.hash_chunksize)
-                if data:
-                    sha.update(data)
-                else:
-                    break
+                if change_detection_method == "fingerprint" or needs_hash:
+                    image_fingerprint = self.get_fingerprint(image_path)
 
-        return sha.hexdigest()
+            except OSError as e:  # Removed between the walk and the stat, or unreadable
+                logging.warning("Could not stat {0} during scan. os.stat returned: {1}".
+                                format(image_path, e))
+                continue
 
+            if change_detection_method == "fingerprint":
+                needs_hash = needs_full_hash(image_path, image_fingerprint, known_files,
+                                             known_fingerprints)
 
-class FileModifiedTimeGetter(QThread):
-    """
-    Contains the methods for hashing files and directories
-    """
+            found_images.append((image_path, image_extension, image_stat, needs_hash,
+                                 image_fingerprint))
 
-    def __init__(self, file):
-        super(FileModifiedTimeGetter, self).__init__()
-        self.file = file
-        self.file_modified_time = None
+        # Hash the whole batch at once so the work is spread across the engine's workers
+        image_hashes = self.get_file_hashes(image[0] for image in found_images if image[3])
 
-    def __del__(self):
-        self.wait()
+        file_list = []
+        for image_path, image_extension, image_stat, needs_hash, image_fingerprint in \
+                found_images:
+            result = build_image_result(image_path, image_extension, image_stat,
+                                        image_hashes.get(image_path), None,
+                                        self.hashing_engine.algorithm, image_fingerprint)
+            file_list.append(result)
+
+        return file_list
 
-    def run(self):
+    def stream_images(self, image_extensions, directory, known_files=None,
+                      change_detection_method="hash", batch_size=500, directories=None):
         """
-        Gets last modified time for file
-        :param file: file to check
-        :return: a datetime object
+        Streaming version of search_for_images for large directories. Batches are yielded as
+        soon as they have been hashed, so they can be written while the scan is still running.
+        :param directories: only list these directories (not their subdirectories) instead of
+        walking the whole tree. See get_changed_directories.
+        :return: generator of lists of image tuples
         """
 
-        self.file_modified_time = os.path.getmtime(self.file)
-        self.file_modified_time = datetime.datetime.fromtimestamp(self.file_modified_time)
-
-        return self.file_modified_time
+        pipeline = ScanPipeline(image_extensions, directory, known_files,
+                                change_detection_method, self.hashing_engine,
+                                batch_size=batch_size, directories=directories)
 
+        return pipeline.batches()
 
-class FileCopier(QObject):
-    """
-    Copies files from network
-    """
+    def get_changed_directories(self, image_extensions, directory, stored_digests):
+        """
+        Builds the Merkle digests of a directory tree from the stats of its images, and compares
+        them with the ones stored by the last scan. Directories are listed and images statted,
+        but no file is read or hashed, so this quickly answers whether anything changed under a
+        project directory.
+        :param image_extensions: list of extensions to search for
+        :param directory: root of the tree
+        :param stored_digests: dict from DatabaseQueries.get_directory_digests
+        :return: (digests, list of directories to rescan, list of directories that were removed
+        since the last scan). Both lists are empty if the root's tree digest is unchanged.
+        """
 
-    finished = pyqtSignal()
+        digests = build_directory_digests(directory, image_extensions)
 
-    def __init__(self, file):
-        super(FileCopier, self).__init__()
-        self.file = QUrl("file:///{}".format(file))
-        self.manager = QNetworkAccessManager(self)
-        self.connect(self.manager, SIGNAL("finished(QNetworkReply*)"), self.reply_finished)
+        if not tree_changed(directory, digests, stored_digests):
+            return digests, [], []
 
-    def reply_finished(self, reply):
-        checkout_class = CheckoutStatusWindow()
-        self.connect(reply, SIGNAL("downloadProgress(int, int)"), checkout_class.update_progress_bar)
-        self.reply = reply
-        checkout_class.progressBar.setMaximum(reply.size())
+        return digests, changed_directories(digests, stored_digests), \
+            removed_directories(digests, stored_digests)
 
-    def run(self):
+    def get_file_hash(self, file, algorithm=None):
         """
-        Start the download
-        :return: None
+        Generate hash of the full contents of file
+        :param file: path to file
+        :param algorithm: registered hash algorithm. Defaults to the configured one.
+        :return: hex digest
         """
-        self.manager.get(QNetworkRequest(self.file))
-        self.finished.emit()
 
+        return self.hashing_engine.hash_file(file, algorithm)
 
-class GeneralFunctions:
-    """
-    Functions that don't need to be threaded
-    """
-
-    def __init__(self):
-        self.file = None
-
-    def hide_file(self, file):
+    def get_fingerprint(self, file):
         """
-        Hides files in windows
-        :return:
+        Generate the quick fingerprint of file: its size plus samples of its head, middle and tail
+        :param file: path to file
+        :return: hex digest
         """
-        self.file = file
-        if platform.system == "Windows":
-            win32api.SetFileAttributes(self.file, win32con.FILE_ATTRIBUTE_HIDDEN)
 
-    def get_application_path(self):
+        return self.hashing_engine.fingerprint(file)
+
+    def compare_fingerprints(self, known_files):
         """
-        Gets the location of the executable file for storing data
-        :return: None
+        Checks stored files against disk with quick fingerprints instead of full hashes. Files
+        whose stats are unchanged aren't read at all.
+        :param known_files: dict of {image_path: (size, mtime_ns, inode, hash, fingerprint)}
+        :return: (set of paths that changed, list of paths whose stats changed but whose
+        fingerprint didn't, which need a full hash to confirm)
         """
 
-        application_path = None
+        changed_files = set()
+        unconfirmed_files = []
 
-        if getattr(sys, 'frozen', False):
-            application_path = os.path.dirname(sys.executable)
+        for image_path in known_files:
+            try:
+                if stat_image(image_path, known_files, "fingerprint") is None:
+                    continue
+                image_fingerprint = self.get_fingerprint(image_path)
+            except OSError:  # Removed or unreadable
+                changed_files.add(image_path)
+                continue
 
-        elif __file__:
-            application_path = os.path.join(os.path.dirname(__file__), '..')
+            if known_files[image_path][4] == image_fingerprint:
+                unconfirmed_files.append(image_path)
+            else:
+                changed_files.add(image_path)
 
-        return application_path
+        return changed_files, unconfirmed_files
 
-    def search_for_images(self, image_extensions, directory):
+    def get_block_manifest(self, file):
         """
-        Searches for imagery in directory specified
-        :param image_extensions: list of extensions to search for
-        :param directory: directory to search
-        :return: List of image paths
+        Hash file and each of its tiles, strips or blocks in a single pass
+        :param file: path to file
+        :return: (hex digest, manifest). See filesystem_utils.hashing.hash_file_blocks.
         """
-        buffer_size = 256
-        file_list = []
-        for root, dirs, files in os.walk(directory):
-            # Traverse the filesystem, adding files to the DB
-            for file in files:
-                sha1 = hashlib.sha1()
-                image_name = os.path.splitext(file)[0]
-                image_extension = os.path.splitext(file)[1]
-                if image_extension in image_extensions:
-                    image_path = os.path.join(root, file)
-                    image_size = os.path.getsize(image_path)
-                    _image_modification_time = os.path.getmtime(image_path)
-                    image_modification_time = datetime.datetime.fromtimestamp(_image_modification_time)
-                    image_first_seen = datetime.datetime.now()
-                    image_last_scanned = datetime.datetime.now()
-                    image_on_disk = True
-
-                    image_hash = self.get_file_hash(image_path)
-
-                    result = (image_path, image_extension, image_size, image_hash,
-                              image_modification_time, image_first_seen, image_last_scanned,
-                              image_on_disk)
-                    file_list.append(result)
 
-        return file_list
+        return self.hashing_engine.hash_file_blocks(file)
 
-    def get_file_hash(self, file):
-        """Generate SHA1 hash of file"""
-
-        buffer_size = 256
-        sha1 = hashlib.sha1()
-
-        # Generate hash
-        with open(file[0], 'rb') as f:
-            data = f.read(buffer_size)
-            sha1.update(data)
-            image_hash = sha1.hexdigest()
+    def get_file_hashes(self, files, algorithm=None):
+        """
+        Generate hashes for a batch of files in parallel
+        :param files: iterable of file paths
+        :param algorithm: registered hash algorithm. Defaults to the configured one.
+        :return: dict of {path: hex digest}. Unreadable files map to None.
+        """
 
-        return image_hash
+        return self.hashing_engine.hash_files(files, algorithm)
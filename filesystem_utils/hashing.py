@@ -0,0 +1,332 @@
+"""
+Whole-file hashing engine. Hashes many files at once across a pool of workers.
+"""
+
+import os
+import mmap
+import zlib
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from filesystem_utils.mounts import is_network_mount
+from filesystem_utils.rasters import block_layout
+
+try:
+    import xxhash  # Optional. Much faster than any hashlib algorithm for change detection.
+except ImportError:
+    xxhash = None
+
+DEFAULT_ALGORITHM = "sha1"
+DEFAULT_BUFFER_SIZE = 1024 * 1024  # 1 MiB per read
+DEFAULT_WINDOW_SIZE = 64 * 1024 * 1024  # 64 MiB mapped at a time
+FINGERPRINT_ALGORITHM = "blake2b"  # Fixed so that stored fingerprints stay comparable
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024  # Bytes read from each of the head, middle and tail
+
+
+class Crc32:
+    """
+    hashlib-style wrapper around zlib.crc32. Fast, but only 32 bits, so only suitable for
+    detecting changes to a file, not for identifying content.
+    """
+
+    name = "crc32"
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return "{:08x}".format(self.value)
+
+
+# Algorithm name -> callable returning a new hasher with update() and hexdigest()
+HASH_ALGORITHMS = {
+    "md5": hashlib.md5,
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+    "blake2b": hashlib.blake2b,
+    "crc32": Crc32,
+}
+
+if xxhash is not None:
+    HASH_ALGORITHMS["xxh64"] = xxhash.xxh64
+    HASH_ALGORITHMS["xxh3_64"] = xxhash.xxh3_64
+
+
+def register_algorithm(name, constructor):
+    """
+    Adds a hash algorithm to the registry
+    :param name: name stored in Imagery.image_hash_algorithm
+    :param constructor: callable returning a new hasher with update() and hexdigest()
+    :return: None
+    """
+
+    HASH_ALGORITHMS[name] = constructor
+
+
+def new_hasher(algorithm):
+    """
+    Creates a hasher from the registry
+    :param algorithm: registered algorithm name
+    :return: hasher object
+    """
+
+    try:
+        return HASH_ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError("Unknown hash algorithm '{0}'. Available: {1}".format(
+            algorithm, ", ".join(sorted(HASH_ALGORITHMS))))
+
+
+def fastest_algorithm():
+    """
+    Gets the fastest registered algorithm that is still 64 bits or wider
+    :return: algorithm name
+    """
+
+    if "xxh3_64" in HASH_ALGORITHMS:
+        return "xxh3_64"
+
+    return "sha256"  # Hardware accelerated on most current CPUs
+
+
+def hash_file(path, algorithm=DEFAULT_ALGORITHM, buffer_size=DEFAULT_BUFFER_SIZE,
+              use_mmap=False, window_size=DEFAULT_WINDOW_SIZE):
+    """
+    Hashes the full contents of a file. Kept at module level so that it can be pickled for
+    process pools.
+    :param path: path to file
+    :param algorithm: name of a registered algorithm (see HASH_ALGORITHMS)
+    :param buffer_size: number of bytes to read per call
+    :param use_mmap: hash memory-mapped windows of the file instead of reading it. Only used for
+    files larger than buffer_size on local filesystems; otherwise falls back to reading.
+    :param window_size: number of bytes to map at a time
+    :return: hex digest
+    """
+
+    with open(path, 'rb', buffering=0) as f:
+        if use_mmap and os.fstat(f.fileno()).st_size > buffer_size and \
+                not is_network_mount(path):
+            try:
+                return _hash_mmap(f, new_hasher(algorithm), window_size)
+            except (OSError, ValueError) as e:
+                logging.info("Could not memory map {0}, reading it instead. mmap returned: {1}".
+                             format(path, e))
+                f.seek(0)
+
+        return _hash_readinto(f, new_hasher(algorithm), buffer_size)
+
+
+def quick_fingerprint(path, sample_size=FINGERPRINT_SAMPLE_SIZE):
+    """
+    Cheap stand-in for a full hash: the file size plus samples from its head, middle and tail.
+    A different fingerprint means the file changed; a matching one only means it probably didn't,
+    as edits between the samples are missed.
+    :param path: path to file
+    :param sample_size: number of bytes to read per sample
+    :return: hex digest
+    """
+
+    hasher = new_hasher(FINGERPRINT_ALGORITHM)
+
+    with open(path, 'rb', buffering=0) as f:
+        file_size = os.fstat(f.fileno()).st_size
+        hasher.update(str(file_size).encode("ascii"))
+
+        if file_size <= 3 * sample_size:
+            return _hash_readinto(f, hasher, max(file_size, 1))
+
+        buffer = bytearray(sample_size)
+        view = memoryview(buffer)
+
+        for offset in (0, (file_size - sample_size) // 2, file_size - sample_size):
+            f.seek(offset)
+            length = f.readinto(buffer)
+            hasher.update(view[:length])
+
+    return hasher.hexdigest()
+
+
+def _hash_readinto(f, hasher, buffer_size):
+    """
+    Hashes an unbuffered file by reading into one reusable buffer, so no new bytes objects are
+    created per read
+    :return: hex digest
+    """
+
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+
+    while True:
+        length = f.readinto(buffer)
+        if not length:
+            break
+        hasher.update(view[:length])
+
+    return hasher.hexdigest()
+
+
+def _hash_mmap(f, hasher, window_size):
+    """
+    Hashes a file by passing memory-mapped windows of it straight to the hasher
+    :return: hex digest
+    """
+
+    file_size = os.fstat(f.fileno()).st_size
+    # Window offsets have to be multiples of the allocation granularity
+    window_size = max(mmap.ALLOCATIONGRANULARITY,
+                      window_size - window_size % mmap.ALLOCATIONGRANULARITY)
+    offset = 0
+
+    while offset < file_size:
+        length = min(window_size, file_size - offset)
+        window = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ, offset=offset)
+
+        try:
+            if hasattr(window, "madvise"):
+                window.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(window) as view:
+                hasher.update(view)
+        finally:
+            window.close()
+
+        offset += length
+
+    return hasher.hexdigest()
+
+
+def hash_file_blocks(path, algorithm=DEFAULT_ALGORITHM, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+    Hashes a file and each of its blocks (see rasters.block_layout) in a single pass
+    :param path: path to file
+    :param algorithm: name of a registered algorithm (see HASH_ALGORITHMS)
+    :param buffer_size: number of bytes to read per call
+    :return: (hex digest of the whole file, manifest). The manifest is a list of
+    (block type, first block index, block count, offset, length, hex digest).
+    """
+
+    file_hasher = new_hasher(algorithm)
+    manifest = []
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+
+    with open(path, 'rb', buffering=0) as f:
+        for block_type, block_index, block_count, offset, length in block_layout(path):
+            block_hasher = new_hasher(algorithm)
+            remaining = length
+            f.seek(offset)
+
+            while remaining:
+                read_length = f.readinto(view[:min(buffer_size, remaining)])
+                if not read_length:  # File was truncated after the layout was read
+                    break
+                block_hasher.update(view[:read_length])
+                file_hasher.update(view[:read_length])
+                remaining -= read_length
+
+            manifest.append((block_type, block_index, block_count, offset, length,
+                             block_hasher.hexdigest()))
+
+    return file_hasher.hexdigest(), manifest
+
+
+class HashingEngine:
+    """
+    Hashes files across a thread or process pool. hashlib and file reads release the GIL, so
+    threads are the default; processes can be used where the hashing itself is the bottleneck.
+    """
+
+    def __init__(self, workers=None, algorithm=DEFAULT_ALGORITHM,
+                 buffer_size=DEFAULT_BUFFER_SIZE, use_processes=False, use_mmap=True,
+                 window_size=DEFAULT_WINDOW_SIZE, block_manifests=False):
+        new_hasher(algorithm)  # Fail early on unknown algorithms
+        self.workers = workers or os.cpu_count() or 1
+        self.algorithm = algorithm
+        self.buffer_size = buffer_size
+        self.use_processes = use_processes
+        self.use_mmap = use_mmap
+        self.window_size = window_size
+        self.block_manifests = block_manifests  # Build per-block manifests in streaming scans
+
+    def hash_file(self, path, algorithm=None):
+        """
+        Hashes a single file in the calling thread
+        :param path: path to file
+        :param algorithm: overrides the engine's algorithm
+        :return: hex digest
+        """
+
+        return hash_file(path, algorithm or self.algorithm, self.buffer_size, self.use_mmap,
+                         self.window_size)
+
+    def fingerprint(self, path):
+        """
+        Takes the quick fingerprint of a file in the calling thread
+        :param path: path to file
+        :return: hex digest
+        """
+
+        return quick_fingerprint(path)
+
+    def hash_file_blocks(self, path):
+        """
+        Hashes a file and builds its per-block manifest in the calling thread
+        :param path: path to file
+        :return: (hex digest, manifest)
+        """
+
+        return hash_file_blocks(path, self.algorithm, self.buffer_size)
+
+    def hash_files(self, paths, algorithm=None):
+        """
+        Hashes a batch of files using the worker pool
+        :param paths: iterable of file paths
+        :param algorithm: overrides the engine's algorithm
+        :return: dict of {path: hex digest}. Files that could not be read map to None.
+        """
+
+        paths = list(paths)
+        algorithm = algorithm or self.algorithm
+        digests = {}
+
+        if self.workers == 1 or len(paths) <= 1:
+            for path in paths:
+                digests[path] = self._hash_or_none(path, algorithm)
+
+            return digests
+
+        if self.use_processes:
+            executor_class = ProcessPoolExecutor
+        else:
+            executor_class = ThreadPoolExecutor
+
+        with executor_class(max_workers=self.workers) as executor:
+            futures = {executor.submit(hash_file, path, algorithm, self.buffer_size,
+                                       self.use_mmap, self.window_size): path
+                       for path in paths}
+
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    digests[path] = future.result()
+                except OSError as e:
+                    digests[path] = None
+                    logging.warning("Could not hash {0}. hash_file returned: {1}".format(path, e))
+
+        return digests
+
+    def _hash_or_none(self, path, algorithm):
+        """
+        Hashes a file, logging and returning None if it can't be read
+        :param path: path to file
+        :param algorithm: registered algorithm name
+        :return: hex digest or None
+        """
+
+        try:
+            return self.hash_file(path, algorithm)
+        except OSError as e:
+            logging.warning("Could not hash {0}. hash_file returned: {1}".format(path, e))
+            return None
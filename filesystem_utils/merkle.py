@@ -0,0 +1,117 @@
+"""
+Merkle digests of directory trees, built from the stat values of the images in them. Comparing
+them with the stored digests shows which directories changed without reading any file contents.
+"""
+
+import os
+import logging
+from filesystem_utils.hashing import new_hasher
+
+# Fixed so that stored digests stay comparable whatever hash algorithm is configured
+MERKLE_ALGORITHM = "sha1"
+
+
+def build_directory_digests(root, image_extensions):
+    """
+    Builds the digests of root and every directory below it
+    :param root: directory path
+    :param image_extensions: only images with these extensions are part of the digests
+    :return: dict of {directory path: (mtime_ns, files_digest, tree_digest)}. files_digest covers
+    the images directly in the directory, tree_digest also covers every subdirectory.
+    """
+
+    digests = {}
+    _digest_directory(root, image_extensions, digests)
+
+    return digests
+
+
+def _digest_directory(path, image_extensions, digests):
+    """
+    Digests one directory after its subdirectories
+    :return: tree digest of path
+    """
+
+    files_hasher = new_hasher(MERKLE_ALGORITHM)
+    subdirectories = []
+
+    try:
+        directory_mtime_ns = os.stat(path).st_mtime_ns
+        with os.scandir(path) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+    except OSError as e:
+        logging.warning("Could not read directory {0} while building digests. os.scandir "
+                        "returned: {1}".format(path, e))
+        return None
+
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry)
+            elif os.path.splitext(entry.name)[1] in image_extensions and entry.is_file():
+                entry_stat = entry.stat()
+                files_hasher.update("{0}\0{1}\0{2}\0{3}\n".format(
+                    entry.name, entry_stat.st_size, entry_stat.st_mtime_ns,
+                    entry_stat.st_ino).encode("utf-8", "surrogateescape"))
+        except OSError:  # Removed while we were listing
+            continue
+
+    files_digest = files_hasher.hexdigest()
+    tree_hasher = new_hasher(MERKLE_ALGORITHM)
+    tree_hasher.update(files_digest.encode("ascii"))
+
+    for entry in subdirectories:
+        subdirectory_digest = _digest_directory(entry.path, image_extensions, digests)
+        if subdirectory_digest is not None:
+            tree_hasher.update("{0}\0{1}\n".format(entry.name, subdirectory_digest).
+                               encode("utf-8", "surrogateescape"))
+
+    tree_digest = tree_hasher.hexdigest()
+    digests[path] = (directory_mtime_ns, files_digest, tree_digest)
+
+    return tree_digest
+
+
+def changed_directories(digests, stored_digests):
+    """
+    Finds the directories whose images have to be rescanned: those whose own mtime or files digest
+    changed. Directories under a subtree whose tree digest is unchanged are never returned.
+    :param digests: fresh digests from build_directory_digests
+    :param stored_digests: digests from the previous scan
+    :return: list of directory paths whose own images were added, removed or changed
+    """
+
+    changed = []
+
+    for path, (directory_mtime_ns, files_digest, tree_digest) in digests.items():
+        stored = stored_digests.get(path)
+
+        if stored is None or stored[0] != directory_mtime_ns or stored[1] != files_digest:
+            changed.append(path)
+
+    return sorted(changed)
+
+
+def removed_directories(digests, stored_digests):
+    """
+    Finds the directories the previous scan saw that are gone. A stored directory missing from the
+    fresh digests is only counted if it no longer exists, so one that couldn't be read this time
+    (e.g. a network share timing out) doesn't have its images marked as deleted.
+    :param digests: fresh digests from build_directory_digests
+    :param stored_digests: digests from the previous scan
+    :return: list of directory paths
+    """
+
+    return sorted(path for path in stored_digests
+                  if path not in digests and not os.path.isdir(path))
+
+
+def tree_changed(root, digests, stored_digests):
+    """
+    Answers "did anything change under root" from its tree digest
+    :return: Bool
+    """
+
+    stored = stored_digests.get(root)
+
+    return stored is None or digests.get(root) is None or stored[2] != digests[root][2]
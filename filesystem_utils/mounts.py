@@ -0,0 +1,37 @@
+"""
+Looks up which filesystem a path lives on
+"""
+
+import os
+
+# Network filesystems. inotify can't see changes made by other hosts on these, and memory
+# mapping them is unsafe because another host can truncate a file while it is mapped.
+NETWORK_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smbfs", "smb3", "afs", "9p", "fuse.sshfs",
+                       "fuse.glusterfs", "ceph", "lustre"}
+
+
+def is_network_mount(path):
+    """
+    Checks /proc/mounts to see if path lives on a network filesystem
+    :param path: path to check
+    :return: Bool
+    """
+
+    try:
+        with open("/proc/mounts") as mounts:
+            mount_table = [line.split()[1:3] for line in mounts]
+    except OSError:
+        return False
+
+    path = os.path.realpath(path)
+    best_match = ""
+    best_type = None
+
+    for mount_point, fs_type in mount_table:
+        mount_point = mount_point.replace("\\040", " ")
+        if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and \
+                len(mount_point) > len(best_match):
+            best_match = mount_point
+            best_type = fs_type
+
+    return best_type in NETWORK_FILESYSTEMS
@@ -0,0 +1,319 @@
+"""
+Streaming scan pipeline: walk -> stat -> hash -> batched database writes
+"""
+
+import os
+import queue
+import datetime
+import logging
+import threading
+from filesystem_utils.hashing import HashingEngine
+
+_DONE = object()  # Sentinel passed down the queues when a stage has finished
+
+
+def iter_image_paths(image_extensions, directory):
+    """
+    Walks a directory and yields the images with a matching extension
+    :param image_extensions: list of extensions to search for
+    :param directory: directory to search
+    :return: generator of (image_path, image_extension)
+    """
+
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            image_extension = os.path.splitext(file)[1]
+            if image_extension in image_extensions:
+                yield os.path.join(root, file), image_extension
+
+
+def iter_directory_images(image_extensions, directories):
+    """
+    Lists the images directly in each directory, without descending into subdirectories. Used to
+    rescan only the directories whose Merkle digests changed.
+    :param image_extensions: list of extensions to search for
+    :param directories: iterable of directory paths
+    :return: generator of (image_path, image_extension)
+    """
+
+    for directory in directories:
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    image_extension = os.path.splitext(entry.name)[1]
+                    if image_extension in image_extensions and entry.is_file():
+                        yield entry.path, image_extension
+        except OSError as e:  # Removed since the digests were built
+            logging.warning("Could not list {0} during scan. os.scandir returned: {1}".
+                            format(directory, e))
+
+
+def stat_image(image_path, known_files, change_detection_method):
+    """
+    Stats an image and decides whether it has to be hashed
+    :param image_path: path to image
+    :param known_files: dict of {image_path: (size, mtime_ns, inode, hash, fingerprint)} from the
+    database
+    :param change_detection_method: "hash", "fingerprint" or "modification_time"
+    :return: (stat_result, needs_hash), or None if the image is unchanged since the last scan.
+    Raises OSError if the image can't be statted; scans log and skip it, compare_fingerprints
+    counts it as changed.
+    """
+
+    image_stat = os.stat(image_path)
+    known_file = known_files.get(image_path)
+
+    if known_file is not None:
+        if known_file[:3] == (image_stat.st_size, image_stat.st_mtime_ns, image_stat.st_ino):
+            return None
+
+        if change_detection_method == "modification_time":
+            return image_stat, False
+
+    return image_stat, True
+
+
+def needs_full_hash(image_path, image_fingerprint, known_files, known_fingerprints):
+    """
+    Decides whether an image picked up by a fingerprint scan needs a full hash. A known image
+    whose stats changed is always hashed: if its fingerprint changed too, the stored hash is of
+    content that is gone, and if it didn't, the image may have been edited between the samples.
+    A new image is only hashed if its fingerprint matches a stored one, since it may be a copy.
+    :param image_path: path to image
+    :param image_fingerprint: quick fingerprint of the image
+    :param known_files: dict of {image_path: (size, mtime_ns, inode, hash, fingerprint)}
+    :param known_fingerprints: set of the fingerprints in known_files
+    :return: Bool
+    """
+
+    if image_path in known_files:
+        return True
+
+    return image_fingerprint in known_fingerprints
+
+
+def build_image_result(image_path, image_extension, image_stat, image_hash,
+                       block_manifest=None, hash_algorithm=None, image_fingerprint=None):
+    """
+    Builds the image tuple returned by scans:
+
+    (image_path, image_extension, image_size, image_hash, image_modification_time,
+    image_first_seen, image_last_scanned, image_on_disk, image_mtime_ns, image_inode,
+    block_manifest, hash_algorithm, image_fingerprint)
+
+    :return: tuple
+    """
+
+    image_modification_time = datetime.datetime.fromtimestamp(image_stat.st_mtime)
+    image_first_seen = datetime.datetime.now()
+    image_last_scanned = datetime.datetime.now()
+    image_on_disk = True
+
+    return (image_path, image_extension, image_stat.st_size, image_hash,
+            image_modification_time, image_first_seen, image_last_scanned, image_on_disk,
+            image_stat.st_mtime_ns, image_stat.st_ino, block_manifest,
+            hash_algorithm if image_hash is not None else None, image_fingerprint)
+
+
+class ScanPipeline:
+    """
+    Streams a directory scan in batches. The walk, stat and hash stages each run in their own
+    threads and pass work along bounded queues, so memory stays flat however large the directory
+    is, and the first batches can be written to the database while later files are still being
+    hashed.
+    """
+
+    def __init__(self, image_extensions, directory, known_files=None,
+                 change_detection_method="hash", hashing_engine=None, queue_size=1000,
+                 batch_size=500, directories=None):
+        self.image_extensions = image_extensions
+        self.directory = directory
+        self.directories = directories  # Only list these directories instead of walking the tree
+        self.known_files = known_files or {}
+        self.known_fingerprints = {known_file[4] for known_file in self.known_files.values()
+                                   if known_file[4] is not None}
+        self.change_detection_method = change_detection_method
+        self.hashing_engine = hashing_engine or HashingEngine()
+        self.batch_size = batch_size
+
+        self.path_queue = queue.Queue(maxsize=queue_size)
+        self.hash_queue = queue.Queue(maxsize=queue_size)
+        self.result_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+
+    def batches(self):
+        """
+        Runs the pipeline. The caller consumes the batches (normally writing them to the
+        database) in its own thread, which keeps the database session on one thread.
+        :return: generator of lists of image tuples (see build_image_result)
+        """
+
+        hash_workers = self.hashing_engine.workers
+        threads = [threading.Thread(target=self._walk_stage),
+                   threading.Thread(target=self._stat_stage, args=(hash_workers,))]
+        threads += [threading.Thread(target=self._hash_stage) for _ in range(hash_workers)]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        batch = []
+        finished_workers = 0
+
+        try:
+            while finished_workers < hash_workers:
+                item = self.result_queue.get()
+
+                if item is _DONE:
+                    finished_workers += 1
+                elif isinstance(item, BaseException):
+                    raise item
+                else:
+                    batch.append(item)
+
+                    if len(batch) >= self.batch_size:
+                        yield batch
+                        batch = []
+
+            if batch:
+                yield batch
+
+        finally:
+            # Unblock the stages if the consumer stopped early or something failed
+            self.stop_event.set()
+            for thread in threads:
+                thread.join()
+
+    def _put(self, target_queue, item):
+        """
+        Puts an item on a queue, giving up if the pipeline has been stopped
+        :return: False if the pipeline was stopped
+        """
+
+        while not self.stop_event.is_set():
+            try:
+                target_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _get(self, source_queue):
+        """
+        Gets an item from a queue, giving up if the pipeline has been stopped
+        :return: the item, or _DONE if the pipeline was stopped
+        """
+
+        while not self.stop_event.is_set():
+            try:
+                return source_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+        return _DONE
+
+    def _walk_stage(self):
+        """
+        Walks the directory tree, or lists the given directories
+        :return: None
+        """
+
+        if self.directories is None:
+            images = iter_image_paths(self.image_extensions, self.directory)
+        else:
+            images = iter_directory_images(self.image_extensions, self.directories)
+
+        try:
+            for image in images:
+                if not self._put(self.path_queue, image):
+                    return
+
+        except Exception as e:
+            self._put(self.result_queue, e)
+
+        self._put(self.path_queue, _DONE)
+
+    def _stat_stage(self, hash_workers):
+        """
+        Stats each image and drops the ones that haven't changed since the last scan
+        :param hash_workers: number of hash stage threads to signal when done
+        :return: None
+        """
+
+        try:
+            while True:
+                item = self._get(self.path_queue)
+                if item is _DONE:
+                    break
+
+                image_path, image_extension = item
+
+                try:
+                    stat_result = stat_image(image_path, self.known_files,
+                                             self.change_detection_method)
+                except OSError as e:  # File was removed or is unreadable
+                    logging.warning("Could not stat {0} during scan. os.stat returned: {1}".
+                                    format(image_path, e))
+                    continue
+
+                if stat_result is not None:
+                    image_stat, needs_hash = stat_result
+                    if not self._put(self.hash_queue,
+                                     (image_path, image_extension, image_stat, needs_hash)):
+                        return
+
+        except BaseException as e:
+            self._put(self.result_queue, e)
+
+        finally:
+            # Always signal the hash stage, or batches() would wait for it forever
+            for _ in range(hash_workers):
+                self._put(self.hash_queue, _DONE)
+
+    def _hash_stage(self):
+        """
+        Hashes images that need it and passes the finished tuples on
+        :return: None
+        """
+
+        try:
+            while True:
+                item = self._get(self.hash_queue)
+                if item is _DONE:
+                    break
+
+                image_path, image_extension, image_stat, needs_hash = item
+                image_hash = None
+                block_manifest = None
+                image_fingerprint = None
+
+                try:
+                    if self.change_detection_method == "fingerprint" or needs_hash:
+                        image_fingerprint = self.hashing_engine.fingerprint(image_path)
+
+                    if self.change_detection_method == "fingerprint":
+                        needs_hash = needs_full_hash(image_path, image_fingerprint,
+                                                     self.known_files, self.known_fingerprints)
+
+                    if needs_hash:
+                        if self.hashing_engine.block_manifests:
+                            image_hash, block_manifest = \
+                                self.hashing_engine.hash_file_blocks(image_path)
+                        else:
+                            image_hash = self.hashing_engine.hash_file(image_path)
+                except OSError as e:
+                    logging.warning("Could not hash {0} during scan. hash_file returned: {1}".
+                                    format(image_path, e))
+
+                result = build_image_result(image_path, image_extension, image_stat, image_hash,
+                                            block_manifest, self.hashing_engine.algorithm,
+                                            image_fingerprint)
+                if not self._put(self.result_queue, result):
+                    return
+
+        except BaseException as e:
+            self._put(self.result_queue, e)
+
+        finally:
+            self._put(self.result_queue, _DONE)
@@ -0,0 +1,455 @@
+"""
+Reads the on-disk block layout of raster files: TIFF/GeoTIFF strips and tiles, and the raster
+blocks of Erdas Imagine (.img/HFA) files
+"""
+
+import os
+import struct
+
+# TIFF tags
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+PREDICTOR = 317
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+SAMPLE_FORMAT = 339
+
+# GeoTIFF tags
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+MODEL_TRANSFORMATION = 34264
+
+# TIFF field type -> (struct format, size in bytes)
+TIFF_TYPES = {1: ("B", 1), 2: ("s", 1), 3: ("H", 2), 4: ("I", 4), 5: ("II", 8), 6: ("b", 1),
+              7: ("B", 1), 8: ("h", 2), 9: ("i", 4), 10: ("ii", 8), 11: ("f", 4), 12: ("d", 8),
+              13: ("I", 4), 16: ("Q", 8), 17: ("q", 8), 18: ("Q", 8)}
+
+# TIFF sample format -> numpy kind
+SAMPLE_KINDS = {1: "u", 2: "i", 3: "f"}
+
+HFA_HEADER_TAG = b"EHFA_HEADER_TAG"
+# HFA pixel type -> numpy dtype. Sub-byte and complex types are left out.
+HFA_PIXEL_TYPES = {3: "|u1", 4: "|i1", 5: "<u2", 6: "<i2", 7: "<u4", 8: "<i4", 9: "<f4",
+                   10: "<f8"}
+_HFA_ENTRY = struct.Struct("<IIIIII64s32sI")  # next, prev, parent, child, data, dataSize, name,
+                                              # type, modTime
+_HFA_BLOCK_INFO = struct.Struct("<hIIHH")  # fileCode, offset, size, logvalid, compressionType
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024  # Used for files without a known block layout
+DEFAULT_MIN_BLOCK_SIZE = 1024 * 1024  # Neighbouring small blocks are merged up to this size
+
+
+class TiffFile:
+    """
+    Minimal reader for classic and Big TIFF directories (IFDs)
+    """
+
+    def __init__(self, f):
+        """
+        :param f: binary file object, positioned anywhere
+        """
+
+        self.f = f
+        self.file_size = f.seek(0, os.SEEK_END)
+        header = self._read(0, 16)
+
+        if header[:2] == b"II":
+            self.byte_order = "<"
+        elif header[:2] == b"MM":
+            self.byte_order = ">"
+        else:
+            raise ValueError("Not a TIFF file")
+
+        version = struct.unpack(self.byte_order + "H", header[2:4])[0]
+
+        if version == 42:
+            self.big_tiff = False
+            first_ifd = struct.unpack(self.byte_order + "I", header[4:8])[0]
+        elif version == 43:
+            self.big_tiff = True
+            first_ifd = struct.unpack(self.byte_order + "Q", header[8:16])[0]
+        else:
+            raise ValueError("Unknown TIFF version {}".format(version))
+
+        self.ifds = []  # list of {tag: (field type, count, raw value or offset bytes)}
+        self.ifd_offsets = []
+        self._read_ifds(first_ifd)
+
+    def _read(self, offset, length):
+        # Checked before reading, so a corrupt offset or count can't make read() allocate more
+        # than the file holds
+        if offset < 0 or length < 0 or offset + length > self.file_size:
+            raise ValueError("TIFF is truncated")
+
+        self.f.seek(offset)
+        data = self.f.read(length)
+
+        if len(data) < length:
+            raise ValueError("TIFF is truncated")
+
+        return data
+
+    def _read_ifds(self, offset):
+        """
+        Reads the chain of IFDs starting at offset
+        :return: None
+        """
+
+        if self.big_tiff:
+            count_format, entry_format, next_format = "Q", "HHQ8s", "Q"
+        else:
+            count_format, entry_format, next_format = "H", "HHI4s", "I"
+
+        count_size = struct.calcsize(count_format)
+        entry_size = struct.calcsize(self.byte_order + entry_format)
+        next_size = struct.calcsize(next_format)
+
+        while offset and offset not in self.ifd_offsets:  # Guard against loops
+            entry_count = struct.unpack(self.byte_order + count_format,
+                                        self._read(offset, count_size))[0]
+            data = self._read(offset + count_size, entry_count * entry_size + next_size)
+
+            entries = {}
+            for index in range(entry_count):
+                tag, field_type, count, value = struct.unpack_from(
+                    self.byte_order + entry_format, data, index * entry_size)
+                entries[tag] = (field_type, count, value)
+
+            self.ifd_offsets.append(offset)
+            self.ifds.append(entries)
+            offset = struct.unpack_from(self.byte_order + next_format, data,
+                                        entry_count * entry_size)[0]
+
+    def tag(self, ifd_index, tag, default=None):
+        """
+        Decodes the values of a tag
+        :param ifd_index: index of the IFD (0 is the full resolution image)
+        :param tag: tag number
+        :param default: returned if the tag isn't present
+        :return: list of values, or bytes for ASCII/UNDEFINED tags
+        """
+
+        entry = self.raw_tag(ifd_index, tag)
+        if entry is None:
+            return default
+
+        field_type, count, value = entry
+        if field_type in (2, 7):
+            return value
+
+        value_format = TIFF_TYPES.get(field_type, ("B", 1))[0]
+        return list(struct.unpack(self.byte_order + value_format * count, value))
+
+    def raw_tag(self, ifd_index, tag):
+        """
+        Reads the undecoded values of a tag, in the file's byte order
+        :param ifd_index: index of the IFD
+        :param tag: tag number
+        :return: (field type, count, bytes), or None if the tag isn't present
+        """
+
+        entry = self.ifds[ifd_index].get(tag)
+        if entry is None:
+            return None
+
+        field_type, count, value = entry
+        length = count * TIFF_TYPES.get(field_type, ("B", 1))[1]
+
+        if length > self.file_size:
+            raise ValueError("Tag {0} has {1} values, more than the file can hold".format(
+                tag, count))
+
+        if length > len(value):  # Stored elsewhere; value holds the offset
+            offset = struct.unpack(self.byte_order + ("Q" if self.big_tiff else "I"), value)[0]
+            value = self._read(offset, length)
+
+        return field_type, count, value[:length]
+
+    def data_blocks(self, ifd_index):
+        """
+        Gets the tiles or strips of an IFD
+        :return: (block type, list of offsets, list of byte counts)
+        """
+
+        offsets = self.tag(ifd_index, TILE_OFFSETS)
+        if offsets is not None:
+            return "tile", offsets, self.tag(ifd_index, TILE_BYTE_COUNTS, [])
+
+        return "strip", self.tag(ifd_index, STRIP_OFFSETS, []), \
+            self.tag(ifd_index, STRIP_BYTE_COUNTS, [])
+
+
+def tiff_blocks(f):
+    """
+    Lists the strips or tiles of every image in a TIFF
+    :param f: binary file object
+    :return: list of (block type, block index, offset, length). Block types are "tile:N" or
+    "strip:N", where N is the IFD (0 is full resolution, higher numbers are usually overviews).
+    """
+
+    tiff = TiffFile(f)
+    blocks = []
+
+    for ifd_index in range(len(tiff.ifds)):
+        block_type, offsets, byte_counts = tiff.data_blocks(ifd_index)
+        block_type = "{0}:{1}".format(block_type, ifd_index)
+
+        for block_index, (offset, length) in enumerate(zip(offsets, byte_counts)):
+            blocks.append((block_type, block_index, offset, length))
+
+    return blocks
+
+
+def _hfa_entries(f):
+    """
+    Walks the entry tree of an Erdas Imagine (HFA) file
+    :param f: binary file object
+    :return: (function reading (offset, length) from f, list of (pointer, parent pointer, name,
+    entry type, data offset, data size))
+    """
+
+    file_size = f.seek(0, os.SEEK_END)
+
+    def read(offset, length):
+        if offset < 0 or length < 0 or offset + length > file_size:
+            raise ValueError("HFA file is truncated")
+        f.seek(offset)
+        return f.read(length)
+
+    if not read(0, 16).startswith(HFA_HEADER_TAG):
+        raise ValueError("Not an HFA file")
+
+    header_pointer = struct.unpack("<I", read(16, 4))[0]
+    root_pointer = struct.unpack("<I", read(header_pointer + 8, 4))[0]
+
+    entries = []
+    visited = set()
+    stack = [(root_pointer, 0)]
+
+    while stack:
+        pointer, parent = stack.pop()
+
+        while pointer and pointer not in visited:  # Walk the sibling chain
+            visited.add(pointer)
+            next_pointer, _, _, child, data, data_size, name, entry_type, _ = \
+                _HFA_ENTRY.unpack(read(pointer, _HFA_ENTRY.size))
+            entries.append((pointer, parent, name.split(b"\0")[0].decode("ascii", "replace"),
+                            entry_type.split(b"\0")[0].decode("ascii", "replace"), data,
+                            data_size))
+
+            if child:
+                stack.append((child, pointer))
+
+            pointer = next_pointer
+
+    return read, entries
+
+
+def hfa_blocks(f):
+    """
+    Lists the raster blocks of every layer in an Erdas Imagine (HFA) file. Blocks held in an
+    external spill file (.ige) aren't part of this file and are left out.
+    :param f: binary file object
+    :return: list of (block type, block index, offset, length). Block types are
+    "block:<layer name>".
+    """
+
+    read, entries = _hfa_entries(f)
+    names = {entry[0]: entry[2] for entry in entries}
+    blocks = []
+
+    for pointer, parent, name, entry_type, data, data_size in entries:
+        if entry_type == "Edms_State" and data:
+            blocks += _hfa_layer_blocks(read, data, data_size, names.get(parent, ""))
+
+    return blocks
+
+
+def _hfa_layer_blocks(read, data, data_size, layer_name, uncompressed_only=False):
+    """
+    Parses the block table of an Edms_State entry:
+    numvirtualblocks, numobjectsperblock, nextobjectnum (longs), compressionType (enum), then the
+    blockinfo pointer (count, offset) followed by the Edms_VirtualBlockInfo records
+    :param uncompressed_only: leave out run-length compressed blocks
+    :return: list of (block type, block index, offset, length)
+    """
+
+    count = struct.unpack("<I", read(data + 14, 4))[0]
+    count = min(count, max(0, (data_size - 22) // _HFA_BLOCK_INFO.size))
+    table = read(data + 22, count * _HFA_BLOCK_INFO.size)
+
+    blocks = []
+    block_type = "block:{}".format(layer_name)
+
+    for block_index in range(count):
+        file_code, offset, size, valid, compression = _HFA_BLOCK_INFO.unpack_from(
+            table, block_index * _HFA_BLOCK_INFO.size)
+
+        if file_code == 0 and valid and not (uncompressed_only and compression):
+            blocks.append((block_type, block_index, offset, size))
+
+    return blocks
+
+
+def pixel_blocks(path):
+    """
+    Finds the uncompressed pixel data of a raster and how its samples are laid out, for filters
+    that work on neighbouring pixels. Covers the full resolution image of uncompressed TIFFs with
+    8 to 64 bit samples, and the uncompressed blocks of HFA layers.
+    :param path: path to file
+    :return: list of (offset, length, numpy dtype string, samples per pixel, samples per row).
+    Empty for compressed, sub-byte and unknown rasters.
+    """
+
+    blocks = []
+
+    with open(path, 'rb') as f:
+        magic = f.read(16)
+
+        try:
+            if magic[:4] in (b"II*\0", b"MM\0*", b"II+\0", b"MM\0+"):
+                blocks = _tiff_pixel_blocks(TiffFile(f))
+            elif magic.startswith(HFA_HEADER_TAG):
+                blocks = _hfa_pixel_blocks(f)
+        except Exception:  # Damaged or unusual file
+            return []
+
+    return blocks
+
+
+def _tiff_pixel_blocks(tiff):
+    """
+    :return: pixel_blocks of the first image of a TIFF
+    """
+
+    bits = set(tiff.tag(0, BITS_PER_SAMPLE, [1]))
+    if tiff.tag(0, COMPRESSION, [1])[0] != 1 or len(bits) != 1:
+        return []
+
+    bits = bits.pop()
+    if bits not in (8, 16, 32, 64):
+        return []
+
+    item_size = bits // 8
+
+    kind = SAMPLE_KINDS.get(tiff.tag(0, SAMPLE_FORMAT, [1])[0])
+    if kind is None:
+        return []
+
+    dtype = "{0}{1}{2}".format(tiff.byte_order if item_size > 1 else "|", kind, item_size)
+    samples = tiff.tag(0, SAMPLES_PER_PIXEL, [1])[0]
+    if tiff.tag(0, PLANAR_CONFIGURATION, [1])[0] == 2:
+        samples = 1  # One plane per block
+
+    block_type, offsets, byte_counts = tiff.data_blocks(0)
+    width = tiff.tag(0, TILE_WIDTH if block_type == "tile" else IMAGE_WIDTH)[0]
+    row_size = width * samples * item_size
+
+    return [(offset, length, dtype, samples, width * samples)
+            for offset, length in zip(offsets, byte_counts)
+            if length and length % row_size == 0]
+
+
+def _hfa_pixel_blocks(f):
+    """
+    Eimg_Layer entries start with width, height (longs), layerType, pixelType (enums), blockWidth
+    and blockHeight (longs); their Edms_State child holds the block table
+    :return: pixel_blocks of every layer of an HFA file
+    """
+
+    read, entries = _hfa_entries(f)
+    layers = {}
+    for pointer, parent, name, entry_type, data, data_size in entries:
+        if entry_type == "Eimg_Layer" and data_size >= 20:
+            _, _, _, pixel_type, block_width, _ = struct.unpack("<IIHHII", read(data, 20))
+            if pixel_type in HFA_PIXEL_TYPES:
+                layers[pointer] = (HFA_PIXEL_TYPES[pixel_type], block_width)
+
+    blocks = []
+    for pointer, parent, name, entry_type, data, data_size in entries:
+        if entry_type == "Edms_State" and data and parent in layers:
+            dtype, block_width = layers[parent]
+            row_size = block_width * int(dtype[-1])
+            blocks += [(offset, length, dtype, 1, block_width)
+                       for _, _, offset, length in _hfa_layer_blocks(read, data, data_size, name,
+                                                                     uncompressed_only=True)
+                       if length and length % row_size == 0]
+
+    return blocks
+
+
+def block_layout(path, chunk_size=DEFAULT_CHUNK_SIZE, min_block_size=DEFAULT_MIN_BLOCK_SIZE):
+    """
+    Splits a file into blocks for a hash manifest. TIFF strips/tiles and HFA blocks are used where
+    they can be read; the space between them (headers, directories, metadata) becomes "other"
+    blocks, and files without a known layout are cut into fixed-size "chunk" blocks. The result
+    always covers the whole file in order, without overlaps.
+    :param path: path to file
+    :param chunk_size: size of "chunk" blocks
+    :param min_block_size: neighbouring blocks of the same type are merged up to this size, to
+    keep manifests of finely tiled mosaics to a sensible number of rows. 0 disables merging.
+    :return: list of (block type, first block index, block count, offset, length)
+    """
+
+    file_size = os.path.getsize(path)
+    blocks = []
+
+    with open(path, 'rb') as f:
+        magic = f.read(16)
+
+        try:
+            if magic[:4] in (b"II*\0", b"MM\0*", b"II+\0", b"MM\0+"):
+                blocks = tiff_blocks(f)
+            elif magic.startswith(HFA_HEADER_TAG):
+                blocks = hfa_blocks(f)
+        except Exception:
+            blocks = []  # Damaged or unusual file; fall back to plain chunks
+
+    if not blocks:
+        return [("chunk", index, 1, offset, min(chunk_size, file_size - offset))
+                for index, offset in enumerate(range(0, file_size, chunk_size))]
+
+    layout = []
+    position = 0
+
+    for block_type, block_index, offset, length in sorted(blocks, key=lambda block: block[2]):
+        start = max(offset, position)  # Clip blocks that overlap ones already placed
+        end = min(offset + length, file_size)
+        if end <= start:
+            continue
+
+        if start > position:
+            layout.append(("other", 0, 1, position, start - position))
+
+        if layout and min_block_size and layout[-1][0] == block_type and \
+                layout[-1][1] + layout[-1][2] == block_index and \
+                layout[-1][3] + layout[-1][4] == start and layout[-1][4] < min_block_size:
+            previous = layout.pop()
+            layout.append((block_type, previous[1], previous[2] + 1, previous[3],
+                           end - previous[3]))
+        else:
+            layout.append((block_type, block_index, 1, start, end - start))
+
+        position = end
+
+    if position < file_size:
+        layout.append(("other", 0, 1, position, file_size - position))
+
+    # Number the "other" blocks in file order
+    other_index = 0
+    for position, block in enumerate(layout):
+        if block[0] == "other":
+            layout[position] = ("other", other_index) + block[2:]
+            other_index += 1
+
+    return layout
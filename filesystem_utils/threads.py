@@ -0,0 +1,147 @@
+"""
+QThread workers for the GUI. Kept apart from the rest of filesystem_utils so that the scanning,
+hashing and raster code can be used without Qt.
+"""
+
+import os
+import datetime
+from PyQt4.QtCore import QThread, SIGNAL, QUrl, pyqtSignal, QObject
+from PyQt4.QtNetwork import QNetworkAccessManager, QNetworkRequest
+from filesystem_utils import hashing
+from filesystem_utils.merkle import build_directory_digests, changed_directories, \
+    removed_directories
+from filesystem_utils.pipeline import iter_directory_images
+
+
+class FileSystemWalker(QThread):
+    """
+    Traverses the FS and finds files
+    """
+
+    def __init__(self, path, image_extensions, stored_digests=None):
+        super(FileSystemWalker, self).__init__()
+        self.path = path
+        self.image_extensions = image_extensions
+        self.stored_digests = stored_digests
+        self.hash_chunksize = 4096
+
+        self.files = []
+        self.subdirs = []
+        self.digests = {}
+        self.removed = []  # Directories in stored_digests that no longer exist
+        self.file_modified_time = None
+
+    def __del__(self):
+        self.wait()
+
+    def run(self):
+        """
+        Walks paths and files, and returns sets of files and directories. If stored_digests is
+        given, only the files in directories that changed since those digests were built are
+        returned, the fresh digests are left in self.digests and the removed directories in
+        self.removed.
+        :return: sets of files and directories
+        """
+
+        if self.stored_digests is not None:
+            self.digests = build_directory_digests(self.path, self.image_extensions)
+            self.subdirs = [directory for directory in self.digests if directory != self.path]
+            self.removed = removed_directories(self.digests, self.stored_digests)
+
+            for directory in changed_directories(self.digests, self.stored_digests):
+                for image_path, _ in iter_directory_images(self.image_extensions, [directory]):
+                    self.files.append(image_path)
+
+            return self.files, self.subdirs
+
+        for root, dirs, filenames in os.walk(self.path):
+            for subdir in dirs:
+                self.subdirs.append(os.path.join(root, subdir))
+
+            for file in filenames:
+                if os.path.splitext(file)[1] in self.image_extensions:
+                    self.files.append(os.path.join(root, file))
+
+        return self.files, self.subdirs
+
+
+class FileHasher(QThread):
+    """
+    Contains the methods for hashing files and directories
+    """
+
+    def __init__(self, file, algorithm=hashing.DEFAULT_ALGORITHM):
+        super(FileHasher, self).__init__()
+        self.file = file
+        self.algorithm = algorithm
+        self.window_size = hashing.DEFAULT_WINDOW_SIZE
+
+    def __del__(self):
+        self.wait()
+
+    def run(self):
+        """
+        Hashes file with the registered algorithm given. Large local files are hashed through
+        memory-mapped windows, everything else through a reusable 1 MiB read buffer.
+        :param file: file to check
+        :return: a hex digest
+        """
+
+        return hashing.hash_file(self.file, self.algorithm, use_mmap=True,
+                                 window_size=self.window_size)
+
+
+class FileModifiedTimeGetter(QThread):
+    """
+    Contains the methods for hashing files and directories
+    """
+
+    def __init__(self, file):
+        super(FileModifiedTimeGetter, self).__init__()
+        self.file = file
+        self.file_modified_time = None
+
+    def __del__(self):
+        self.wait()
+
+    def run(self):
+        """
+        Gets last modified time for file
+        :param file: file to check
+        :return: a datetime object
+        """
+
+        self.file_modified_time = os.path.getmtime(self.file)
+        self.file_modified_time = datetime.datetime.fromtimestamp(self.file_modified_time)
+
+        return self.file_modified_time
+
+
+class FileCopier(QObject):
+    """
+    Copies files from network
+    """
+
+    finished = pyqtSignal()
+
+    def __init__(self, file):
+        super(FileCopier, self).__init__()
+        self.file = QUrl("file:///{}".format(file))
+        self.manager = QNetworkAccessManager(self)
+        self.connect(self.manager, SIGNAL("finished(QNetworkReply*)"), self.reply_finished)
+
+    def reply_finished(self, reply):
+        from ivcs import CheckoutStatusWindow  # Imported here; ivcs imports this module
+
+        checkout_class = CheckoutStatusWindow()
+        self.connect(reply, SIGNAL("downloadProgress(int, int)"), checkout_class.update_progress_bar)
+        self.reply = reply
+        checkout_class.progressBar.setMaximum(reply.size())
+
+    def run(self):
+        """
+        Start the download
+        :return: None
+        """
+        self.manager.get(QNetworkRequest(self.file))
+        self.finished.emit()
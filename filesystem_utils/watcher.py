@@ -0,0 +1,397 @@
+"""
+Watches project directories for image changes. Uses inotify on Linux, and falls back to polling
+on other platforms and on network mounts, where inotify doesn't see changes made by other hosts.
+"""
+
+import os
+import sys
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import logging
+import threading
+from filesystem_utils.pipeline import iter_image_paths
+from filesystem_utils.mounts import is_network_mount
+
+# Changelist.change_type values
+ADDED = 0
+MODIFIED = 1
+DELETED = 2
+
+# inotify constants, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+             IN_DELETE | IN_DELETE_SELF
+
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class InotifyBackend:
+    """
+    Recursive inotify watches on a set of directory trees
+    """
+
+    def __init__(self, image_extensions):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._rm_watch = libc.inotify_rm_watch
+
+        self.image_extensions = image_extensions
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self.watches = {}  # wd -> directory path
+        self.images = set()  # Images under the watches, to report when their directory goes
+        self.unwatched = []  # New trees that couldn't be watched, to be polled instead
+
+    def add_tree(self, root):
+        """
+        Adds a watch to root and every directory below it
+        :param root: directory path
+        :return: None
+        """
+
+        for directory, dirs, files in os.walk(root):
+            wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, "Could not watch {0}: {1}".format(directory,
+                                                                        os.strerror(errno)))
+            self.watches[wd] = directory
+            self.images.update(os.path.join(directory, file) for file in files
+                               if os.path.splitext(file)[1] in self.image_extensions)
+
+    def remove_tree(self, root):
+        """
+        Drops the watches on root and every directory below it, after it was moved away or deleted
+        :param root: directory path
+        :return: list of (path, DELETED) for the images that were under root
+        """
+
+        prefix = os.path.join(root, "")
+
+        for wd, directory in list(self.watches.items()):
+            if directory == root or directory.startswith(prefix):
+                del self.watches[wd]
+                self._rm_watch(self.fd, wd)  # Fails harmlessly if the kernel already dropped it
+
+        removed = [image_path for image_path in self.images if image_path.startswith(prefix)]
+        self.images.difference_update(removed)
+
+        return [(image_path, DELETED) for image_path in sorted(removed)]
+
+    def read_events(self, timeout):
+        """
+        Waits up to timeout seconds for events
+        :param timeout: seconds
+        :return: list of (path, change_type)
+        """
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        buffer = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+
+        while offset < len(buffer):
+            wd, mask, cookie, name_length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + name_length].rstrip(b"\0")
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify event queue overflowed. Some changes were missed and "
+                                "will only be picked up by a rescan.")
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+
+            if mask & (IN_IGNORED | IN_DELETE_SELF):
+                self.watches.pop(wd, None)
+                continue
+
+            path = os.path.join(directory, os.fsdecode(name))
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Watch the new tree, and report images that landed in it before the watch
+                    try:
+                        self.add_tree(path)
+                    except OSError as e:  # Usually the watch limit (fs.inotify.max_user_watches)
+                        logging.warning("Could not use inotify for {0}, polling instead. The "
+                                        "watcher returned: {1}".format(path, e))
+                        self.unwatched.append(path)
+                    events += [(image_path, ADDED) for image_path, _ in
+                               iter_image_paths(self.image_extensions, path)]
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    # Moved out of the tree, renamed (its new name arrives as IN_MOVED_TO) or
+                    # deleted. Nothing under the old path exists any more.
+                    events += self.remove_tree(path)
+                continue
+
+            if os.path.splitext(path)[1] not in self.image_extensions:
+                continue
+
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                events.append((path, ADDED))
+                self.images.add(path)
+            elif mask & (IN_MODIFY | IN_CLOSE_WRITE):
+                events.append((path, MODIFIED))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                events.append((path, DELETED))
+                self.images.discard(path)
+
+        return events
+
+    def close(self):
+        """
+        Closes the inotify file descriptor
+        :return: None
+        """
+
+        os.close(self.fd)
+
+
+class PollingBackend:
+    """
+    Finds changes by comparing stat snapshots of the directory trees
+    """
+
+    def __init__(self, image_extensions):
+        self.image_extensions = image_extensions
+        self.roots = []
+        self.snapshot = {}
+
+    def add_tree(self, root):
+        """
+        Starts polling root
+        :param root: directory path
+        :return: None
+        """
+
+        self.roots.append(root)
+        self.snapshot.update(self._take_snapshot(root))
+
+    def poll(self):
+        """
+        Compares the trees against the last snapshot
+        :return: list of (path, change_type)
+        """
+
+        current = {}
+        for root in self.roots:
+            current.update(self._take_snapshot(root))
+
+        events = []
+        for path, stat_key in current.items():
+            previous = self.snapshot.get(path)
+            if previous is None:
+                events.append((path, ADDED))
+            elif previous != stat_key:
+                events.append((path, MODIFIED))
+
+        for path in self.snapshot:
+            if path not in current:
+                events.append((path, DELETED))
+
+        self.snapshot = current
+
+        return events
+
+    def _take_snapshot(self, root):
+        """
+        Stats every image under root
+        :return: dict of {path: (size, mtime_ns, inode)}
+        """
+
+        snapshot = {}
+        for image_path, _ in iter_image_paths(self.image_extensions, root):
+            try:
+                image_stat = os.stat(image_path)
+            except OSError:  # Removed between the walk and the stat
+                continue
+            snapshot[image_path] = (image_stat.st_size, image_stat.st_mtime_ns, image_stat.st_ino)
+
+        return snapshot
+
+
+def changes_since(known_files, roots, image_extensions):
+    """
+    Compares stored stats against the directory trees, to find the changes made while nothing was
+    watching (e.g. while IVCS was closed)
+    :param known_files: dict of {image_path: (size, mtime_ns, inode, ...)} from the database
+    :param roots: directories to compare
+    :param image_extensions: list of extensions to report
+    :return: list of (path, change_type)
+    """
+
+    poller = PollingBackend(image_extensions)
+    poller.roots = list(roots)
+    poller.snapshot = {path: tuple(known_file[:3]) for path, known_file in known_files.items()}
+
+    return poller.poll()
+
+
+class DirectoryWatcher:
+    """
+    Watches directory trees and reports debounced image changes. GIS tools tend to write a
+    raster in many small bursts, so events for a path are held until it has been quiet for
+    `debounce` seconds, and bursts are collapsed into a single change.
+    """
+
+    def __init__(self, roots, image_extensions, on_changes, debounce=2.0, poll_interval=30.0,
+                 use_polling=False):
+        """
+        :param roots: directories to watch
+        :param image_extensions: list of extensions to report
+        :param on_changes: callable taking a list of (path, change_type)
+        :param debounce: seconds a path has to be quiet before its change is reported
+        :param poll_interval: seconds between scans of polled directories
+        :param use_polling: poll every root, even where inotify is available
+        """
+
+        self.image_extensions = image_extensions
+        self.on_changes = on_changes
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+
+        self.pending = {}  # path -> [change_type, time of last event]
+        self.stop_event = threading.Event()
+        self.inotify = None
+        self.poller = None
+
+        for root in roots:
+            if not use_polling and sys.platform.startswith("linux") and \
+                    not is_network_mount(root):
+                try:
+                    if self.inotify is None:
+                        self.inotify = InotifyBackend(image_extensions)
+                    self.inotify.add_tree(root)
+                    continue
+                except OSError as e:  # Usually the watch limit (fs.inotify.max_user_watches)
+                    logging.warning("Could not use inotify for {0}, polling instead. The "
+                                    "watcher returned: {1}".format(root, e))
+
+            self._poll_tree(root)
+
+    def _poll_tree(self, root):
+        """
+        Adds a directory tree to the polling backend
+        :return: None
+        """
+
+        if self.poller is None:
+            self.poller = PollingBackend(self.image_extensions)
+        self.poller.add_tree(root)
+
+    def run(self):
+        """
+        Watches until stop() is called
+        :return: None
+        """
+
+        last_poll = time.monotonic()
+        wait = min(self.debounce / 2.0, 1.0)
+
+        try:
+            while not self.stop_event.is_set():
+                events = []
+
+                if self.inotify is not None:
+                    events += self.inotify.read_events(wait)
+                    while self.inotify.unwatched:
+                        self._poll_tree(self.inotify.unwatched.pop())
+                else:
+                    self.stop_event.wait(wait)
+
+                if self.poller is not None and time.monotonic() - last_poll >= self.poll_interval:
+                    events += self.poller.poll()
+                    last_poll = time.monotonic()
+
+                now = time.monotonic()
+                for path, change_type in events:
+                    self._add_event(path, change_type, now)
+
+                self._flush(now)
+
+            self._flush(None)  # Report whatever is left on the way out
+
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+
+    def stop(self):
+        """
+        Asks run() to return
+        :return: None
+        """
+
+        self.stop_event.set()
+
+    def _add_event(self, path, change_type, now):
+        """
+        Merges an event into the pending changes for its path
+        :return: None
+        """
+
+        pending = self.pending.get(path)
+
+        if pending is None:
+            self.pending[path] = [change_type, now]
+            return
+
+        previous_type = pending[0]
+
+        if previous_type == ADDED and change_type == DELETED:
+            del self.pending[path]  # Temporary file that came and went
+            return
+        elif previous_type == ADDED:
+            change_type = ADDED
+        elif previous_type == DELETED and change_type != DELETED:
+            change_type = MODIFIED  # Replaced, e.g. written to a temp file and renamed over
+
+        self.pending[path] = [change_type, now]
+
+    def _flush(self, now):
+        """
+        Reports the changes that have been quiet for longer than the debounce time
+        :param now: current time.monotonic(), or None to report everything
+        :return: None
+        """
+
+        ready = [(path, pending[0]) for path, pending in self.pending.items()
+                 if now is None or now - pending[1] >= self.debounce]
+
+        if not ready:
+            return
+
+        for path, _ in ready:
+            del self.pending[path]
+
+        try:
+            self.on_changes(ready)
+        except Exception as e:
+            # Keep the batch and try again after another debounce. Whatever is still pending
+            # when the watcher stops is found by changes_since on the next start.
+            logging.error("Failed recording filesystem changes, retrying. on_changes returned: "
+                          "{}".format(e))
+            retry_time = time.monotonic()
+            for path, change_type in ready:
+                self.pending[path] = [change_type, retry_time]
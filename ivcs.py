@@ -12,12 +12,13 @@ import hashlib
 import datetime
 import bcrypt
 import logging
-from PyQt4.QtCore import QThread
+from PyQt4.QtCore import QThread, pyqtSignal
 from hashlib import sha1
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref, sessionmaker
-from database import ImageryDatabase, DatabaseQueries
+from database import DatabaseQueries, get_database, SchemaTooNew
+from database.pragmas import CONFIG_SECTION, DEFAULT_PRAGMAS
 from database.passwords import PasswordHash
 from gui import commit_message_window, ivcs_mainwindow, settings_window, view_message_window, \
     CheckoutStatus, ManageProjectsWindow, AddProject, ErrorMessage, NewUserRegistrationWindow, \
@@ -26,6 +27,7 @@ from PyQt4.QtGui import QFileDialog, QDialog, QLineEdit, QBrush, QAbstractItemVi
 from PyQt4.QtCore import Qt
 import compressor
 import filesystem_utils
+import filesystem_utils.threads
 
 class MainWindow(ivcs_mainwindow.QtGui.QMainWindow, ivcs_mainwindow.Ui_MainWindow):
     def __init__(self):
@@ -33,6 +35,9 @@ class MainWindow(ivcs_mainwindow.QtGui.QMainWindow, ivcs_mainwindow.Ui_MainWindo
         ivcs_mainwindow.Ui_MainWindow.__init__(self)
         self.setupUi(self)
         self.image_extensions = []
+        self.change_detection_method = None
+        self.hash_algorithm = filesystem_utils.hashing.DEFAULT_ALGORITHM
+        self.watcher_thread = None
 
         self.general_functions = filesystem_utils.GeneralFunctions()
         self.app_dir = self.general_functions.get_application_path()
@@ -69,11 +74,20 @@ class MainWindow(ivcs_mainwindow.QtGui.QMainWindow, ivcs_mainwindow.Ui_MainWindo
             self.username = self.config.get("settings", "username")
             self.image_extensions = ast.literal_eval(self.config.get("settings", "imageextensions"))
             self.storage_path = self.config.get("settings", "datapath")
+            self.hash_algorithm = read_hash_algorithm(self.config)
+            self.general_functions = filesystem_utils.GeneralFunctions(self.hash_algorithm)
 
             # Handle main window buttons
             self.CheckoutButton.clicked.connect(self.handle_checkout_button_click)
             self.UpdateAllButton.clicked.connect(self.handle_update_all_button)
 
+            # Record changes to the project directories as they happen
+            self.watcher_thread = WatcherThread(self.app_dir, self.image_extensions,
+                                                self.change_detection_method,
+                                                self.hash_algorithm)
+            self.watcher_thread.changes_recorded.connect(self.update_remote_files)
+            self.watcher_thread.start()
+
 
         # Menu Bar Actions
         self.actionSettings.triggered.connect(self.handle_settings_click)
@@ -92,13 +106,14 @@ class MainWindow(ivcs_mainwindow.QtGui.QMainWindow, ivcs_mainwindow.Ui_MainWindo
         self.update_local_files()
 
         projects = self.queries.get_all_projects()
+        tasks_by_project = self.queries.get_tasks_by_project()
 
         for project in projects:
             project_id = project[0]
             project = project[1]
             self.ProjectSelection.addItem(project)
 
-            tasks = self.queries.get_task_by_project(project_id)
+            tasks = tasks_by_project.get(project_id, [])
 
             for task in tasks:
                 self.TaskSelection.addItem(task)
@@ -117,23 +132,46 @@ class MainWindow(ivcs_mainwindow.QtGui.QMainWindow, ivcs_mainwindow.Ui_MainWindo
         """
         self.RemoteFileListView.clear()
         files = self.queries.get_all_remote_files()
-        hash_list = []
 
-        list_widget_index = 0
-        for file in files:
+        if self.watcher_thread is not None:
+            # The watcher keeps the changelist up to date, so nothing needs to be rehashed
+            changed_files = set(change[0] for change in self.queries.get_pending_changes())
+        elif self.change_detection_method == "fingerprint":
+            # Only files whose stats changed but whose fingerprint didn't need a full hash
+            changed_files, unconfirmed_files = \
+                self.general_functions.compare_fingerprints(self.queries.get_file_stats())
+            changed_files.update(self.find_changed_hashes(unconfirmed_files))
+        else:
+            changed_files = self.find_changed_hashes([file[0] for file in files])
+
+        for list_widget_index, file in enumerate(files):
             self.RemoteFileListView.addItem(file[0])
 
             # Change text color of changed files to red
-            if not self.general_functions.get_file_hash(file):
-                self.RemoteFileListView.item(list_widget_index).setSelected(True)
-
-                for item in self.RemoteFileListView.selectedItems():
-                    item.setForeground(QBrush(Qt.red, Qt.SolidPattern))
+            if file[0] in changed_files:
+                item = self.RemoteFileListView.item(list_widget_index)
+                item.setForeground(QBrush(Qt.red, Qt.SolidPattern))
 
-        list_widget_index += 1
+    def find_changed_hashes(self, paths):
+        """
+        Rehashes files with the algorithm their stored hash was made with
+        :param paths: list of image paths
+        :return: set of the paths whose hash changed
+        """
 
+        stored_hashes = self.queries.get_stored_hashes()
+        files_by_algorithm = {}
+        for path in paths:
+            algorithm = stored_hashes[path][1]
+            files_by_algorithm.setdefault(algorithm, []).append(path)
 
+        changed_files = set()
+        for algorithm, algorithm_paths in files_by_algorithm.items():
+            file_hashes = self.general_functions.get_file_hashes(algorithm_paths, algorithm)
+            changed_files.update(path for path in algorithm_paths
+                                 if file_hashes[path] != stored_hashes[path][0])
 
+        return changed_files
 
     def handle_checkout_button_click(self):
         """
@@ -181,7 +219,7 @@ class MainWindow(ivcs_mainwindow.QtGui.QMainWindow, ivcs_mainwindow.Ui_MainWindo
             for project in projects:
                 print("Projects associated with user: {}".format(project))  # TODO: Remove this after testing
 
-        #self.fs_walker = filesystem_utils.FileSystemWalker(self.storage_path, self.image_extensions)
+        #self.fs_walker = filesystem_utils.threads.FileSystemWalker(self.storage_path, self.image_extensions)
         #self.files = self.fs_walker
 
     def handle_manage_projects_click(self):
@@ -190,12 +228,25 @@ class MainWindow(ivcs_mainwindow.QtGui.QMainWindow, ivcs_mainwindow.Ui_MainWindo
         :return: None
         """
 
-        proj_window = ProjectsWindow(self.image_extensions)
+        proj_window = ProjectsWindow(self.image_extensions, self.change_detection_method,
+                                     self.hash_algorithm)
         proj_window.show()
         proj_window.exec_()
 
         self.update_remote_files()
 
+    def closeEvent(self, event):
+        """
+        Stops the filesystem watcher when the window is closed
+        :return: None
+        """
+
+        if self.watcher_thread is not None:
+            self.watcher_thread.stop()
+            self.watcher_thread.wait()
+
+        event.accept()
+
 
 class SettingsWindow(settings_window.QtGui.QDialog, settings_window.Ui_Dialog):
     """
@@ -210,6 +261,7 @@ class SettingsWindow(settings_window.QtGui.QDialog, settings_window.Ui_Dialog):
         self.username = None
         self.storage_path = None
         self.change_detection_method = None
+        self.hash_algorithm = None
 
         self.setFixedSize(self.size())  # Prevent resizing
 
@@ -226,9 +278,12 @@ class SettingsWindow(settings_window.QtGui.QDialog, settings_window.Ui_Dialog):
         self.username = self.config.get("settings", "username")
         self.image_extensions = ast.literal_eval(self.config.get("settings", "imageextensions"))
         self.storage_path = self.config.get("settings", "datapath")
+        self.hash_algorithm = read_hash_algorithm(self.config)
 
         if self.change_detection_method == "hash":
             self.UseChecksums.setChecked(True)
+        elif self.change_detection_method == "fingerprint":
+            self.UseFingerprint.setChecked(True)
         elif self.change_detection_method == "modification_time":
             self.UseOSModifiedDate.setChecked(True)
         else:
@@ -261,6 +316,8 @@ class SettingsWindow(settings_window.QtGui.QDialog, settings_window.Ui_Dialog):
 
         if self.UseChecksums.isChecked():
             self.change_detection_method = "hash"
+        elif self.UseFingerprint.isChecked():
+            self.change_detection_method = "fingerprint"
         elif self.UseOSModifiedDate.isChecked():
             self.change_detection_method = "modification_time"
 
@@ -274,7 +331,7 @@ class SettingsWindow(settings_window.QtGui.QDialog, settings_window.Ui_Dialog):
         self.storage_path = self.DataStoragePathEntry.text()
 
         # Make sure all fields contain a value before writing to file
-        if self.UseChecksums or self.UseOSModifiedDate:
+        if self.UseChecksums or self.UseFingerprint or self.UseOSModifiedDate:
             if self.ImgExtensionCheckBox or self.TifExtensionCheckBox:
                 if len(self.UserNameEntry.text()) >= 2:
                     if len(self.DataStoragePathEntry.text()) >= 2:
@@ -296,6 +353,7 @@ class SettingsWindow(settings_window.QtGui.QDialog, settings_window.Ui_Dialog):
         self.config['settings'] = {"username": self.username,
                                    "ImageExtensions": self.image_extensions,
                                    "ChangeDetectMethod": self.change_detection_method,
+                                   "HashAlgorithm": self.hash_algorithm,
                                    "DataPath": self.storage_path}
 
         with open(self.config_file_path, 'w') as configfile:
@@ -307,9 +365,11 @@ class SettingsWindow(settings_window.QtGui.QDialog, settings_window.Ui_Dialog):
 class ProjectsWindow(ManageProjectsWindow.QtGui.QDialog,
                      ManageProjectsWindow.Ui_ManageProjectsWindow):
 
-    def __init__(self, image_extensions):
+    def __init__(self, image_extensions, change_detection_method="hash", hash_algorithm=None):
         super(ProjectsWindow, self).__init__()
         self.image_extensions = image_extensions
+        self.change_detection_method = change_detection_method
+        self.hash_algorithm = hash_algorithm
         ManageProjectsWindow.QtGui.QDialog.__init__(self)
         ManageProjectsWindow.Ui_ManageProjectsWindow.__init__(self)
         self.setupUi(self)
@@ -320,13 +380,11 @@ class ProjectsWindow(ManageProjectsWindow.QtGui.QDialog,
         self.setFixedSize(self.size())  # Prevent resizing
 
         # Set the global application path
-        self.general_functions = filesystem_utils.GeneralFunctions()
+        self.general_functions = filesystem_utils.GeneralFunctions(self.hash_algorithm)
         self.app_dir = self.general_functions.get_application_path()
 
         # Get list of projects
         self.queries = DatabaseQueries(self.app_dir)
-        db = ImageryDatabase(self.app_dir)
-        db_session = db.load_session()
 
         self.projects = self.queries.get_all_projects()
 
@@ -411,40 +469,64 @@ class ProjectsWindow(ManageProjectsWindow.QtGui.QDialog,
 
         new_directory_id = self.queries.add_project_directory(project, directory)
 
-        """Get a list of images in directory with correct extensions. The function returns a tuple
-        that looks like this:
+        if new_directory_id is None:
+            # Directory is already part of the project, so only pick up what changed on disk
+            directory_id = self.queries.get_directory_id(project_id, directory)
+            digests, directories, removed_directories = \
+                self.general_functions.get_changed_directories(
+                    self.image_extensions, directory,
+                    self.queries.get_directory_digests(directory_id))
+
+            if not directories and not removed_directories:
+                logging.info("Nothing changed under {}".format(directory))
+                self.update_directories_list(project_id)
+                return
+
+            if removed_directories:
+                removed_images = self.queries.mark_directories_removed(directory_id,
+                                                                       removed_directories)
+                logging.info("{0} directories with {1} images were removed from {2}".format(
+                    len(removed_directories), removed_images, directory))
+
+            known_files = self.queries.get_file_stats(directory_id)
+        else:
+            directory_id = new_directory_id
+            digests, directories, _ = self.general_functions.get_changed_directories(
+                self.image_extensions, directory, {})
+            known_files = {}
 
-        (image_path, image_extension, image_size, image_hash, image_modification_time,
-        image_first_seen, image_last_scanned, image_on_disk)
-
-        """
-        images = self.general_functions.search_for_images(self.image_extensions, directory)
-
-        for image in images:
-            image_path = image[0]
-            image_extension = image[1]
-            image_size = image[2]
-            image_hash = image[3]
-            image_modification_time = image[4]
-            image_first_seen = image[5]
-            image_last_scanned = image[6]
-            image_on_disk = image[7]
-
-            image_metadata = {
-                'project_id':               project_id,
-                'directory_id':             new_directory_id,
-                'image_path':               image_path,
-                'image_extension':          image_extension,
-                'image_size':               image_size,
-                'image_hash':               image_hash,
-                'image_modification_time':  image_modification_time,
-                'image_first_seen':         image_first_seen,
-                'image_last_scanned':       image_last_scanned,
-                'image_on_disk':            image_on_disk
-            }
+        """Stream the new or changed images in directory with correct extensions into the
+        database in batches. Each image is a tuple that looks like this:
 
-            self.queries.add_file_to_database(image_metadata)
+        (image_path, image_extension, image_size, image_hash, image_modification_time,
+        image_first_seen, image_last_scanned, image_on_disk, image_mtime_ns, image_inode,
+        block_manifest, hash_algorithm, image_fingerprint)
 
+        """
+        batches = self.general_functions.stream_images(self.image_extensions, directory,
+                                                       known_files,
+                                                       self.change_detection_method,
+                                                       directories=directories)
+
+        for images in batches:
+            new_images = []
+            changed_images = []
+
+            for image in images:
+                file_info = image_metadata(image, project_id, directory_id)
+
+                if file_info['image_path'] in known_files:
+                    changed_images.append(file_info)
+                else:
+                    new_images.append(file_info)
+
+            if new_images:
+                self.queries.add_files_to_database(new_images)
+            if changed_images:
+                self.queries.update_files_in_database(changed_images)
+
+        # Saved last, so an interrupted scan is repeated in full next time
+        self.queries.save_directory_digests(directory_id, digests)
         self.update_directories_list(project_id)
 
     def handle_project_clicked(self):
@@ -650,14 +732,20 @@ class CheckoutStatusWindow(CheckoutStatus.QtGui.QDialog, CheckoutStatus.Ui_Check
 
     def update_progress_bar(self, read, total):
         """
-        Updates the progress bar
+        Updates the progress bar. Used as the progress callback of network copies and of the
+        streaming compressor functions.
         :param read: Amount read (int)
-        :param total: Total length(int)
+        :param total: Total length(int). Unknown if None or below 1.
         :return: None
         """
 
-        print("Read: {}".format(read))
-        print("Total: {}".format(total))
+        if total is None or total < 1:
+            self.progressBar.setMaximum(0)  # Busy indicator
+            return
+
+        # Scaled to a percentage, as QProgressBar only takes 32 bit values
+        self.progressBar.setMaximum(100)
+        self.progressBar.setValue(int(read * 100 / total))
 
 
 class UserLoginWindow(LoginWindow.QtGui.QDialog, LoginWindow.Ui_LoginWIndow):
@@ -866,6 +954,118 @@ class IoThread(QThread):
         initialize_config(self.path)
 
 
+class WatcherThread(QThread):
+    """
+    Watches the project directories and writes changes to the database as they happen
+    """
+
+    changes_recorded = pyqtSignal()
+
+    def __init__(self, path, image_extensions, change_detection_method, hash_algorithm):
+        QThread.__init__(self)
+        self.path = path
+        self.image_extensions = image_extensions
+        self.change_detection_method = change_detection_method
+        self.hash_algorithm = hash_algorithm
+        self.stopped = False
+        self.watcher = None
+        self.queries = None
+        self.general_functions = None
+        self.directories = []
+
+    def __del__(self):
+        self.wait()
+
+    def run(self):
+        # The database session is created here so that it is only used from this thread
+        self.queries = DatabaseQueries(self.path)
+        self.general_functions = filesystem_utils.GeneralFunctions(self.hash_algorithm)
+        self.directories = self.queries.get_all_directories()
+        roots = [directory[2] for directory in self.directories]
+
+        self.watcher = filesystem_utils.DirectoryWatcher(roots, self.image_extensions,
+                                                         self.record_changes)
+
+        try:
+            # Pick up what changed while IVCS was closed. The watches are already in place, so
+            # nothing that changes from here on is missed.
+            self.record_changes(filesystem_utils.watcher.changes_since(
+                self.queries.get_file_stats(), roots, self.image_extensions))
+
+            if not self.stopped:
+                self.watcher.run()
+        finally:
+            self.queries.database.remove_session()
+
+    def stop(self):
+        """
+        Stops watching
+        :return: None
+        """
+
+        self.stopped = True
+        if self.watcher is not None:
+            self.watcher.stop()
+
+    def record_changes(self, changes):
+        """
+        Writes a batch of debounced changes from the watcher to the database
+        :param changes: list of (path, change_type)
+        :return: None
+        """
+
+        for path, change_type in changes:
+            directory = self.find_directory(path)
+            if directory is None:
+                continue
+
+            directory_id, project_id, root = directory
+
+            if change_type == filesystem_utils.watcher.DELETED:
+                file_info = {'project_id': project_id, 'directory_id': directory_id,
+                             'image_path': path}
+            else:
+                try:
+                    image_stat = os.stat(path)
+                except OSError:  # Already gone again
+                    continue
+
+                image_hash = None
+                block_manifest = None
+                image_fingerprint = self.general_functions.get_fingerprint(path)
+
+                # The watcher saw the write, so in fingerprint mode there is nothing to confirm
+                if self.change_detection_method == "hash" or \
+                        (change_type == filesystem_utils.watcher.ADDED and
+                         self.change_detection_method == "modification_time"):
+                    image_hash, block_manifest = self.general_functions.get_block_manifest(path)
+
+                image = filesystem_utils.build_image_result(path, os.path.splitext(path)[1],
+                                                            image_stat, image_hash,
+                                                            block_manifest, self.hash_algorithm,
+                                                            image_fingerprint)
+                file_info = image_metadata(image, project_id, directory_id)
+
+            self.queries.record_file_change(change_type, file_info)
+
+        self.changes_recorded.emit()
+
+    def find_directory(self, path):
+        """
+        Finds the project directory that contains path
+        :return: (directory_id, project_id, root), or None
+        """
+
+        best_match = None
+
+        for directory in self.directories:
+            root = os.path.join(directory[2], '')
+            if path.startswith(root) and (best_match is None or len(root) > len(best_match[2])):
+                best_match = directory
+
+        return best_match
+
+
 def initialize_config(path):
     """
     Sets up a new config file, or loads one if it already exists at the exe directory
@@ -880,20 +1080,83 @@ def initialize_config(path):
     # Set default options
     config['settings'] = {"ImageExtensions": ['.img', '.tif'],
                           "ChangeDetectMethod": "modification_time",
+                          "HashAlgorithm": filesystem_utils.hashing.fastest_algorithm(),
                           "Username": "UNSET",
                           "datapath": "~"}
+    config[CONFIG_SECTION] = DEFAULT_PRAGMAS  # SQLite connection profile
 
     with open(config_file_path, 'w') as configfile:
         config.write(configfile)
 
 
+def read_hash_algorithm(config):
+    """
+    Reads the hash algorithm from the configuration, falling back to the default if it is missing
+    or not available on this machine (e.g. xxh3_64 without the xxhash package)
+    :param config: ConfigParser
+    :return: algorithm name
+    """
+
+    algorithm = config.get("settings", "hashalgorithm",
+                           fallback=filesystem_utils.hashing.DEFAULT_ALGORITHM)
+
+    if algorithm not in filesystem_utils.hashing.HASH_ALGORITHMS:
+        logging.error("Hash algorithm '{0}' in the configuration file is not available. Using "
+                      "{1} instead.".format(algorithm, filesystem_utils.hashing.DEFAULT_ALGORITHM))
+        algorithm = filesystem_utils.hashing.DEFAULT_ALGORITHM
+
+    return algorithm
+
+
+def image_metadata(image, project_id, directory_id):
+    """
+    Converts an image tuple from a scan into the dict used by the database
+    :param image: image tuple from a scan (see filesystem_utils.build_image_result)
+    :return: dict
+    """
+
+    image_path = image[0]
+    image_extension = image[1]
+    image_size = image[2]
+    image_hash = image[3]
+    image_modification_time = image[4]
+    image_first_seen = image[5]
+    image_last_scanned = image[6]
+    image_on_disk = image[7]
+    image_mtime_ns = image[8]
+    image_inode = image[9]
+    image_block_manifest = image[10]
+    image_hash_algorithm = image[11]
+    image_fingerprint = image[12]
+
+    file_info = {
+        'project_id':               project_id,
+        'directory_id':             directory_id,
+        'image_path':               image_path,
+        'image_extension':          image_extension,
+        'image_size':               image_size,
+        'image_hash':               image_hash,
+        'image_hash_algorithm':     image_hash_algorithm,
+        'image_modification_time':  image_modification_time,
+        'image_first_seen':         image_first_seen,
+        'image_last_scanned':       image_last_scanned,
+        'image_on_disk':            image_on_disk,
+        'image_mtime_ns':           image_mtime_ns,
+        'image_inode':              image_inode,
+        'image_block_manifest':     image_block_manifest,
+        'image_fingerprint':        image_fingerprint
+    }
+
+    return file_info
+
+
 def db_init(path):
     """
     Initializes the database
     :return: SQLAlchemy session object
     """
 
-    imagery_database = ImageryDatabase(path)
+    imagery_database = get_database(path)
     db_session = imagery_database.load_session()  # Get the session object
 
     logging.info("Initialized database at {}".format(path))
@@ -960,7 +1223,7 @@ def main():
     logging.info("IVCS started.")
 
     # TESTING
-    io = filesystem_utils.FileCopier("/Users/rwardrup/Downloads/pycharm-professional-2016.2.3.dmg")
+    io = filesystem_utils.threads.FileCopier("/Users/rwardrup/Downloads/pycharm-professional-2016.2.3.dmg")
     io.run()
 
     general_functions = filesystem_utils.GeneralFunctions()
@@ -974,6 +1237,14 @@ def main():
 
     # Instantiate the first windows
     login = LoginWindow.QtGui.QApplication(sys.argv)
+
+    try:
+        get_database(app_dir)
+    except SchemaTooNew as e:
+        logging.error(e)
+        raise_error_window(str(e))
+        return
+
     login_window = UserLoginWindow()
     login_window.show()
     login.exec_()
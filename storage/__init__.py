@@ -0,0 +1,192 @@
+"""
+Stores image versions in the repository. Versions are written as binary deltas against their
+parent where that pays off, with a full snapshot (keyframe) at regular intervals so that
+rebuilding any version only has to apply a short chain of deltas.
+
+Every version is an object in a content-addressed ObjectStore, keyed by the hash of the image
+content, so Versions.path_to_version points into the store and identical images are only stored
+once. A delta object records the key of its parent and its chain depth in its header, which is
+all restore() needs to rebuild it.
+"""
+
+import os
+import shutil
+import logging
+from compressor.delta import encode_delta, apply_delta, DeltaTooLarge, DEFAULT_BLOCK_SIZE, \
+    DEFAULT_MAX_RATIO
+from compressor.roi import open_random_access, extract_window, FileReader
+from storage.objects import ObjectStore
+
+FULL = "full"
+DELTA = "delta"
+DEFAULT_KEYFRAME_INTERVAL = 10  # At most this many deltas between full snapshots
+OBJECTS_DIRECTORY = "objects"
+
+
+class VersionStore:
+    """
+    Writes and rebuilds versions under a repository directory
+    """
+
+    def __init__(self, root, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL,
+                 max_delta_ratio=DEFAULT_MAX_RATIO, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        :param root: repository directory
+        :param keyframe_interval: a full snapshot is stored once a chain has this many deltas
+        :param max_delta_ratio: a full snapshot is stored if more than this share of a version
+        differs from its parent
+        :param block_size: block size deltas are computed with
+        """
+
+        self.root = root
+        self.keyframe_interval = keyframe_interval
+        self.max_delta_ratio = max_delta_ratio
+        self.block_size = block_size
+        self.objects = ObjectStore(os.path.join(root, OBJECTS_DIRECTORY))
+
+    def store(self, source, parent=None, digest=None, seekable=False):
+        """
+        Stores a new version of a file. Content that is already in the store isn't read or
+        written again.
+        :param source: path of the new version
+        :param parent: path_to_version of the parent version, or None for the first version
+        :param digest: content key (ObjectStore.hash_file) of source, if already known. An
+        unchanged file then costs a single existence check. Only pass an Imagery.image_hash whose
+        image_hash_algorithm is the store's (sha256); other digests raise ValueError.
+        :param seekable: store a full snapshot in a block container, so windows of it can be
+        checked out with restore_window without decompressing the whole raster
+        :return: (path_to_version, storage_type, chain_depth)
+        """
+
+        digest = self.objects.check_key(digest) if digest is not None else \
+            self.objects.hash_file(source)
+
+        if self.objects.contains(digest):
+            logging.info("{} is already stored".format(source))
+            return (self.objects.object_path(digest),) + self.describe(digest)
+
+        if parent is not None and not seekable:
+            parent_digest = self.objects.digest_of(parent)
+            chain_depth = self.describe(parent_digest)[1] + 1
+
+            if chain_depth < self.keyframe_interval:
+                try:
+                    return self._store_delta(source, digest, parent_digest, chain_depth), \
+                        DELTA, chain_depth
+                except DeltaTooLarge as e:
+                    logging.info("Storing a full snapshot of {0}. {1}".format(source, e))
+
+        return self.objects.put_file(source, digest, seekable=seekable)[1], FULL, 0
+
+    def _store_delta(self, source, digest, parent_digest, chain_depth):
+        """
+        Writes source as a delta object against a stored parent
+        :return: path of the object
+        """
+
+        parent_copy = self.objects.temporary_path()
+        temporary = self.objects.temporary_path()
+
+        try:
+            self.restore(self.objects.object_path(parent_digest), parent_copy)
+            encode_delta(parent_copy, source, temporary, self.block_size, self.max_delta_ratio,
+                         metadata={"chain_depth": chain_depth,
+                                   "delta": {"parent": parent_digest}})
+            return self.objects.add(temporary, digest)
+        finally:
+            for path in (parent_copy, temporary):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def describe(self, digest):
+        """
+        Reads how an object is stored
+        :param digest: object key
+        :return: (storage_type, chain_depth)
+        """
+
+        metadata = self.objects.read_metadata(digest) or {}
+
+        if "delta" in metadata:
+            return DELTA, metadata.get("chain_depth", 1)
+
+        return FULL, 0
+
+    def restore(self, path_to_version, destination):
+        """
+        Rebuilds a version by decompressing its full snapshot and applying the deltas after it
+        :param path_to_version: path of the version's object
+        :param destination: path of the file to write
+        :return: None
+        """
+
+        # Follow the parent keys back to the full snapshot
+        chain = [self.objects.digest_of(path_to_version)]
+        while True:
+            metadata = self.objects.read_metadata(chain[-1]) or {}
+            if "delta" not in metadata:
+                break
+            if metadata["delta"]["parent"] in chain:
+                raise ValueError("Delta chain of {} doesn't end in a full snapshot".format(
+                    path_to_version))
+            chain.append(metadata["delta"]["parent"])
+
+        chain.reverse()
+
+        current = self.objects.temporary_path()
+        self.objects.get_file(chain[0], current)
+
+        try:
+            for digest in chain[1:]:
+                rebuilt = self.objects.temporary_path()
+                try:
+                    with self.objects.open_object(digest) as f_delta:
+                        apply_delta(current, f_delta, rebuilt)
+                except Exception:
+                    if os.path.exists(rebuilt):
+                        os.remove(rebuilt)
+                    raise
+                finally:
+                    os.remove(current)
+                current = rebuilt
+
+            shutil.move(current, destination)
+        finally:
+            if os.path.exists(current):
+                os.remove(current)
+
+    def restore_window(self, path_to_version, destination, window=None, tiles=None):
+        """
+        Checks out part of a TIFF version (see compressor.roi.extract_window). Versions stored
+        with seekable=True only have the blocks covering the window decompressed; anything else
+        is rebuilt in full first.
+        :param path_to_version: path of the version's object
+        :param destination: path of the TIFF to write
+        :param window: (x offset, y offset, width, height) in pixels
+        :param tiles: tile or strip indices, instead of a window
+        :return: (x offset, y offset, width, height) of the written image within the version
+        """
+
+        path = self.objects.object_path(self.objects.digest_of(path_to_version))
+
+        if os.path.exists(path):
+            try:
+                reader = open_random_access(path)
+            except ValueError:
+                reader = None
+
+            if reader is not None:
+                with reader:
+                    return extract_window(reader, destination, window, tiles)
+
+        logging.info("{} isn't seekable; rebuilding it in full for the window".format(
+            path_to_version))
+
+        rebuilt = self.objects.temporary_path()
+        try:
+            self.restore(path_to_version, rebuilt)
+            with FileReader(rebuilt) as reader:
+                return extract_window(reader, destination, window, tiles)
+        finally:
+            if os.path.exists(rebuilt):
+                os.remove(rebuilt)
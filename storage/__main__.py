@@ -0,0 +1,48 @@
+"""
+Command line tools for an IVCS repository:
+
+    python -m storage repack <repository>
+"""
+
+import sys
+import logging
+import argparse
+from storage import VersionStore
+from storage.packs import repack, DEFAULT_MAX_OBJECT_SIZE
+
+
+def main(arguments=None):
+    """
+    Command line entry point
+    :return: exit code
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m storage",
+                                     description="Pack the small objects of an IVCS repository")
+    subparsers = parser.add_subparsers(dest="command")
+    repack_parser = subparsers.add_parser("repack", help="move small loose objects into a pack")
+    repack_parser.add_argument("repository", help="repository directory")
+    repack_parser.add_argument("--max-size", type=int, default=DEFAULT_MAX_OBJECT_SIZE,
+                               help="largest object to pack, in bytes (default: %(default)s)")
+    repack_parser.add_argument("--keep-loose", action="store_true",
+                               help="leave the loose objects in place")
+    arguments = parser.parse_args(arguments)
+
+    if arguments.command != "repack":
+        parser.print_help()
+        return 1
+
+    logging.basicConfig(level=logging.INFO)
+    store = VersionStore(arguments.repository)
+    pack_path = repack(store.objects, arguments.max_size, not arguments.keep_loose)
+
+    if pack_path is None:
+        print("Nothing to pack")
+    else:
+        print(pack_path)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
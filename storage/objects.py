@@ -0,0 +1,277 @@
+"""
+Content-addressed object store. Objects are keyed by the hash of their uncompressed content and
+sharded into fan-out directories, so identical images in different projects or directories are
+stored once, and storing content that is already there costs a single existence check.
+Small objects can be moved into packfiles by storage.packs.repack; lookups check the loose
+objects first, then the packs.
+"""
+
+import io
+import os
+import uuid
+import hashlib
+import compressor
+from compressor.codecs import read_header
+from storage.packs import load_packs, PACKS_DIRECTORY
+
+DEFAULT_ALGORITHM = "sha256"
+DEFAULT_FAN_OUT = 1  # Levels of two-character directories: objects/ab/cdef...
+TEMPORARY_DIRECTORY = "tmp"
+
+
+class ObjectStore:
+    """
+    Objects under a directory, written atomically: each one is built in a temporary file and
+    renamed into place, so readers never see a partial object
+    """
+
+    def __init__(self, root, algorithm=DEFAULT_ALGORITHM, fan_out=DEFAULT_FAN_OUT):
+        """
+        :param root: directory the objects are stored in
+        :param algorithm: hashlib algorithm the keys are made with
+        :param fan_out: number of directory levels objects are sharded into
+        """
+
+        self.root = root
+        self.algorithm = algorithm
+        self.fan_out = fan_out
+        self._packs = None
+
+        os.makedirs(os.path.join(root, TEMPORARY_DIRECTORY), exist_ok=True)
+
+    def hash_file(self, path, buffer_size=1024 * 1024):
+        """
+        Makes the key of a file's content
+        :param path: path to file
+        :return: hex digest
+        """
+
+        hasher = hashlib.new(self.algorithm)
+
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(buffer_size), b""):
+                hasher.update(chunk)
+
+        return hasher.hexdigest()
+
+    def check_key(self, digest):
+        """
+        Checks that a digest given by a caller is a key of this store. A digest made with another
+        algorithm, e.g. an Imagery.image_hash from xxh3_64, would file the content under a key
+        that can collide and that lookups by content never find.
+        :param digest: hex digest
+        :return: digest, lowercased. Raises ValueError if it isn't a hex digest of the store's
+        algorithm.
+        """
+
+        digest_size = hashlib.new(self.algorithm).digest_size
+
+        try:
+            key = bytes.fromhex(digest)
+        except (TypeError, ValueError):
+            key = None
+
+        if key is None or len(key) != digest_size or len(digest) != digest_size * 2:
+            raise ValueError("{0!r} is not a {1} digest, which is what this store's objects are "
+                             "keyed by".format(digest, self.algorithm))
+
+        return digest.lower()
+
+    def object_path(self, digest):
+        """
+        Gets the path an object is stored at
+        :param digest: object key
+        :return: path
+        """
+
+        shards = [digest[level * 2:level * 2 + 2] for level in range(self.fan_out)]
+
+        return os.path.join(self.root, *(shards + [digest[self.fan_out * 2:]]))
+
+    def digest_of(self, path):
+        """
+        Gets the key of an object from its path
+        :param path: path returned by object_path
+        :return: object key
+        """
+
+        parts = []
+        for _ in range(self.fan_out + 1):
+            path, part = os.path.split(path)
+            parts.append(part)
+
+        return "".join(reversed(parts))
+
+    @property
+    def packs(self):
+        """
+        Packs of the store, opened on first use
+        """
+
+        if self._packs is None:
+            self._packs = load_packs(self.root)
+
+        return self._packs
+
+    def reload_packs(self):
+        """
+        Reopens the packs, e.g. after a repack
+        :return: None
+        """
+
+        for pack in self._packs or []:
+            pack.close()
+
+        self._packs = None
+
+    def find_pack(self, digest):
+        """
+        Finds the pack an object is in
+        :param digest: object key
+        :return: Pack, or None if the object isn't packed
+        """
+
+        for pack in self.packs:
+            if pack.contains(digest):
+                return pack
+
+        return None
+
+    def contains(self, digest):
+        """
+        Checks whether an object is stored, loose or packed
+        :param digest: object key
+        :return: Bool
+        """
+
+        return os.path.exists(self.object_path(digest)) or self.find_pack(digest) is not None
+
+    def iter_loose(self):
+        """
+        Lists the objects that aren't packed
+        :return: generator of (object key, path)
+        """
+
+        for directory, directories, files in os.walk(self.root):
+            if directory == self.root:
+                directories[:] = [name for name in directories
+                                  if name not in (TEMPORARY_DIRECTORY, PACKS_DIRECTORY)]
+                depth = 0
+            else:
+                depth = os.path.relpath(directory, self.root).count(os.sep) + 1
+
+            if depth != self.fan_out:
+                continue
+
+            for name in files:
+                path = os.path.join(directory, name)
+                yield self.digest_of(path), path
+
+    def open_object(self, digest):
+        """
+        Opens an object for reading
+        :param digest: object key
+        :return: binary file object at the start of the object
+        """
+
+        try:
+            return open(self.object_path(digest), 'rb')
+        except FileNotFoundError:
+            pack = self.find_pack(digest)
+            if pack is None:
+                # Another process may have packed it since the packs were opened
+                self.reload_packs()
+                pack = self.find_pack(digest)
+            if pack is None:
+                raise
+
+        return io.BytesIO(pack.read(digest))
+
+    def temporary_path(self):
+        """
+        Gets a path to build an object in. It is on the same filesystem as the objects, so
+        add() can rename it into place.
+        :return: path
+        """
+
+        return os.path.join(self.root, TEMPORARY_DIRECTORY, uuid.uuid4().hex)
+
+    def add(self, temporary, digest):
+        """
+        Moves a finished object into place. If another writer stored the same content first,
+        the temporary file is dropped.
+        :param temporary: path from temporary_path
+        :param digest: object key
+        :return: path of the object
+        """
+
+        destination = self.object_path(digest)
+
+        if self.contains(digest):
+            os.remove(temporary)
+            return destination
+
+        with open(temporary, 'r+b') as f:
+            os.fsync(f.fileno())  # The rename must not land before the data
+
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(temporary, destination)
+
+        return destination
+
+    def put_file(self, path, digest=None, progress=None, seekable=False):
+        """
+        Stores the content of a file, compressed with an automatically chosen codec
+        :param path: path to file
+        :param digest: key of the content if already known, which saves reading the file when
+        the object exists. Has to be made with the store's algorithm (see check_key).
+        :param progress: callable taking (bytes read, total bytes)
+        :param seekable: store it as a block container, so parts of it can be read without
+        decompressing the rest (see compressor.roi)
+        :return: (object key, path of the object, True if it was added)
+        """
+
+        digest = self.check_key(digest) if digest is not None else self.hash_file(path)
+
+        if self.contains(digest):
+            return digest, self.object_path(digest), False
+
+        temporary = self.temporary_path()
+        try:
+            if seekable:
+                compressor.compress_container(path, temporary, progress=progress)
+            else:
+                compressor.compress_file(path, temporary, progress=progress)
+        except Exception:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+        return digest, self.add(temporary, digest), True
+
+    def read_metadata(self, digest):
+        """
+        Reads the compressor header of an object
+        :param digest: object key
+        :return: metadata dict, or None for objects without a header
+        """
+
+        with self.open_object(digest) as f:
+            return read_header(f)
+
+    def get_file(self, digest, destination, progress=None):
+        """
+        Decompresses a full object. Deltas have to be rebuilt by VersionStore.restore.
+        :param digest: object key
+        :param destination: path of the file to write
+        :param progress: callable taking (compressed bytes read, compressed total)
+        :return: None
+        """
+
+        path = self.object_path(digest)
+        if os.path.exists(path) and compressor.is_block_container(path):
+            compressor.decompress_container(path, destination, progress=progress)
+            return
+
+        with self.open_object(digest) as f:
+            compressor.decompress_file(f, destination, progress=progress)
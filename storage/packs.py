@@ -0,0 +1,241 @@
+"""
+Packfiles: many small objects in one file, with a sorted fixed-width index that is searched
+through mmap. Keeps projects with hundreds of thousands of sidecars and thumbnails from turning
+into millions of inodes, and lets a bulk checkout read one file instead of many.
+
+Pack (pack-<name>.pack):
+
+    PACK_MAGIC, version (B), 3 bytes padding, object count (Q), then the objects back to back,
+    byte for byte as they were stored loose
+
+Index (pack-<name>.idx):
+
+    INDEX_MAGIC, version (B), digest size (B), 2 bytes padding, object count (Q)
+    fan-out table: 256 x I, entry i is the number of objects whose key starts with a byte <= i
+    entries sorted by key: key (digest size bytes), offset (Q), length (Q)
+
+Run `python -m storage repack <repository>` to pack the loose objects of a repository.
+"""
+
+import os
+import mmap
+import bisect
+import struct
+import hashlib
+import logging
+from compressor.container import is_block_container
+
+PACK_MAGIC = b"IVCP"
+INDEX_MAGIC = b"IVCI"
+VERSION = 1
+PACKS_DIRECTORY = "packs"
+DEFAULT_MAX_OBJECT_SIZE = 1024 * 1024  # Larger objects stay loose
+
+_PACK_HEADER = struct.Struct("<4sB3xQ")
+_INDEX_HEADER = struct.Struct("<4sBB2xQ")
+_FAN_OUT = struct.Struct("<256I")
+_LOCATION = struct.Struct("<QQ")
+
+
+class _IndexKeys:
+    """
+    Sequence view of the keys in an index, so bisect can search the mmap directly
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.count
+
+    def __getitem__(self, position):
+        start = self.index.entries_offset + position * self.index.entry_size
+        return self.index.map[start:start + self.index.digest_size]
+
+
+class PackIndex:
+    """
+    Memory-mapped pack index
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.digest_size, self.count = _INDEX_HEADER.unpack_from(self.map, 0)
+        if magic != INDEX_MAGIC or version > VERSION:
+            self.map.close()
+            raise ValueError("{} is not a pack index this version can read".format(path))
+
+        self.fan_out = _FAN_OUT.unpack_from(self.map, _INDEX_HEADER.size)
+        self.entries_offset = _INDEX_HEADER.size + _FAN_OUT.size
+        self.entry_size = self.digest_size + _LOCATION.size
+        self.keys = _IndexKeys(self)
+
+    def close(self):
+        self.map.close()
+
+    def find(self, digest):
+        """
+        Looks up an object
+        :param digest: hex object key
+        :return: (offset, length) in the pack, or None
+        """
+
+        key = bytes.fromhex(digest)
+        if len(key) != self.digest_size:
+            return None
+
+        low = self.fan_out[key[0] - 1] if key[0] else 0
+        position = bisect.bisect_left(self.keys, key, low, self.fan_out[key[0]])
+
+        if position < self.count and self.keys[position] == key:
+            start = self.entries_offset + position * self.entry_size + self.digest_size
+            return _LOCATION.unpack_from(self.map, start)
+
+        return None
+
+    def __iter__(self):
+        """
+        Yields the hex keys of every object, in order
+        """
+
+        for position in range(self.count):
+            yield self.keys[position].hex()
+
+
+class Pack:
+    """
+    A packfile and its index
+    """
+
+    def __init__(self, pack_path):
+        self.pack_path = pack_path
+        self.index = PackIndex(os.path.splitext(pack_path)[0] + ".idx")
+
+    def close(self):
+        self.index.close()
+
+    def contains(self, digest):
+        return self.index.find(digest) is not None
+
+    def read(self, digest):
+        """
+        Reads an object
+        :param digest: hex object key
+        :return: bytes, exactly as the object was stored loose
+        """
+
+        location = self.index.find(digest)
+        if location is None:
+            raise KeyError(digest)
+
+        offset, length = location
+        with open(self.pack_path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+
+def load_packs(root):
+    """
+    Opens every pack in an object store. Packs without an index are unfinished and skipped.
+    :param root: object store directory
+    :return: list of Pack
+    """
+
+    directory = os.path.join(root, PACKS_DIRECTORY)
+    if not os.path.isdir(directory):
+        return []
+
+    packs = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".pack") and \
+                os.path.exists(os.path.join(directory, name[:-len(".pack")] + ".idx")):
+            packs.append(Pack(os.path.join(directory, name)))
+
+    return packs
+
+
+def write_pack(objects, directory, digest_size):
+    """
+    Writes a pack and its index
+    :param objects: list of (hex key, path of the loose object)
+    :param directory: directory to write the pack into
+    :param digest_size: size of the keys in bytes
+    :return: path of the pack
+    """
+
+    objects = sorted(objects)
+    name = hashlib.sha1("".join(digest for digest, _ in objects).encode("ascii")).hexdigest()
+    pack_path = os.path.join(directory, "pack-{}.pack".format(name))
+    index_path = os.path.join(directory, "pack-{}.idx".format(name))
+    entries = []
+
+    with open(pack_path + ".tmp", 'wb') as f_pack:
+        f_pack.write(_PACK_HEADER.pack(PACK_MAGIC, VERSION, len(objects)))
+
+        for digest, path in objects:
+            with open(path, 'rb') as f_object:
+                data = f_object.read()
+            entries.append((bytes.fromhex(digest), f_pack.tell(), len(data)))
+            f_pack.write(data)
+
+        f_pack.flush()
+        os.fsync(f_pack.fileno())
+
+    fan_out = [0] * 256
+    for key, _, _ in entries:
+        fan_out[key[0]] += 1
+    for byte in range(1, 256):
+        fan_out[byte] += fan_out[byte - 1]
+
+    with open(index_path + ".tmp", 'wb') as f_index:
+        f_index.write(_INDEX_HEADER.pack(INDEX_MAGIC, VERSION, digest_size, len(entries)))
+        f_index.write(_FAN_OUT.pack(*fan_out))
+        for key, offset, length in entries:
+            f_index.write(key + _LOCATION.pack(offset, length))
+
+        f_index.flush()
+        os.fsync(f_index.fileno())
+
+    # The index goes in last, so a pack is only used once it is complete
+    os.replace(pack_path + ".tmp", pack_path)
+    os.replace(index_path + ".tmp", index_path)
+
+    return pack_path
+
+
+def repack(object_store, max_object_size=DEFAULT_MAX_OBJECT_SIZE, delete_loose=True):
+    """
+    Moves the small loose objects of a store into a new pack
+    :param object_store: storage.objects.ObjectStore
+    :param max_object_size: objects larger than this (stored size) stay loose
+    :param delete_loose: remove the loose copies once the pack is in place
+    :return: path of the new pack, or None if there was nothing to pack
+    """
+
+    # Block containers are read through their path, so they stay loose
+    objects = [(digest, path) for digest, path in object_store.iter_loose()
+               if os.path.getsize(path) <= max_object_size and not is_block_container(path)]
+
+    if not objects:
+        return None
+
+    directory = os.path.join(object_store.root, PACKS_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+
+    pack_path = write_pack(objects, directory, hashlib.new(object_store.algorithm).digest_size)
+    object_store.reload_packs()
+    logging.info("Packed {0} objects into {1}".format(len(objects), pack_path))
+
+    if delete_loose:
+        for digest, path in objects:
+            os.remove(path)
+            try:
+                os.rmdir(os.path.dirname(path))  # Only succeeds once the shard is empty
+            except OSError:
+                pass
+
+    return pack_path
@@ -0,0 +1,98 @@
+"""
+bulk_add_files: ids assigned up front, block manifests written with them, and several writers
+adding files to the same database at once
+"""
+
+import threading
+from database import DatabaseQueries
+from database.models import Projects, Directories, Imagery
+
+PROJECT_ID, DIRECTORY_ID = 1, 1
+MANIFEST = [("chunk", 0, 1, 0, 4, "hash 0"), ("chunk", 1, 1, 4, 2, "hash 1")]
+
+
+def file_info(path, manifest=None):
+    return {"project_id": PROJECT_ID, "directory_id": DIRECTORY_ID, "image_path": path,
+            "image_extension": ".tif", "image_size": 6, "image_hash": None,
+            "image_hash_algorithm": None, "image_modification_time": None,
+            "image_first_seen": None, "image_last_scanned": None, "image_on_disk": True,
+            "image_mtime_ns": 0, "image_inode": 0, "image_block_manifest": manifest}
+
+
+def make_database(path):
+    """
+    :return: DatabaseQueries on a database with one project and directory
+    """
+
+    queries = DatabaseQueries(path)
+    queries.session.add(Projects(id=PROJECT_ID, name="project"))
+    queries.session.add(Directories(id=DIRECTORY_ID, project_id=PROJECT_ID, root="/images"))
+    queries.session.commit()
+
+    return queries
+
+
+def stored_paths(queries):
+    """
+    :return: dict of Imagery id: image_path
+    """
+
+    return dict(queries.session.query(Imagery.id, Imagery.image_path))
+
+
+def test_ids_continue_after_the_highest_id_across_batches(tmp_path):
+    queries = make_database(str(tmp_path))
+    queries.bulk_add_files([file_info("/images/first.tif"), file_info("/images/moved.tif")])
+    queries.session.query(Imagery).filter_by(id=2).update({"id": 7})  # Ids 2 to 6 are free
+    queries.session.commit()
+
+    paths = ["/images/{}.tif".format(index) for index in range(5)]
+    ids = queries.bulk_add_files([file_info(path, MANIFEST if index == 3 else None)
+                                  for index, path in enumerate(paths)], batch_size=2)
+
+    assert ids == [8, 9, 10, 11, 12]
+    assert stored_paths(queries) == \
+        dict([(1, "/images/first.tif"), (7, "/images/moved.tif")] + list(zip(ids, paths)))
+    assert queries.get_block_manifest(11) == MANIFEST
+    assert queries.get_block_manifest(10) == []
+
+
+def test_empty_input_adds_nothing(tmp_path):
+    queries = make_database(str(tmp_path))
+
+    assert queries.bulk_add_files(iter([])) == []
+    assert stored_paths(queries) == {}
+
+
+def test_concurrent_writers_get_distinct_ids(tmp_path):
+    path = str(tmp_path)
+    make_database(path)
+    results, errors = {}, []
+
+    def add_files(writer):
+        queries = DatabaseQueries(path)  # A session, and connection, of this thread
+        try:
+            results[writer] = []
+            for batch in range(10):
+                results[writer] += queries.bulk_add_files(
+                    [file_info("/images/{0}-{1}-{2}.tif".format(writer, batch, index))
+                     for index in range(5)], batch_size=2)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            queries.database.remove_session()
+
+    threads = [threading.Thread(target=add_files, args=(writer,)) for writer in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+
+    ids = [image_id for writer_ids in results.values() for image_id in writer_ids]
+    stored = stored_paths(DatabaseQueries(path))
+
+    assert errors == []
+    assert sorted(ids) == list(range(1, 201))
+    for writer, writer_ids in results.items():
+        assert all(stored[image_id].startswith("/images/{}-".format(writer))
+                   for image_id in writer_ids)
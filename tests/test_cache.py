@@ -0,0 +1,142 @@
+"""
+LookupCache: entries expire, misses and failed loads aren't stored, and invalidation drops only the
+lookups it names. The DatabaseQueries lookups see rows added elsewhere once their entry expires.
+"""
+
+import pytest
+import database.cache as cache
+from database import DatabaseQueries, ImageryDatabase
+from database.cache import LookupCache
+from database.models import Projects, Users
+
+TTL = 5.0
+
+
+class Clock:
+    """
+    Stands in for the time module, so tests move time.monotonic forward instead of sleeping
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+
+class Loader:
+    """
+    Returns its value and counts the calls
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+def test_entries_expire_after_the_ttl(clock):
+    lookups = LookupCache(ttl=TTL)
+    load = Loader(1)
+
+    lookups.get("project_id", "a", load)
+    clock.now += TTL - 0.1
+    lookups.get("project_id", "a", load)
+    load.value = 2
+    clock.now += 0.2
+
+    assert lookups.get("project_id", "a", load) == 2
+    assert load.calls == 2
+    assert lookups.stats() == {"project_id": (1, 2)}
+
+
+def test_misses_and_failed_loads_are_not_stored(clock):
+    lookups = LookupCache(ttl=TTL)
+    missing = Loader(None)
+
+    def failing_load():
+        raise RuntimeError("database is locked")
+
+    assert lookups.get("user", "nobody", missing) is None
+    assert lookups.get("user", "nobody", missing) is None
+    with pytest.raises(RuntimeError):
+        lookups.get("task", "task", failing_load)
+
+    assert missing.calls == 2
+    assert lookups.get("task", "task", Loader(3)) == 3
+
+
+def test_invalidate_drops_only_the_named_lookups(clock):
+    lookups = LookupCache(ttl=TTL)
+    for lookup in ("project_id", "all_projects", "user"):
+        lookups.get(lookup, "a", Loader(lookup))
+
+    lookups.invalidate("project_id", "all_projects")
+    loads = {lookup: Loader(lookup) for lookup in ("project_id", "all_projects", "user")}
+    for lookup, load in loads.items():
+        lookups.get(lookup, "a", load)
+
+    assert {lookup: load.calls for lookup, load in loads.items()} == \
+        {"project_id": 1, "all_projects": 1, "user": 0}
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    lookups = LookupCache(max_size=2, ttl=TTL)
+    lookups.get("user", "a", Loader(1))
+    lookups.get("user", "b", Loader(2))
+    lookups.get("user", "a", Loader(None))  # Hit; "b" is now the oldest
+    lookups.get("user", "c", Loader(3))
+
+    assert lookups.get("user", "a", Loader(None)) == 1
+    assert lookups.get("user", "b", Loader(None)) is None
+
+
+def test_project_added_elsewhere_is_found_once_the_entry_expires(tmp_path, clock):
+    path = str(tmp_path)
+    queries = DatabaseQueries(path)
+    queries.add_new_project("first")
+    other_workstation = ImageryDatabase(path).load_session()  # Its own engine and cache
+
+    assert queries.get_all_projects() == [(1, "first")]
+    other_workstation.add(Projects(name="second"))
+    other_workstation.commit()
+    other_workstation.close()
+    cached = queries.get_all_projects()
+    clock.now += TTL + 1
+
+    assert cached == [(1, "first")]
+    assert queries.get_all_projects() == [(1, "first"), (2, "second")]
+    assert queries.get_project_id_by_name("second") == 2
+
+
+def test_local_changes_invalidate_right_away(tmp_path, clock):
+    queries = DatabaseQueries(str(tmp_path))
+    queries.add_new_project("first")
+    queries.get_all_projects()
+
+    queries.delete_project("first")
+    queries.add_new_project("second")
+
+    assert [name for _, name in queries.get_all_projects()] == ["second"]
+    assert queries.get_project_id_by_name("second") == \
+        queries.session.query(Projects.id).filter_by(name="second").scalar()
+
+
+def test_user_that_missed_is_found_once_added(tmp_path, clock):
+    queries = DatabaseQueries(str(tmp_path))
+
+    assert queries.query_users("someone") is ValueError
+    queries.session.add(Users(username="someone", email="someone@example.com"))
+    queries.session.commit()
+
+    assert queries.query_users("someone").username == "someone"
@@ -0,0 +1,91 @@
+"""
+Round trips through the compressed file formats: compress_file's header + codec stream, and the
+IVCB block container
+"""
+
+import os
+import pytest
+import compressor
+from compressor.container import compress_container, decompress_container, BlockReader, \
+    is_block_container
+
+BLOCK_SIZE = 4096
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+SAMPLES = {
+    "empty": b"",
+    "one byte": b"x",
+    "one block": os.urandom(BLOCK_SIZE),
+    "blocks and a bit": os.urandom(BLOCK_SIZE) + b"\0" * (2 * BLOCK_SIZE) + b"tail",
+    "text": b"imagery version control " * 5000,
+}
+
+
+@pytest.mark.parametrize("name", sorted(SAMPLES))
+def test_compress_file_round_trip(tmp_path, name):
+    source = write(tmp_path / "source", SAMPLES[name])
+
+    compressor.compress_file(source, str(tmp_path / "compressed"))
+    compressor.decompress_file(str(tmp_path / "compressed"), str(tmp_path / "restored"))
+
+    assert read(tmp_path / "restored") == SAMPLES[name]
+
+
+@pytest.mark.parametrize("codec", ["lzma", "store"])
+def test_compress_file_round_trip_with_codec(tmp_path, codec):
+    data = SAMPLES["blocks and a bit"]
+    source = write(tmp_path / "source", data)
+
+    metadata = compressor.compress_file(source, str(tmp_path / "compressed"), codec=codec)
+    compressor.decompress_file(str(tmp_path / "compressed"), str(tmp_path / "restored"))
+
+    assert metadata["codec"] == codec
+    assert read(tmp_path / "restored") == data
+
+
+@pytest.mark.parametrize("name", sorted(SAMPLES))
+def test_container_round_trip(tmp_path, name):
+    data = SAMPLES[name]
+    source = write(tmp_path / "source", data)
+    container = str(tmp_path / "container")
+
+    blocks = compress_container(source, container, block_size=BLOCK_SIZE, workers=1)
+    decompress_container(container, str(tmp_path / "restored"), workers=1)
+
+    assert is_block_container(container)
+    assert blocks == -(-len(data) // BLOCK_SIZE)
+    assert read(tmp_path / "restored") == data
+
+
+def test_container_read_at(tmp_path):
+    data = SAMPLES["blocks and a bit"]
+    source = write(tmp_path / "source", data)
+    container = str(tmp_path / "container")
+    compress_container(source, container, block_size=BLOCK_SIZE, workers=1)
+
+    with BlockReader(container) as reader:
+        assert reader.size == len(data)
+        assert reader.read_at(0, len(data)) == data
+        assert reader.read_at(BLOCK_SIZE - 10, 20) == data[BLOCK_SIZE - 10:BLOCK_SIZE + 10]
+        assert reader.read_at(BLOCK_SIZE, BLOCK_SIZE) == data[BLOCK_SIZE:2 * BLOCK_SIZE]
+        assert reader.read_at(len(data) - 2, 100) == data[-2:]
+        assert reader.read_at(len(data), 10) == b""
+
+
+def test_compressed_file_is_not_a_container(tmp_path):
+    source = write(tmp_path / "source", SAMPLES["text"])
+    compressor.compress_file(source, str(tmp_path / "compressed"))
+
+    assert not is_block_container(source)
+    assert not is_block_container(str(tmp_path / "compressed"))
@@ -0,0 +1,102 @@
+"""
+Round trips through binary deltas: apply_delta(parent, encode_delta(parent, target)) == target
+"""
+
+import os
+import pytest
+from compressor.codecs import ChunkReader
+from compressor.delta import encode_delta, apply_delta, DeltaTooLarge
+
+BLOCK_SIZE = 1024
+PARENT = os.urandom(BLOCK_SIZE * 8 + 100)
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+TARGETS = {
+    "unchanged": PARENT,
+    "one block changed": PARENT[:BLOCK_SIZE * 3] + os.urandom(BLOCK_SIZE) +
+                         PARENT[BLOCK_SIZE * 4:],
+    "shifted": b"inserted" + PARENT,
+    "appended": PARENT + os.urandom(300),
+    "truncated": PARENT[:BLOCK_SIZE * 5 + 17],
+    "exactly one block": PARENT[:BLOCK_SIZE],
+    "empty": b"",
+}
+
+
+def round_trip(tmp_path, parent_data, target_data, **options):
+    parent = write(tmp_path / "parent", parent_data)
+    target = write(tmp_path / "target", target_data)
+    delta = str(tmp_path / "delta")
+    restored = str(tmp_path / "restored")
+
+    metadata = encode_delta(parent, target, delta, block_size=BLOCK_SIZE, **options)
+    apply_delta(parent, delta, restored)
+
+    return metadata, read(restored)
+
+
+@pytest.mark.parametrize("name", sorted(TARGETS))
+def test_delta_round_trip(tmp_path, name):
+    metadata, restored = round_trip(tmp_path, PARENT, TARGETS[name], max_ratio=None)
+
+    assert restored == TARGETS[name]
+    assert metadata["size"] == len(TARGETS[name])
+
+
+@pytest.mark.parametrize("parent_data", [b"", PARENT[:BLOCK_SIZE]])
+def test_delta_against_small_parent(tmp_path, parent_data):
+    target_data = PARENT[:BLOCK_SIZE] + b"more"
+
+    _, restored = round_trip(tmp_path, parent_data, target_data, max_ratio=None)
+
+    assert restored == target_data
+
+
+def test_unchanged_delta_is_small(tmp_path):
+    round_trip(tmp_path, PARENT, PARENT, max_ratio=None)
+
+    assert os.path.getsize(str(tmp_path / "delta")) < BLOCK_SIZE
+
+
+def test_unrelated_target_is_too_large(tmp_path):
+    parent = write(tmp_path / "parent", PARENT)
+    target = write(tmp_path / "target", os.urandom(len(PARENT)))
+    delta = str(tmp_path / "delta")
+
+    with pytest.raises(DeltaTooLarge):
+        encode_delta(parent, target, delta, block_size=BLOCK_SIZE, max_ratio=0.5)
+
+    assert not os.path.exists(delta)
+
+
+def test_wrong_parent_is_rejected(tmp_path):
+    parent = write(tmp_path / "parent", PARENT)
+    target = write(tmp_path / "target", TARGETS["one block changed"])
+    encode_delta(parent, target, str(tmp_path / "delta"), block_size=BLOCK_SIZE)
+
+    with pytest.raises(ValueError):
+        apply_delta(write(tmp_path / "other", PARENT[:-1]), str(tmp_path / "delta"),
+                    str(tmp_path / "restored"))
+
+
+@pytest.mark.parametrize("length", [1, 7, 1000, 5000])
+def test_chunk_reader_reads_across_pieces(length):
+    data = os.urandom(10000)
+    reader = ChunkReader(data[start:start + 3000] for start in range(0, len(data), 3000))
+
+    chunks = list(iter(lambda: reader.read(length), b""))
+
+    assert b"".join(chunks) == data
+    assert all(len(chunk) == length for chunk in chunks[:-1])
+    assert reader.read(length) == b""
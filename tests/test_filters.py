@@ -0,0 +1,151 @@
+"""
+Round trips through the raster pre-filters: uncompressed TIFF strips are filtered, compressed,
+and restored byte for byte
+"""
+
+import struct
+import logging
+import pytest
+import compressor
+import compressor.filters as filters
+
+# TIFF tags written by write_tiff
+IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, COMPRESSION, PHOTOMETRIC = 256, 257, 258, 259, 262
+STRIP_OFFSETS, SAMPLES_PER_PIXEL, ROWS_PER_STRIP, STRIP_BYTE_COUNTS = 273, 277, 278, 279
+SAMPLE_FORMAT = 339
+SHORT, LONG = 3, 4
+
+
+def write_tiff(path, pixels, rows_per_strip=3):
+    """
+    Writes an uncompressed, striped TIFF in the byte order of the pixels' dtype
+    :param pixels: numpy array of (rows, columns) or (rows, columns, samples), with an explicit
+    byte order for samples wider than a byte
+    :return: path
+    """
+
+    numpy = pytest.importorskip("numpy")
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, numpy.newaxis]
+    rows, columns, samples = pixels.shape
+    dtype = pixels.dtype
+    big_endian = dtype.byteorder == ">"
+    order = ">" if big_endian else "<"
+
+    row_size = columns * samples * dtype.itemsize
+    strip_rows = [min(rows_per_strip, rows - row) for row in range(0, rows, rows_per_strip)]
+    data = pixels.tobytes()
+    data_offset = 8
+
+    tags = [(IMAGE_WIDTH, LONG, [columns]), (IMAGE_LENGTH, LONG, [rows]),
+            (BITS_PER_SAMPLE, SHORT, [dtype.itemsize * 8] * samples), (COMPRESSION, SHORT, [1]),
+            (PHOTOMETRIC, SHORT, [1]),
+            (STRIP_OFFSETS, LONG, [data_offset + row * row_size
+                                   for row in range(0, rows, rows_per_strip)]),
+            (SAMPLES_PER_PIXEL, SHORT, [samples]), (ROWS_PER_STRIP, LONG, [rows_per_strip]),
+            (STRIP_BYTE_COUNTS, LONG, [strip * row_size for strip in strip_rows]),
+            (SAMPLE_FORMAT, SHORT, [{"u": 1, "i": 2, "f": 3}[dtype.kind]] * samples)]
+
+    ifd_offset = data_offset + len(data)
+    extra_offset = ifd_offset + 2 + 12 * len(tags) + 4
+    entries, extra = b"", b""
+
+    for tag, field_type, values in tags:
+        packed = struct.pack("{0}{1}{2}".format(order, len(values), "H" if field_type == SHORT
+                                                else "I"), *values)
+        if len(packed) <= 4:
+            value = packed.ljust(4, b"\0")
+        else:
+            value = struct.pack(order + "I", extra_offset + len(extra))
+            extra += packed
+        entries += struct.pack(order + "HHI", tag, field_type, len(values)) + value
+
+    with open(path, 'wb') as f:
+        f.write((b"MM\0*" if big_endian else b"II*\0") + struct.pack(order + "I", ifd_offset))
+        f.write(data)
+        f.write(struct.pack(order + "H", len(tags)) + entries + struct.pack(order + "I", 0))
+        f.write(extra)
+
+    return str(path)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def header(path):
+    with open(path, 'rb') as f:
+        return compressor.read_header(f)
+
+
+def gradient(dtype, shape):
+    """
+    :return: smooth pixels that wrap around at the ends of integer ranges
+    """
+
+    numpy = pytest.importorskip("numpy")
+    values = numpy.arange(numpy.prod(shape), dtype="f8").reshape(shape) * 37.5
+
+    if numpy.dtype(dtype).kind == "f":
+        return numpy.sin(values / 1000.0).astype(dtype)
+
+    return (values.astype("u8") % (numpy.iinfo(dtype).max + 1)).astype(dtype)
+
+
+@pytest.mark.parametrize("dtype, shape", [
+    ("u1", (10, 33)),
+    ("<u2", (10, 33, 2)),
+    ("<f4", (7, 20)),
+    (">u2", (10, 33)),
+    (">f4", (7, 20, 2)),
+])
+def test_filtered_round_trip(tmp_path, dtype, shape):
+    source = write_tiff(tmp_path / "source.tif", gradient(dtype, shape))
+
+    spec = filters.filter_spec(source)
+    compressor.compress_file(source, str(tmp_path / "compressed"))
+    compressor.decompress_file(str(tmp_path / "compressed"), str(tmp_path / "restored"))
+
+    assert spec is not None
+    assert [region[2] for region in spec["regions"]] == \
+        [dtype if dtype[0] in "<>" else "|" + dtype]
+    assert "filter" in header(tmp_path / "compressed")
+    assert read(tmp_path / "restored") == read(source)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 100, 1024 * 1024])
+def test_filter_inverts_across_chunks(tmp_path, chunk_size):
+    source = write_tiff(tmp_path / "source.tif", gradient("<u2", (10, 33, 2)), rows_per_strip=4)
+    data = read(source)
+    spec = filters.filter_spec(source, chunk_size=chunk_size)
+
+    filtered = b"".join(filters.iter_filter(iter([data]), spec, len(data)))
+    pieces = (filtered[start:start + 7] for start in range(0, len(filtered), 7))
+    restored = b"".join(filters.iter_unfilter(pieces, spec, len(data)))
+
+    assert filtered != data
+    assert restored == data
+
+
+def test_without_numpy_rasters_are_compressed_unfiltered(tmp_path, monkeypatch, caplog):
+    source = str(tmp_path / "source.tif")
+    with open(source, 'wb') as f:  # One 4x4 strip of 8 bit samples, little-endian
+        f.write(b"II*\0" + struct.pack("<I", 24) + bytes(range(16)))
+        f.write(struct.pack("<H", 6))
+        for tag, field_type, value in [(IMAGE_WIDTH, LONG, 4), (IMAGE_LENGTH, LONG, 4),
+                                       (BITS_PER_SAMPLE, SHORT, 8), (COMPRESSION, SHORT, 1),
+                                       (STRIP_OFFSETS, LONG, 8), (STRIP_BYTE_COUNTS, LONG, 16)]:
+            f.write(struct.pack("<HHII", tag, field_type, 1, value))
+        f.write(struct.pack("<I", 0))
+    monkeypatch.setattr(filters, "numpy", None)
+    monkeypatch.setattr(filters, "_missing_numpy_logged", False)
+
+    with caplog.at_level(logging.WARNING):
+        compressor.compress_file(source, str(tmp_path / "compressed"))
+        compressor.compress_file(source, str(tmp_path / "compressed again"))
+    compressor.decompress_file(str(tmp_path / "compressed"), str(tmp_path / "restored"))
+
+    assert "filter" not in header(tmp_path / "compressed")
+    assert read(tmp_path / "restored") == read(source)
+    assert len([record for record in caplog.records if "NumPy" in record.getMessage()]) == 1
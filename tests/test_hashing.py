@@ -0,0 +1,94 @@
+"""
+HashingEngine and hash_file: every read path (buffered reads and memory-mapped windows) gives the
+same digest as hashing the whole content at once
+"""
+
+import os
+import mmap
+import hashlib
+import pytest
+from filesystem_utils import hashing
+from filesystem_utils.hashing import HashingEngine, hash_file
+
+BUFFER_SIZE = 4096
+WINDOW_SIZE = mmap.ALLOCATIONGRANULARITY
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+SIZES = {
+    "empty": 0,
+    "one byte": 1,
+    "one buffer": BUFFER_SIZE,
+    "over the mmap threshold": BUFFER_SIZE + 1,
+    "several windows and a bit": WINDOW_SIZE * 3 + 123,
+}
+
+
+@pytest.fixture
+def mmap_calls(monkeypatch):
+    """
+    Counts the files hashed through memory-mapped windows
+    """
+
+    calls = []
+    original = hashing._hash_mmap
+
+    def counting_hash_mmap(f, hasher, window_size):
+        calls.append(window_size)
+        return original(f, hasher, window_size)
+
+    monkeypatch.setattr(hashing, "_hash_mmap", counting_hash_mmap)
+
+    return calls
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+@pytest.mark.parametrize("name", sorted(SIZES))
+def test_hash_file_matches_hashlib(tmp_path, mmap_calls, name, use_mmap):
+    data = os.urandom(SIZES[name])
+    path = write(tmp_path / "file", data)
+
+    digest = hash_file(path, "sha256", BUFFER_SIZE, use_mmap, WINDOW_SIZE)
+
+    assert digest == hashlib.sha256(data).hexdigest()
+    # Only files larger than one buffer are mapped
+    assert len(mmap_calls) == (1 if use_mmap and len(data) > BUFFER_SIZE else 0)
+
+
+@pytest.mark.parametrize("algorithm", sorted(hashing.HASH_ALGORITHMS))
+def test_algorithms_agree_across_read_paths(tmp_path, algorithm):
+    path = write(tmp_path / "file", os.urandom(WINDOW_SIZE * 2 + 7))
+
+    read = hash_file(path, algorithm, BUFFER_SIZE, use_mmap=False)
+    mapped = hash_file(path, algorithm, BUFFER_SIZE, use_mmap=True, window_size=WINDOW_SIZE)
+    empty = hash_file(write(tmp_path / "empty", b""), algorithm, use_mmap=True)
+
+    assert read == mapped
+    assert empty == hashing.new_hasher(algorithm).hexdigest()
+
+
+def test_unknown_algorithm_is_rejected():
+    with pytest.raises(ValueError):
+        HashingEngine(algorithm="no such algorithm")
+
+
+@pytest.mark.parametrize("use_processes", [False, True])
+def test_engine_hashes_batches_in_parallel(tmp_path, use_processes):
+    contents = {write(tmp_path / "file {}".format(index), os.urandom(index * 5000)): index
+                for index in range(6)}
+    missing = str(tmp_path / "missing")
+    engine = HashingEngine(workers=3, algorithm="sha256", buffer_size=BUFFER_SIZE,
+                           use_processes=use_processes, window_size=WINDOW_SIZE)
+
+    digests = engine.hash_files(list(contents) + [missing])
+
+    assert digests.pop(missing) is None
+    for path, digest in digests.items():
+        with open(path, 'rb') as f:
+            assert digest == hashlib.sha256(f.read()).hexdigest()
+    assert digests == {path: engine.hash_file(path) for path in contents}
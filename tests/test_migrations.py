@@ -0,0 +1,105 @@
+"""
+Databases created by older versions of IVCS have to open and work after an upgrade
+"""
+
+import os
+import sqlite3
+import pytest
+from database import ImageryDatabase, DatabaseQueries, SchemaTooNew
+from database.base import Base
+from database.migrations import ADDED_COLUMNS, SCHEMA_VERSION
+import database.models as models
+
+# Imagery and Versions as the first released schema created them. Frozen: a column added to
+# either model has to come with a migration, not an edit here.
+BASELINE_TABLES = {
+    "Imagery": """
+        CREATE TABLE "Imagery" (
+            id INTEGER NOT NULL, project_id INTEGER, directory_id INTEGER, image_path VARCHAR,
+            image_extension VARCHAR, image_size FLOAT, image_hash VARCHAR,
+            image_modified_time DATETIME, image_first_seen DATETIME, image_last_scanned DATETIME,
+            image_on_disk BOOLEAN, PRIMARY KEY (id))
+    """,
+    "Versions": """
+        CREATE TABLE "Versions" (
+            id INTEGER NOT NULL, uuid VARCHAR NOT NULL, project_id INTEGER,
+            directory_id INTEGER, image_id INTEGER, change_id VARCHAR, checkout_id INTEGER,
+            path_to_version VARCHAR, commit_message VARCHAR, PRIMARY KEY (id, uuid))
+    """,
+}
+
+
+def create_baseline_database(path):
+    """
+    Writes an ivcs.db with the baseline Imagery and Versions tables and one row in Imagery
+    :return: path of ivcs.db
+    """
+
+    db_path = os.path.join(path, "ivcs.db")
+    connection = sqlite3.connect(db_path)
+
+    for statement in BASELINE_TABLES.values():
+        connection.execute(statement)
+    connection.execute("INSERT INTO Imagery (id, project_id, directory_id, image_path, image_hash) "
+                       "VALUES (1, 1, 1, '/data/a.tif', 'abc')")
+    connection.commit()
+    connection.close()
+
+    return db_path
+
+
+def test_new_columns_have_migrations():
+    connection = sqlite3.connect(":memory:")
+
+    for table_name, statement in BASELINE_TABLES.items():
+        connection.execute(statement)
+        baseline_columns = {row[1] for row in
+                            connection.execute('PRAGMA table_info("{}")'.format(table_name))}
+        model_columns = set(Base.metadata.tables[table_name].c.keys())
+
+        assert model_columns - baseline_columns == set(ADDED_COLUMNS[table_name])
+
+    connection.close()
+
+
+def test_baseline_database_opens_and_queries(tmp_path):
+    db_path = create_baseline_database(str(tmp_path))
+
+    queries = DatabaseQueries(str(tmp_path))
+
+    assert queries.get_all_remote_files() == [("/data/a.tif", 1)]
+    assert queries.get_file_stats()["/data/a.tif"][3] == "abc"
+    assert queries.get_stored_hashes() == {"/data/a.tif": ("abc", "sha1")}
+    for model in (models.Imagery, models.Versions, models.ImageryBlocks, models.DirectoryDigests):
+        queries.session.query(model).all()
+
+    connection = sqlite3.connect(db_path)
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    connection.close()
+
+
+def test_up_to_date_database_reopens(tmp_path):
+    ImageryDatabase(str(tmp_path))
+
+    database = ImageryDatabase(str(tmp_path))
+
+    assert database.load_session().query(models.Imagery).all() == []
+
+
+def test_newer_database_is_not_opened(tmp_path):
+    db_path = create_baseline_database(str(tmp_path))
+    connection = sqlite3.connect(db_path)
+    connection.execute("PRAGMA user_version = {:d}".format(SCHEMA_VERSION + 1))
+    connection.commit()
+    connection.close()
+
+    with pytest.raises(SchemaTooNew):
+        ImageryDatabase(str(tmp_path))
+
+    connection = sqlite3.connect(db_path)
+    columns = {row[1] for row in connection.execute('PRAGMA table_info("Imagery")')}
+    tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master "
+                                                   "WHERE type = 'table'")}
+    connection.close()
+    assert not columns & set(ADDED_COLUMNS["Imagery"])
+    assert tables == set(BASELINE_TABLES)
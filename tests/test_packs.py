@@ -0,0 +1,167 @@
+"""
+Round trips through the object store and packfiles: objects read back the same loose and packed
+"""
+
+import os
+import hashlib
+import pytest
+from storage import VersionStore
+from storage.objects import ObjectStore
+from storage.packs import write_pack, repack, Pack, load_packs
+
+DIGEST_SIZE = 20
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def key(first_byte, fill):
+    """
+    :return: hex key starting with first_byte, then DIGEST_SIZE - 1 bytes of fill
+    """
+
+    return (bytes([first_byte]) + bytes([fill]) * (DIGEST_SIZE - 1)).hex()
+
+
+# Keys at both ends of the key space and on both sides of bucket boundaries, with bucket 0x7f
+# holding several keys and most buckets empty
+PACKED_KEYS = [key(0x00, 0x10), key(0x00, 0x20), key(0x7f, 0x00), key(0x7f, 0x80),
+               key(0x7f, 0xff), key(0x80, 0x00), key(0xff, 0xff)]
+
+
+@pytest.fixture
+def pack(tmp_path):
+    objects = []
+    for index, digest in enumerate(PACKED_KEYS):
+        objects.append((digest, write(tmp_path / digest, "object {}".format(index).encode())))
+    objects.append((key(0x42, 0x42), write(tmp_path / "empty", b"")))
+
+    pack = Pack(write_pack(objects, str(tmp_path), DIGEST_SIZE))
+    yield pack
+    pack.close()
+
+
+def test_pack_round_trip(pack):
+    for index, digest in enumerate(PACKED_KEYS):
+        assert pack.read(digest) == "object {}".format(index).encode()
+
+    assert pack.read(key(0x42, 0x42)) == b""
+    assert sorted(pack.index) == sorted(PACKED_KEYS + [key(0x42, 0x42)])
+
+
+@pytest.mark.parametrize("digest", [
+    key(0x00, 0x00),  # Before the first key
+    key(0x00, 0x30),  # After the last key of the first bucket
+    key(0x01, 0x00),  # Empty bucket right after a full one
+    key(0x7e, 0xff),  # Empty bucket right before a full one
+    key(0x7f, 0x01),  # Between keys of one bucket
+    key(0x80, 0x01),  # After the only key of a bucket
+    key(0xfe, 0xff),  # Empty bucket before the last one
+    key(0xff, 0xfe),  # Before the last key
+    key(0xff, 0xff)[:-2] + "00",
+])
+def test_pack_lookup_misses(pack, digest):
+    assert pack.index.find(digest) is None
+    assert not pack.contains(digest)
+    with pytest.raises(KeyError):
+        pack.read(digest)
+
+
+def test_pack_rejects_wrong_key_size(pack):
+    assert pack.index.find(PACKED_KEYS[0][:-2]) is None
+
+
+def test_repack_round_trip(tmp_path):
+    store = ObjectStore(str(tmp_path / "objects"))
+    contents = [b"", b"x", os.urandom(5000), b"sidecar " * 1000]
+    digests = [store.put_file(write(tmp_path / "source{}".format(index), data))[0]
+               for index, data in enumerate(contents)]
+
+    pack_path = repack(store)
+
+    assert pack_path is not None
+    assert list(store.iter_loose()) == []
+    assert repack(store) is None  # Nothing left to pack
+
+    for digest, data in zip(digests, contents):
+        assert store.contains(digest)
+        store.get_file(digest, str(tmp_path / "restored"))
+        assert read(tmp_path / "restored") == data
+
+
+def test_repack_keeps_large_objects_loose(tmp_path):
+    store = ObjectStore(str(tmp_path / "objects"))
+    small = store.put_file(write(tmp_path / "small", b"small"))[0]
+    large = store.put_file(write(tmp_path / "large", os.urandom(4096)))[0]
+
+    repack(store, max_object_size=1024)
+
+    assert [digest for digest, _ in store.iter_loose()] == [large]
+    assert store.find_pack(small) is not None
+
+
+def test_store_sees_packs_written_by_another_store(tmp_path):
+    root = str(tmp_path / "objects")
+    reader = ObjectStore(root)
+    writer = ObjectStore(root)
+    digest = writer.put_file(write(tmp_path / "source", b"packed elsewhere"))[0]
+    assert reader.packs == []
+
+    repack(writer)
+    reader.get_file(digest, str(tmp_path / "restored"))
+
+    assert read(tmp_path / "restored") == b"packed elsewhere"
+    assert len(load_packs(root)) == 1
+
+
+def test_packed_version_chain_round_trip(tmp_path):
+    versions = VersionStore(str(tmp_path / "repository"), keyframe_interval=3)
+    data = bytearray(os.urandom(256 * 1024))
+    parent = None
+    stored = []
+
+    for version in range(5):
+        data[version * 1000:version * 1000 + 16] = os.urandom(16)
+        source = write(tmp_path / "v{}".format(version), bytes(data))
+        parent, storage_type, chain_depth = versions.store(source, parent)
+        stored.append((parent, storage_type, bytes(data)))
+
+    repack(versions.objects)
+
+    assert [storage_type for _, storage_type, _ in stored] == \
+        ["full", "delta", "delta", "full", "delta"]
+    for path_to_version, _, expected in stored:
+        versions.restore(path_to_version, str(tmp_path / "restored"))
+        assert read(tmp_path / "restored") == expected
+
+
+def test_version_store_uses_a_known_sha256_digest(tmp_path):
+    versions = VersionStore(str(tmp_path / "repository"))
+    source = write(tmp_path / "source", b"known content")
+    digest = hashlib.sha256(b"known content").hexdigest()
+
+    path_to_version = versions.store(source, digest=digest.upper())[0]
+
+    assert versions.objects.digest_of(path_to_version) == digest
+    assert versions.store(source)[0] == path_to_version
+
+
+@pytest.mark.parametrize("algorithm", ["sha1", "md5", "blake2b"])
+def test_version_store_rejects_other_digests(tmp_path, algorithm):
+    versions = VersionStore(str(tmp_path / "repository"))
+    source = write(tmp_path / "source", b"known content")
+
+    with pytest.raises(ValueError):
+        versions.store(source, digest=hashlib.new(algorithm, b"known content").hexdigest())
+    with pytest.raises(ValueError):
+        versions.objects.put_file(source, "not a digest")
+
+    assert list(versions.objects.iter_loose()) == []
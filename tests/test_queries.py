@@ -0,0 +1,85 @@
+"""
+The DatabaseQueries lookups run a fixed number of statements, however many rows they return
+"""
+
+import os
+import contextlib
+from sqlalchemy import event
+from database import DatabaseQueries
+from database.models import Users, Projects, Tasklists
+
+
+@contextlib.contextmanager
+def count_statements(engine):
+    """
+    Counts the statements executed on an engine
+    :return: list that holds the count once the block exits
+    """
+
+    count = [0]
+
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        count[0] += 1
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield count
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def populate(path, projects, per_project):
+    """
+    Makes a database with projects that each have per_project users and tasks
+    :return: DatabaseQueries
+    """
+
+    os.makedirs(path)
+    queries = DatabaseQueries(path)
+    session = queries.session
+
+    for project_index in range(projects):
+        project = Projects(name="project {}".format(project_index))
+        session.add(project)
+        session.flush()
+
+        for index in range(per_project):
+            name = "{0}-{1}".format(project_index, index)
+            session.add(Users(username="user " + name, email=name, projects=[project]))
+            session.add(Tasklists(taskname="task " + name, project=project.name,
+                                  project_id=project.id))
+
+    session.commit()
+
+    return queries
+
+
+def statements_per_lookup(path, projects, per_project):
+    """
+    :return: dict of lookup: number of statements it ran
+    """
+
+    queries = populate(path, projects, per_project)
+    lookups = {
+        "get_users_for_project": lambda: queries.get_users_for_project("project 0"),
+        "query_all_tasks": queries.query_all_tasks,
+        "get_tasks_by_project": queries.get_tasks_by_project,
+    }
+
+    counts = {}
+    for name, lookup in lookups.items():
+        queries.session.expire_all()
+        with count_statements(queries.session.get_bind()) as count:
+            result = lookup()
+        assert len(result) >= min(projects, per_project)
+        counts[name] = count[0]
+
+    return counts
+
+
+def test_statement_count_does_not_grow_with_rows(tmp_path):
+    small = statements_per_lookup(str(tmp_path / "small"), 3, 3)
+    large = statements_per_lookup(str(tmp_path / "large"), 30, 30)
+
+    assert small == large
+    assert all(count == 1 for count in large.values())
@@ -0,0 +1,188 @@
+"""
+Raster block layouts: TIFF strips and tiles, HFA block tables, and damaged files that have to fall
+back to plain chunks
+"""
+
+import struct
+import pytest
+from filesystem_utils.rasters import (tiff_blocks, hfa_blocks, block_layout, HFA_HEADER_TAG,
+                                      IMAGE_WIDTH, IMAGE_LENGTH, STRIP_OFFSETS,
+                                      STRIP_BYTE_COUNTS, TILE_OFFSETS, TILE_BYTE_COUNTS)
+
+LONG = 4
+TIFF_DATA_OFFSET = 8
+HFA_ENTRY_SIZE = 124  # next, prev, parent, child, data, dataSize, name[64], type[32], modTime
+
+
+def write_tiff(path, ifds, data, order="<"):
+    """
+    Writes a classic TIFF: the header, data, then each IFD followed by its out-of-line values
+    :param ifds: list of IFDs, each a list of (tag, list of LONG values)
+    :param data: bytes placed straight after the header, at TIFF_DATA_OFFSET
+    :return: path
+    """
+
+    content = (b"II*\0" if order == "<" else b"MM\0*") + \
+        struct.pack(order + "I", TIFF_DATA_OFFSET + len(data)) + data
+
+    for index, tags in enumerate(ifds):
+        extra_offset = len(content) + 2 + 12 * len(tags) + 4
+        entries, extra = b"", b""
+
+        for tag, values in tags:
+            packed = struct.pack("{0}{1}I".format(order, len(values)), *values)
+            if len(packed) <= 4:
+                value = packed
+            else:
+                value = struct.pack(order + "I", extra_offset + len(extra))
+                extra += packed
+            entries += struct.pack(order + "HHI", tag, LONG, len(values)) + value
+
+        # The next IFD follows this one's out-of-line values
+        next_offset = extra_offset + len(extra) if index + 1 < len(ifds) else 0
+        content += struct.pack(order + "H", len(tags)) + entries + \
+            struct.pack(order + "I", next_offset) + extra
+
+    with open(path, 'wb') as f:
+        f.write(content)
+
+    return str(path)
+
+
+def striped_tags(offsets, byte_counts):
+    return [(IMAGE_WIDTH, [16]), (IMAGE_LENGTH, [16]), (STRIP_OFFSETS, offsets),
+            (STRIP_BYTE_COUNTS, byte_counts)]
+
+
+def write_hfa(path, blocks, data=b""):
+    """
+    Writes an HFA file with one layer, "Layer_1", whose Edms_State holds the given block table
+    :param blocks: list of (file code, offset, size, valid, compression type)
+    :param data: bytes appended after the block table, at hfa_data_offset(len(blocks))
+    :return: path
+    """
+
+    def entry(child, name, entry_type, data_offset=0, data_size=0):
+        return struct.pack("<IIIIII64s32sI", 0, 0, 0, child, data_offset, data_size,
+                           name.encode(), entry_type.encode(), 0)
+
+    root, layer, state = 32, 32 + HFA_ENTRY_SIZE, 32 + 2 * HFA_ENTRY_SIZE
+    state_data = state + HFA_ENTRY_SIZE
+    state_size = 22 + 14 * len(blocks)
+
+    content = HFA_HEADER_TAG.ljust(16, b"\0") + struct.pack("<I", 20)
+    content += b"\0" * 8 + struct.pack("<I", root)  # Header: version, free list, root entry
+    content += entry(layer, "root", "root")
+    content += entry(state, "Layer_1", "Eimg_Layer")
+    content += entry(0, "RasterDMS", "Edms_State", state_data, state_size)
+    content += b"\0" * 14 + struct.pack("<II", len(blocks), state_data + 22)
+    content += b"".join(struct.pack("<hIIHH", *block) for block in blocks)
+    assert len(content) == hfa_data_offset(len(blocks))
+
+    with open(path, 'wb') as f:
+        f.write(content + data)
+
+    return str(path)
+
+
+def hfa_data_offset(block_count):
+    """
+    :return: offset of the data write_hfa puts after a block table of block_count records
+    """
+
+    return 32 + 3 * HFA_ENTRY_SIZE + 22 + 14 * block_count
+
+
+def blocks_of(read_blocks, path):
+    with open(path, 'rb') as f:
+        return read_blocks(f)
+
+
+def chunks(path, chunk_size):
+    return [block[0] for block in block_layout(path, chunk_size=chunk_size)]
+
+
+@pytest.mark.parametrize("order", ["<", ">"])
+def test_strips_of_every_ifd_are_listed(tmp_path, order):
+    path = write_tiff(tmp_path / "striped.tif", [striped_tags([8, 108], [100, 100]),
+                                                 striped_tags([208], [50])],
+                      bytes(250), order)
+
+    assert blocks_of(tiff_blocks, path) == [("strip:0", 0, 8, 100), ("strip:0", 1, 108, 100),
+                                            ("strip:1", 0, 208, 50)]
+
+
+def test_tiled_layout_covers_the_file(tmp_path):
+    tiles = [(TILE_OFFSETS, [8, 72, 136, 200]), (TILE_BYTE_COUNTS, [64] * 4)]
+    path = write_tiff(tmp_path / "tiled.tif", [[(IMAGE_WIDTH, [16]), (IMAGE_LENGTH, [16])] + tiles],
+                      bytes(256))
+
+    layout = block_layout(path, min_block_size=0)
+    merged = block_layout(path, min_block_size=128)
+
+    assert blocks_of(tiff_blocks, path)[0] == ("tile:0", 0, 8, 64)
+    assert layout[:5] == [("other", 0, 1, 0, 8)] + [("tile:0", index, 1, 8 + 64 * index, 64)
+                                                    for index in range(4)]
+    assert merged[1:3] == [("tile:0", 0, 2, 8, 128), ("tile:0", 2, 2, 136, 128)]
+    for blocks in (layout, merged):
+        assert blocks[-1][0] == "other"
+        assert [block[3] for block in blocks[1:]] == \
+            [block[3] + block[4] for block in blocks[:-1]]
+
+
+@pytest.mark.parametrize("corruption", ["huge count", "offset past the end", "huge ifd",
+                                        "truncated"])
+def test_corrupt_tiffs_fall_back_to_chunks(tmp_path, corruption):
+    path = write_tiff(tmp_path / "corrupt.tif", [striped_tags([8, 108], [100, 100])], bytes(200))
+    with open(path, 'rb') as f:
+        content = bytearray(f.read())
+    ifd_offset = TIFF_DATA_OFFSET + 200
+    strip_byte_counts = ifd_offset + 2 + 12 * 3
+
+    if corruption == "huge count":
+        struct.pack_into("<I", content, strip_byte_counts + 4, 0x7fffffff)
+    elif corruption == "offset past the end":
+        struct.pack_into("<I", content, 4, len(content) + 1000)
+    elif corruption == "huge ifd":
+        struct.pack_into("<H", content, ifd_offset, 0xffff)
+    else:
+        content = content[:ifd_offset + 20]
+    with open(path, 'wb') as f:
+        f.write(content)
+
+    with pytest.raises(ValueError):
+        blocks_of(tiff_blocks, path)
+    assert chunks(path, 100) == ["chunk"] * ((len(content) + 99) // 100)
+
+
+def test_ifd_loop_is_read_once(tmp_path):
+    path = write_tiff(tmp_path / "loop.tif", [striped_tags([8], [100])], bytes(100))
+    with open(path, 'r+b') as f:
+        ifd_offset = TIFF_DATA_OFFSET + 100
+        f.seek(ifd_offset + 2 + 12 * 4)
+        f.write(struct.pack("<I", ifd_offset))  # The IFD is its own successor
+
+    assert blocks_of(tiff_blocks, path) == [("strip:0", 0, 8, 100)]
+
+
+def test_hfa_blocks_in_this_file_are_listed(tmp_path):
+    data_offset = hfa_data_offset(4)
+    blocks = [(0, data_offset + 100 * index, 100, 1, 0) for index in range(2)] + \
+        [(1, 0, 100, 1, 0),  # In the .ige spill file
+         (0, data_offset + 200, 100, 0, 0)]  # Not valid
+    path = write_hfa(tmp_path / "image.img", blocks, bytes(300))
+
+    assert blocks_of(hfa_blocks, path) == [("block:Layer_1", 0, data_offset, 100),
+                                           ("block:Layer_1", 1, data_offset + 100, 100)]
+    assert [block[0] for block in block_layout(path, min_block_size=0)] == \
+        ["other", "block:Layer_1", "block:Layer_1", "other"]
+
+
+def test_truncated_hfa_falls_back_to_chunks(tmp_path):
+    path = write_hfa(tmp_path / "image.img", [(0, 0, 100, 1, 0)])
+    with open(path, 'r+b') as f:
+        f.truncate(150)  # Cuts through the layer entry
+
+    with pytest.raises(ValueError):
+        blocks_of(hfa_blocks, path)
+    assert chunks(path, 64) == ["chunk"] * 3
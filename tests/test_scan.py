@@ -0,0 +1,265 @@
+"""
+Directory scans: incremental rescans, files that disappear or change between scans, and failures
+inside the streaming scan pipeline
+"""
+
+import os
+import shutil
+import threading
+import pytest
+import filesystem_utils.pipeline as pipeline
+from database import DatabaseQueries
+from database.models import Projects, Directories
+from filesystem_utils import GeneralFunctions
+from filesystem_utils.hashing import HashingEngine
+from filesystem_utils.merkle import removed_directories
+from filesystem_utils.pipeline import ScanPipeline
+
+IMAGE_EXTENSIONS = [".tif"]
+
+
+# Keys of the file_info dicts, in the order of the image tuples (see build_image_result)
+IMAGE_KEYS = ("image_path", "image_extension", "image_size", "image_hash",
+              "image_modification_time", "image_first_seen", "image_last_scanned", "image_on_disk",
+              "image_mtime_ns", "image_inode", "image_block_manifest", "image_hash_algorithm",
+              "image_fingerprint")
+
+
+def write_image(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+    os.utime(path, ns=(0, len(content)))  # Distinct mtimes, however fast the test runs
+
+
+def scan_into_database(queries, directory, change_detection_method, stream=False):
+    """
+    Scans directory into project 1 the way the add directory dialog does
+    :param stream: scan with stream_images instead of search_for_images
+    :return: list of image tuples the scan returned
+    """
+
+    project_id, directory_id = 1, 1
+    if queries.get_directory_id(project_id, directory) is None:
+        queries.session.add(Projects(id=project_id, name="project"))
+        queries.session.add(Directories(id=directory_id, project_id=project_id, root=directory))
+        queries.session.commit()
+
+    known_files = queries.get_file_stats()
+    functions = GeneralFunctions()
+    if stream:
+        images = [image for batch in functions.stream_images(IMAGE_EXTENSIONS, directory,
+                                                             known_files, change_detection_method)
+                  for image in batch]
+    else:
+        images = functions.search_for_images(IMAGE_EXTENSIONS, directory, known_files,
+                                             change_detection_method)
+
+    for image in images:
+        file_info = dict(zip(IMAGE_KEYS, image), project_id=project_id,
+                         directory_id=directory_id)
+        if image[0] in known_files:
+            queries.update_file_in_database(file_info)
+        else:
+            queries.add_file_to_database(file_info)
+
+    return images
+
+
+def test_search_skips_files_that_cannot_be_statted(tmp_path):
+    write_image(str(tmp_path / "a.tif"), b"a" * 100)
+    os.symlink(str(tmp_path / "missing.tif"), str(tmp_path / "dangling.tif"))
+
+    functions = GeneralFunctions()
+    images = functions.search_for_images(IMAGE_EXTENSIONS, str(tmp_path))
+
+    assert [image[0] for image in images] == [str(tmp_path / "a.tif")]
+
+
+def test_rescan_without_hashing_keeps_the_stored_hash(tmp_path):
+    images = tmp_path / "images"
+    images.mkdir()
+    image_path = str(images / "a.tif")
+    write_image(image_path, b"a" * 100)
+    queries = DatabaseQueries(str(tmp_path))
+
+    scan_into_database(queries, str(images), "hash")
+    stored_hash = queries.get_file_stats()[image_path][3]
+    write_image(image_path, b"b" * 200)
+    rescanned = scan_into_database(queries, str(images), "modification_time")
+
+    assert [image[3] for image in rescanned] == [None]
+    assert stored_hash is not None
+    assert queries.get_file_stats()[image_path][:4] == (200, 200, os.stat(image_path).st_ino,
+                                                        stored_hash)
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_fingerprint_rescan_hashes_edited_files(tmp_path, stream):
+    images = tmp_path / "images"
+    images.mkdir()
+    image_path = str(images / "a.tif")
+    write_image(image_path, b"a" * 100)
+    queries = DatabaseQueries(str(tmp_path))
+
+    scan_into_database(queries, str(images), "hash", stream)
+    old_hash = queries.get_file_stats()[image_path][3]
+    write_image(image_path, b"b" * 200)
+    scan_into_database(queries, str(images), "fingerprint", stream)
+
+    image_hash = queries.get_file_stats()[image_path][3]
+    assert image_hash is not None
+    assert image_hash != old_hash
+    assert image_hash == GeneralFunctions().get_file_hash(image_path)
+
+
+def test_removed_directories_are_marked_and_their_digests_dropped(tmp_path):
+    images = tmp_path / "images"
+    (images / "kept").mkdir(parents=True)
+    (images / "gone" / "deeper").mkdir(parents=True)
+    for name in ("kept/a.tif", "gone/b.tif", "gone/deeper/c.tif"):
+        write_image(str(images / name), b"image")
+    queries = DatabaseQueries(str(tmp_path))
+    functions = GeneralFunctions()
+
+    scan_into_database(queries, str(images), "hash")
+    digests, _, _ = functions.get_changed_directories(IMAGE_EXTENSIONS, str(images), {})
+    queries.save_directory_digests(1, digests)
+    shutil.rmtree(str(images / "gone"))
+
+    digests, directories, removed = functions.get_changed_directories(
+        IMAGE_EXTENSIONS, str(images), queries.get_directory_digests(1))
+    marked = queries.mark_directories_removed(1, removed)
+    queries.save_directory_digests(1, digests)
+
+    assert directories == [str(images)]
+    assert removed == [str(images / "gone"), str(images / "gone" / "deeper")]
+    assert marked == 2
+    assert sorted(queries.get_all_remote_files(on_disk=False)) == \
+        [(str(images / "gone" / "b.tif"), 1), (str(images / "gone" / "deeper" / "c.tif"), 1)]
+    assert sorted(queries.get_directory_digests(1)) == [str(images), str(images / "kept")]
+
+
+def test_unreadable_directories_are_not_removed(tmp_path):
+    stored_digests = {str(tmp_path): None, str(tmp_path / "gone"): None}
+
+    assert removed_directories({}, stored_digests) == [str(tmp_path / "gone")]
+
+
+class FailingEngine(HashingEngine):
+    """
+    Hashing engine that raises on one file, as a full disk or a bug in a hasher would
+    """
+
+    def __init__(self, failing_path):
+        super(FailingEngine, self).__init__(workers=2, algorithm="sha256")
+        self.failing_path = failing_path
+
+    def hash_file(self, path, algorithm=None):
+        if path == self.failing_path:
+            raise RuntimeError("hasher failed on {}".format(path))
+        return super(FailingEngine, self).hash_file(path, algorithm)
+
+
+def make_images(directory, count):
+    """
+    :return: sorted paths of count small images in directory
+    """
+
+    paths = [str(directory / "{:03d}.tif".format(index)) for index in range(count)]
+    for path in paths:
+        write_image(path, path.encode())
+
+    return paths
+
+
+def consume(batches, timeout=30):
+    """
+    Reads every batch in another thread, so a hang fails the test instead of blocking it
+    :return: (list of images, exception raised by the pipeline or None)
+    """
+
+    result = {"images": [], "error": None}
+
+    def run():
+        try:
+            for batch in batches:
+                result["images"] += batch
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "pipeline hung"
+
+    return result["images"], result["error"]
+
+
+def test_pipeline_streams_every_image(tmp_path):
+    paths = make_images(tmp_path, 50)
+
+    images, error = consume(ScanPipeline(IMAGE_EXTENSIONS, str(tmp_path), batch_size=7,
+                                         queue_size=4).batches())
+
+    assert error is None
+    assert sorted(image[0] for image in images) == paths
+    assert all(image[3] is not None for image in images)
+
+
+def test_hash_stage_failure_is_raised_to_the_consumer(tmp_path):
+    paths = make_images(tmp_path, 50)
+    engine = FailingEngine(paths[20])
+
+    images, error = consume(ScanPipeline(IMAGE_EXTENSIONS, str(tmp_path), hashing_engine=engine,
+                                         batch_size=5, queue_size=4).batches())
+
+    assert isinstance(error, RuntimeError)
+    assert paths[20] not in [image[0] for image in images]
+
+
+def test_stat_stage_failure_is_raised_to_the_consumer(tmp_path, monkeypatch):
+    paths = make_images(tmp_path, 50)
+    original = pipeline.stat_image
+
+    def failing_stat_image(image_path, known_files, change_detection_method):
+        if image_path == paths[30]:
+            raise KeyError(image_path)  # Not an OSError, so the stage doesn't skip it
+        return original(image_path, known_files, change_detection_method)
+
+    monkeypatch.setattr(pipeline, "stat_image", failing_stat_image)
+
+    _, error = consume(ScanPipeline(IMAGE_EXTENSIONS, str(tmp_path), batch_size=5,
+                                    queue_size=4).batches())
+
+    assert isinstance(error, KeyError)
+
+
+def test_walk_stage_failure_is_raised_to_the_consumer(tmp_path, monkeypatch):
+    make_images(tmp_path, 10)
+    original = pipeline.iter_image_paths
+
+    def failing_walk(image_extensions, directory):
+        for index, image in enumerate(original(image_extensions, directory)):
+            if index == 5:
+                raise RuntimeError("walk failed")
+            yield image
+
+    monkeypatch.setattr(pipeline, "iter_image_paths", failing_walk)
+
+    images, error = consume(ScanPipeline(IMAGE_EXTENSIONS, str(tmp_path)).batches())
+
+    assert isinstance(error, RuntimeError)
+    assert len(images) <= 5
+
+
+def test_consumer_can_stop_early(tmp_path):
+    make_images(tmp_path, 50)
+    batches = ScanPipeline(IMAGE_EXTENSIONS, str(tmp_path), batch_size=2, queue_size=2).batches()
+
+    first = next(batches)
+    closer = threading.Thread(target=batches.close, daemon=True)
+    closer.start()
+    closer.join(30)
+
+    assert len(first) == 2
+    assert not closer.is_alive(), "pipeline hung after the consumer stopped"
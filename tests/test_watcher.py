@@ -0,0 +1,102 @@
+"""
+Directory watcher: inotify events for whole directories, and batches that fail to be recorded
+"""
+
+import os
+import sys
+import pytest
+from filesystem_utils.watcher import InotifyBackend, DirectoryWatcher, ADDED, MODIFIED, DELETED
+
+IMAGE_EXTENSIONS = [".tif"]
+
+linux_only = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs inotify")
+
+
+def make_tree(root):
+    """
+    Makes root/project/scenes/{a,b}.tif and root/outside
+    :return: (project directory, outside directory)
+    """
+
+    project = root / "project"
+    scenes = project / "scenes"
+    outside = root / "outside"
+    scenes.mkdir(parents=True)
+    outside.mkdir()
+    for name in ("a.tif", "b.tif"):
+        (scenes / name).write_bytes(b"image")
+
+    return str(project), str(outside)
+
+
+def read_all_events(backend):
+    """
+    Reads events until inotify has nothing more to report
+    :return: set of (path, change_type)
+    """
+
+    events = set()
+    while True:
+        new_events = backend.read_events(0.2)
+        if not new_events:
+            return events
+        events.update(new_events)
+
+
+@linux_only
+def test_directory_moved_out_of_the_tree_is_deleted(tmp_path):
+    project, outside = make_tree(tmp_path)
+    backend = InotifyBackend(IMAGE_EXTENSIONS)
+    backend.add_tree(project)
+
+    os.rename(os.path.join(project, "scenes"), os.path.join(outside, "scenes"))
+    events = read_all_events(backend)
+    (tmp_path / "outside" / "scenes" / "c.tif").write_bytes(b"image")
+    later_events = read_all_events(backend)
+    backend.close()
+
+    assert events == {(os.path.join(project, "scenes", name), DELETED)
+                      for name in ("a.tif", "b.tif")}
+    assert later_events == set()
+    assert list(backend.watches.values()) == [project]
+
+
+@linux_only
+def test_directory_renamed_inside_the_tree_is_deleted_and_added(tmp_path):
+    project, _ = make_tree(tmp_path)
+    backend = InotifyBackend(IMAGE_EXTENSIONS)
+    backend.add_tree(project)
+
+    os.rename(os.path.join(project, "scenes"), os.path.join(project, "renamed"))
+    events = read_all_events(backend)
+    new_image = os.path.join(project, "renamed", "c.tif")
+    (tmp_path / "project" / "renamed" / "c.tif").write_bytes(b"image")
+    later_events = read_all_events(backend)
+    backend.close()
+
+    assert events == {(os.path.join(project, directory, name), change_type)
+                      for directory, change_type in (("scenes", DELETED), ("renamed", ADDED))
+                      for name in ("a.tif", "b.tif")}
+    assert (new_image, ADDED) in later_events
+    assert all(path == new_image for path, _ in later_events)
+
+
+def test_failed_batch_is_reported_again(tmp_path):
+    batches = []
+
+    def on_changes(changes):
+        batches.append(sorted(changes))
+        if len(batches) == 1:
+            raise RuntimeError("database is locked")
+
+    watcher = DirectoryWatcher([str(tmp_path)], IMAGE_EXTENSIONS, on_changes, debounce=0,
+                               use_polling=True)
+    watcher._add_event("a.tif", ADDED, 0)
+    watcher._add_event("b.tif", MODIFIED, 0)
+
+    watcher._flush(None)
+    watcher._flush(None)
+    watcher._flush(None)
+
+    assert batches == [[("a.tif", ADDED), ("b.tif", MODIFIED)]] * 2
+    assert watcher.pending == {}